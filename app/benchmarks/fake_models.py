@@ -0,0 +1,48 @@
+import asyncio
+import hashlib
+import random
+from typing import Callable, List
+from pydantic_ai.messages import ModelMessage, ModelResponse, ToolCallPart, UserPromptPart
+from pydantic_ai.models.function import AgentInfo, FunctionModel
+from app.coding.policy_models import PolicyAnalysis
+
+
+def _user_prompt(messages: List[ModelMessage]) -> str:
+    for part in reversed(messages[-1].parts):
+        if isinstance(part, UserPromptPart) and isinstance(part.content, str):
+            return part.content
+    return ""
+
+
+def _fraction(text: str) -> float:
+    """Stable number in [0, 1) derived from the text, so the same prompt always gets the same answer."""
+    return int(hashlib.sha256(text.encode("utf-8")).hexdigest()[:8], 16) / 16 ** 8
+
+
+def simulated_model(output_for: Callable[[str], dict], latency: float = 0.5, jitter: float = 0.5, seed: int = 0) -> FunctionModel:
+    """
+    pydantic-ai FunctionModel standing in for the OpenAI model: waits latency * (1 +- jitter) seconds,
+    then returns output_for(user prompt) as the structured output. Pass it as 'model' to build_agent / build_coding_agent.
+    """
+    rng = random.Random(seed)
+
+    async def respond(messages: List[ModelMessage], info: AgentInfo) -> ModelResponse:
+        await asyncio.sleep(latency * (1 + rng.uniform(-jitter, jitter)))
+        return ModelResponse(parts=[ToolCallPart(info.output_tools[0].name, output_for(_user_prompt(messages)))])
+
+    return FunctionModel(respond)
+
+
+def screening_output(prompt: str) -> dict:
+    """ResponseModel fields: about 10% of the papers are included."""
+    fraction = _fraction(prompt)
+    return {"should_be_included": fraction < 0.1, "confidence_level": round(0.5 + fraction / 2, 3), "summary": "Synthetic decision."}
+
+
+def coding_output(prompt: str) -> dict:
+    """Every PolicyAnalysis field (they are all required, even the Optional ones): the codes left empty but the outcome."""
+    outcomes = ["Success", "Failure", "Mixed Outcome"]
+    return {name: None for name in PolicyAnalysis.model_fields} | {
+        "title": prompt[:40],
+        "implementation_performance": outcomes[int(_fraction(prompt) * len(outcomes))],
+    }
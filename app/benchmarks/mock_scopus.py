@@ -0,0 +1,187 @@
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List, Optional
+from urllib.parse import parse_qs, urlparse
+
+WORDS = """
+policy implementation governance climate energy water urban transport health education reform regulation
+incentive compliance outcome evaluation stakeholder municipality federal local program agency budget
+participation legitimacy conflict feedback capacity enforcement adoption diffusion sustainability
+""".split()
+
+
+def synthetic_eid(i: int) -> str:
+    return f"2-s2.0-{i:011d}"
+
+
+def synthetic_text(rng: random.Random, words: int) -> str:
+    return " ".join(rng.choice(WORDS) for _ in range(words))
+
+
+def synthetic_entry(i: int) -> dict:
+    """One entry of a Scopus search results page, with the fields entry_to_paper reads."""
+    rng = random.Random(i)
+    eid = synthetic_eid(i)
+    return {
+        "eid": eid,
+        "dc:identifier": f"SCOPUS_ID:{i}",
+        "dc:creator": f"Author {i}",
+        "prism:url": f"https://api.elsevier.com/content/abstract/scopus_id/{i}",
+        "prism:doi": f"10.1000/synthetic.{i}",
+        "link": [{"@href": f"https://example.org/{eid}/{kind}"} for kind in ("self", "author-affiliation", "scopus")],
+        "openaccess": "1" if i % 3 == 0 else "0",
+        "openaccessFlag": i % 3 == 0,
+        "pii": f"S{i:016d}",
+        "subtypeDescription": "Article",
+        "subtype": "ar",
+        "citedby-count": str(rng.randint(0, 200)),
+        "prism:publicationName": "Journal of Synthetic Policy",
+        "prism:issn": "00000000",
+        "prism:coverDate": f"{rng.randint(2000, 2024)}-01-01",
+        "dc:title": f"Paper {i}: {synthetic_text(rng, 8)}",
+    }
+
+
+class MockScopus:
+    """
+    Local stand-in for the Scopus Search, Abstract Retrieval and Article Retrieval (PDF) APIs, served from a background thread.
+    Every response waits 'latency' seconds, and a share 'throttle_rate' of the requests get a 429 with Retry-After,
+    so the retry and rate limiting paths are exercised too. With 'api_key', requests without that X-ELS-APIKey get a 401.
+    Use it as a context manager:
+        with MockScopus(10_000) as scopus:
+            get_papers({}, scopus.search_url, ...)
+    handling_times holds the time the server took for each request it answered with a 200.
+    """
+
+    def __init__(self, papers: int, latency: float = 0.05, throttle_rate: float = 0.0, retry_after: float = 0.1, seed: int = 0,
+                 api_key: Optional[str] = None):
+        self.papers = papers
+        self.api_key = api_key
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.rng = random.Random(seed)
+        self.requests = 0
+        self.throttled = 0
+        self.handling_times: List[float] = []
+        self._lock = threading.Lock()
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self.server.daemon_threads = True
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    @property
+    def search_url(self) -> str:
+        return f"{self.base_url}/content/search/scopus"
+
+    @property
+    def abstract_url(self) -> str:
+        return self.base_url + "/content/abstract/eid/{eid}"
+
+    @property
+    def article_url(self) -> str:
+        return self.base_url + "/content/article/pii/{pii}"
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def reset_stats(self):
+        with self._lock:
+            self.requests = 0
+            self.throttled = 0
+            self.handling_times = []
+
+    def _search(self, params: dict) -> dict:
+        start = int(params.get("start", ["0"])[0])
+        count = int(params.get("count", ["25"])[0])
+        return {"search-results": {
+            "opensearch:totalResults": str(self.papers),
+            "entry": [synthetic_entry(i) for i in range(start, min(start + count, self.papers))],
+        }}
+
+    def _abstract(self, eid: str) -> dict:
+        rng = random.Random(eid)
+        return {"abstracts-retrieval-response": {"coredata": {"dc:description": synthetic_text(rng, 150)}}}
+
+    def _article(self, pii: str) -> bytes:
+        """A minimal one-page PDF with some text of the paper."""
+        text = synthetic_text(random.Random(pii), 40)
+        stream = f"BT /F1 10 Tf 50 750 Td ({text}) Tj ET".encode("latin-1")
+        objects = [
+            b"<< /Type /Catalog /Pages 2 0 R >>",
+            b"<< /Type /Pages /Kids [3 0 R] /Count 1 >>",
+            b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Contents 4 0 R /Resources << /Font << /F1 5 0 R >> >> >>",
+            b"<< /Length " + str(len(stream)).encode() + b" >>\nstream\n" + stream + b"\nendstream",
+            b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+        ]
+        pdf = b"%PDF-1.4\n"
+        offsets = []
+        for number, body in enumerate(objects, 1):
+            offsets.append(len(pdf))
+            pdf += f"{number} 0 obj\n".encode() + body + b"\nendobj\n"
+        xref = len(pdf)
+        pdf += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode()
+        pdf += b"".join(f"{offset:010d} 00000 n \n".encode() for offset in offsets)
+        pdf += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode()
+        return pdf
+
+    def _handler(self):
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # Keep-alive, like the real API, so pooled clients reuse their connections
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                started = time.perf_counter()
+                url = urlparse(self.path)
+                with mock._lock:
+                    mock.requests += 1
+                    throttle = mock.rng.random() < mock.throttle_rate
+                    if throttle:
+                        mock.throttled += 1
+                time.sleep(mock.latency)
+                if throttle:
+                    self._send(429, {"error": "throttled"}, {"Retry-After": str(mock.retry_after)})
+                    return
+                if mock.api_key is not None and self.headers.get("X-ELS-APIKey") != mock.api_key:
+                    self._send(401, {"error": "invalid API key"})
+                    return
+                if url.path == "/content/search/scopus":
+                    self._send(200, mock._search(parse_qs(url.query)))
+                elif url.path.startswith("/content/abstract/eid/"):
+                    self._send(200, mock._abstract(url.path.rsplit("/", 1)[-1]))
+                elif url.path.startswith("/content/article/pii/"):
+                    self._send(200, mock._article(url.path.rsplit("/", 1)[-1]), content_type="application/pdf")
+                else:
+                    self._send(404, {"error": "not found"})
+                    return
+                with mock._lock:
+                    mock.handling_times.append(time.perf_counter() - started)
+
+            def _send(self, status: int, body, headers: dict = None, content_type: str = "application/json"):
+                data = body if isinstance(body, bytes) else json.dumps(body).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(data)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
@@ -0,0 +1,198 @@
+import asyncio
+import json
+import logging
+import random
+import tempfile
+import time
+import tracemalloc
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Callable, List, Optional
+from app.benchmarks.fake_models import coding_output, screening_output, simulated_model
+from app.benchmarks.mock_scopus import MockScopus, synthetic_text
+from app.coding.results_store import ResultsStore
+from app.coding.runner import build_coding_agent, code_documents_async
+from app.extract_papers import retrieves_abstracts
+from app.extract_papers.analyses_abstracts import build_agent, process_and_update_papers
+from app.extract_papers.fulltext import fetch_fulltexts_async
+from app.extract_papers.retrieves_abstracts import retrieve_abstracts_async
+from app.extract_papers.screening_engine import UPDATE_SCREENING_SQL
+from app.extract_papers.search_basic_info import create_db, get_papers, get_papers_async, insert_papers_to_db
+from app.instrumentation import save_at_exit
+from app.run_metrics import RunMetrics
+from app.storage import connect
+
+INSTRUCTIONS = "Include the papers about the implementation of public policies."
+
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    if not values:
+        return None
+    values = sorted(values)
+    return values[int(q * (len(values) - 1))]
+
+
+def call_latencies(metrics: RunMetrics) -> List[float]:
+    """Latency of every model call recorded by this run."""
+    metrics.flush()
+    return [row[0] for row in metrics.conn.execute("SELECT latency FROM run_metrics WHERE run_id = ?", (metrics.run_id,))]
+
+
+@contextmanager
+def timed_calls(module, name: str, totals: dict):
+    """Adds the time spent in module.name to totals[name] while the block runs, e.g. the DB flushes of a stage."""
+    original = getattr(module, name)
+    totals.setdefault(name, 0.0)
+
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return original(*args, **kwargs)
+        finally:
+            totals[name] += time.perf_counter() - started
+
+    setattr(module, name, wrapper)
+    try:
+        yield totals
+    finally:
+        setattr(module, name, original)
+
+
+def measure(stage: str, papers: int, items: int, run: Callable[[], object], latencies: Callable[[], List[float]] = lambda: [],
+            db_write_seconds: Callable[[], Optional[float]] = lambda: None) -> dict:
+    """
+    Runs one stage and returns its wall time, throughput (items per second), p50/p95 latency of its requests or model calls,
+    peak Python memory (tracemalloc, which slows allocations down a bit) and the time spent writing to SQLite.
+    When run() returns a number, it is the count of items actually completed and the throughput is computed from it,
+    so failed items are not counted; 'items' is then only the number attempted.
+    """
+    tracemalloc.start()
+    started = time.perf_counter()
+    completed = run()
+    seconds = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    values = latencies()
+    result = {
+        "stage": stage,
+        "papers": papers,
+        "attempted": items,
+        "items": completed if isinstance(completed, int) else items,
+        "seconds": round(seconds, 3),
+        "items_per_second": round((completed if isinstance(completed, int) else items) / seconds, 1) if seconds else None,
+        "latency_p50": percentile(values, 0.5),
+        "latency_p95": percentile(values, 0.95),
+        "peak_memory_mb": round(peak / 2 ** 20, 1),
+        "db_write_seconds": db_write_seconds(),
+    }
+    logging.warning(f"Benchmark: {result}")
+    return result
+
+
+def benchmark_size(papers: int, work_dir: Path, scopus_latency: float, throttle_rate: float, model_latency: float, chunk: int,
+                   http_concurrency: int, llm_concurrency: int, coding_share: float) -> List[dict]:
+    """All the stages for one corpus size, against a fresh database in work_dir."""
+    results = []
+    db_path = str(work_dir / f"bench_{papers}.db")
+    metrics_path = str(work_dir / f"bench_{papers}_metrics.db")
+    harvested = []
+    # Quotas are the mock's, not Elsevier's or OpenAI's: the budgets should not be what is measured
+    fast = 10_000.0
+
+    with MockScopus(papers, latency=scopus_latency) as scopus:
+        # requests has no retry, so the sequential harvest runs without 429s
+        results.append(measure("get_papers", papers, papers,
+                               lambda: harvested.extend(get_papers({}, scopus.search_url, "bench", "", "", papers, chunk)) or len(harvested),
+                               lambda: scopus.handling_times))
+        scopus.reset_stats()
+        scopus.throttle_rate = throttle_rate
+        results.append(measure("get_papers_async", papers, papers,
+                               lambda: len(asyncio.run(get_papers_async({}, scopus.search_url, "bench", "", "", papers, chunk,
+                                                                        http_concurrency, fast))),
+                               lambda: scopus.handling_times))
+
+        create_db(db_path)
+        results.append(measure("insert_papers_to_db", papers, papers, lambda: insert_papers_to_db(db_path, harvested)))
+        # The whole stage is the write
+        results[-1]["db_write_seconds"] = results[-1]["seconds"]
+
+        scopus.reset_stats()
+        flush_times = {}
+        with timed_calls(retrieves_abstracts, "flush_abstracts", flush_times):
+            results.append(measure("retrieve_abstracts", papers, papers,
+                                   lambda: asyncio.run(retrieve_abstracts_async(db_path, {}, http_concurrency, fast,
+                                                                                url=scopus.abstract_url)),
+                                   lambda: scopus.handling_times,
+                                   lambda: round(flush_times["flush_abstracts"], 3)))
+        results[-1]["throttled_requests"] = scopus.throttled
+
+        # Every third synthetic paper is open access
+        scopus.reset_stats()
+        host = scopus.base_url.split("//", 1)[1]
+        results.append(measure("fetch_fulltexts", papers, len(range(0, papers, 3)),
+                               lambda: len(asyncio.run(fetch_fulltexts_async(db_path, work_dir / f"fulltexts_{papers}", {}, None,
+                                                                             http_concurrency, only_included=False,
+                                                                             host_rates={host: fast}, article_url=scopus.article_url))),
+                               lambda: scopus.handling_times))
+    del harvested[:]
+
+    metrics = RunMetrics(metrics_path, f"bench_screening_{papers}")
+    agent = build_agent(INSTRUCTIONS, model=simulated_model(screening_output, model_latency))
+    results.append(measure("process_and_update_papers", papers, papers,
+                           lambda: process_and_update_papers(db_path, agent, INSTRUCTIONS, True, llm_concurrency,
+                                                             requests_per_minute=10 ** 9, tokens_per_minute=10 ** 12,
+                                                             metrics=metrics),
+                           lambda: call_latencies(metrics)))
+    metrics.close()
+
+    # The screening writer's UPDATEs on their own, batched the same way (50 per transaction)
+    conn = connect(db_path)
+    rows = [(True, 0.9, "Synthetic decision.", "bench", "bench", eid) for (eid,) in conn.execute("SELECT eid FROM papers")]
+
+    def write_decisions():
+        for start in range(0, len(rows), 50):
+            with conn:
+                conn.executemany(UPDATE_SCREENING_SQL, rows[start:start + 50])
+
+    results.append(measure("screening_db_writes", papers, len(rows), write_decisions))
+    results[-1]["db_write_seconds"] = results[-1]["seconds"]
+    conn.close()
+
+    documents = max(1, int(papers * coding_share))
+    texts = {Path(f"doc_{i}.pdf"): synthetic_text(random.Random(i), 2000) for i in range(documents)}
+    metrics = RunMetrics(metrics_path, f"bench_coding_{papers}")
+    coding_agent = build_coding_agent(model=simulated_model(coding_output, model_latency))
+    store = ResultsStore(str(work_dir / f"bench_{papers}_coding.db"))
+    results.append(measure("code_documents", papers, documents,
+                           lambda: asyncio.run(code_documents_async(coding_agent, texts, store, llm_concurrency, recode_all=True,
+                                                                    metrics=metrics)),
+                           lambda: call_latencies(metrics)))
+    store.close()
+    metrics.close()
+    return results
+
+
+if __name__ == "__main__":
+    # Config:
+    sizes = [1_000, 10_000, 100_000] # synthetic corpus sizes. 100k takes a while with the default latencies
+    scopus_latency = 0.05 # seconds per request of the mock Scopus server
+    throttle_rate = 0.02 # share of the async requests answered with a 429
+    model_latency = 0.2 # seconds per call of the simulated model (+-50%)
+    chunk = 25 # papers per search page, as in search_basic_info
+    http_concurrency = 8
+    llm_concurrency = 32
+    coding_share = 0.1 # documents coded per paper of the corpus
+    results_path = Path(__file__).parent / "results.jsonl" # one line per stage and size, appended to compare runs
+    # Histograms of the simulated runs, kept apart from the real ones in app/run_metrics.db
+    save_at_exit(Path(__file__).parent / "instrumentation.db", Path(__file__).parent / "instrumentation.prom")
+
+    # Only the benchmark lines: the stages log every page / paper at INFO
+    logging.getLogger().setLevel(logging.WARNING)
+    run_at = time.strftime("%Y-%m-%dT%H:%M:%S")
+    with tempfile.TemporaryDirectory() as work_dir:
+        for size in sizes:
+            for result in benchmark_size(size, Path(work_dir), scopus_latency, throttle_rate, model_latency, chunk,
+                                         http_concurrency, llm_concurrency, coding_share):
+                with open(results_path, "a", encoding="utf-8") as f:
+                    f.write(json.dumps({"run_at": run_at, **result}) + "\n")
+    print(f"Results appended to {results_path}")
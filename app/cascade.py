@@ -0,0 +1,95 @@
+import time
+from typing import Any, Callable, Dict, Iterable, Optional, Sequence
+from pydantic import BaseModel
+from app.llm_cache import CachedResult, agent_model_name
+
+
+def escalate_when(min_confidence: Optional[float] = None, field_values: Optional[Dict[str, Iterable]] = None) -> Callable[[BaseModel], bool]:
+    """
+    Escalation rule for CascadeAgent: True when the output's confidence_level is below min_confidence,
+    or when one of its fields has one of the given values, e.g. {"should_be_included": [True]} to have
+    every inclusion confirmed by the larger model.
+    """
+    field_values = {name: set(values) for name, values in (field_values or {}).items()}
+
+    def escalate(output: BaseModel) -> bool:
+        confidence = getattr(output, "confidence_level", None)
+        if min_confidence is not None and confidence is not None and confidence < min_confidence:
+            return True
+        return any(getattr(output, name, None) in values for name, values in field_values.items())
+
+    return escalate
+
+
+class CascadeResult:
+    """
+    Stands in for the AgentRunResult of a cascade call. 'output' is the larger model's answer when the call was
+    escalated, the small model's otherwise. Both answers are kept for the audit (see RunMetrics.record_cascade).
+    """
+
+    def __init__(self, cheap_result, cheap_model: str, cheap_latency: float, strong_result=None, strong_model: Optional[str] = None,
+                 strong_latency: Optional[float] = None, agreement_fields: Sequence[str] = ()):
+        self.cheap_result = cheap_result
+        self.cheap_model = cheap_model
+        self.cheap_latency = cheap_latency
+        self.strong_result = strong_result
+        self.strong_model = strong_model
+        self.strong_latency = strong_latency
+        self.agreement_fields = agreement_fields
+
+    @property
+    def escalated(self) -> bool:
+        return self.strong_result is not None
+
+    @property
+    def output(self) -> BaseModel:
+        return (self.strong_result or self.cheap_result).output
+
+    @property
+    def agreed(self) -> Optional[bool]:
+        """Whether both models gave the same agreement_fields, None if the call was not escalated."""
+        if not self.escalated:
+            return None
+        cheap, strong = self.cheap_result.output, self.strong_result.output
+        return all(getattr(cheap, name, None) == getattr(strong, name, None) for name in self.agreement_fields)
+
+    @property
+    def from_cache(self) -> bool:
+        return all(isinstance(result, CachedResult) for result in (self.cheap_result, self.strong_result) if result is not None)
+
+    def usage(self):
+        """Tokens of both calls, so rate budgets and metrics account for the escalation."""
+        if not self.escalated:
+            return self.cheap_result.usage()
+        return self.cheap_result.usage() + self.strong_result.usage()
+
+
+class CascadeAgent:
+    """
+    Asks a small, fast model first and only re-runs the call on the larger model when escalate(output) is True
+    (see escalate_when). Takes Agents or CachedAgents, and has the same run() signature, so it can be passed
+    wherever an agent is expected (screen_papers_async, code_documents_async...).
+    Its model name combines both models, so decisions made by the cascade are told apart from single-model ones.
+    """
+
+    def __init__(self, cheap_agent, strong_agent, escalate: Callable[[BaseModel], bool], agreement_fields: Sequence[str] = ()):
+        self.cheap_agent = cheap_agent
+        self.strong_agent = strong_agent
+        self.escalate = escalate
+        self.agreement_fields = agreement_fields
+
+    @property
+    def model(self) -> str:
+        return f"cascade:{agent_model_name(self.cheap_agent)}>{agent_model_name(self.strong_agent)}"
+
+    async def run(self, user_prompt: str, deps: Any = None, **kwargs) -> CascadeResult:
+        started = time.perf_counter()
+        cheap_result = await self.cheap_agent.run(user_prompt, deps=deps, **kwargs)
+        result = CascadeResult(cheap_result, agent_model_name(self.cheap_agent), time.perf_counter() - started,
+                               agreement_fields=self.agreement_fields)
+        if self.escalate(cheap_result.output):
+            started = time.perf_counter()
+            result.strong_result = await self.strong_agent.run(user_prompt, deps=deps, **kwargs)
+            result.strong_model = agent_model_name(self.strong_agent)
+            result.strong_latency = time.perf_counter() - started
+        return result
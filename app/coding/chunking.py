@@ -0,0 +1,110 @@
+import asyncio
+import time
+from collections import Counter
+from typing import List, Optional
+import tiktoken
+from app.coding.policy_models import PolicyAnalysis
+from app.cascade import CascadeResult
+from app.llm_cache import CachedResult, agent_model_name
+from app.run_metrics import RunMetrics
+
+EXCERPT_PREFIX = "text_excerpt_for_"
+EXCERPT_SEPARATOR = "\n[...]\n"
+
+
+def chunk_text(text: str, max_tokens: int = 8000, overlap: int = 400, encoding_name: str = "o200k_base") -> List[str]:
+    """
+    Splits the text into sections of at most 'max_tokens' tokens, each starting 'overlap' tokens before
+    the end of the previous one so a passage cut at a boundary is complete in one of the two sections.
+    o200k_base is the tokenizer of the gpt-4.1 / gpt-4o models.
+    """
+    if overlap >= max_tokens:
+        raise ValueError("overlap must be smaller than max_tokens")
+    encoding = tiktoken.get_encoding(encoding_name)
+    tokens = encoding.encode(text)
+    if len(tokens) <= max_tokens:
+        return [text]
+    step = max_tokens - overlap
+    return [encoding.decode(tokens[start:start + max_tokens]) for start in range(0, len(tokens) - overlap, step)]
+
+
+def _join_distinct(values: List[Optional[str]]) -> Optional[str]:
+    distinct = list(dict.fromkeys(v.strip() for v in values if v and v.strip()))
+    return EXCERPT_SEPARATOR.join(distinct) if distinct else None
+
+
+def merge_analyses(analyses: List[PolicyAnalysis]) -> PolicyAnalysis:
+    """
+    Combines the analyses of the sections of one document into one record.
+    - implementation_performance: the value all sections agree on, "Mixed Outcome" if they disagree.
+    - yes/no codes: True if any section found evidence, False if none did but some said False, None otherwise.
+    - text_excerpt_for_* fields: the excerpts of the sections that support the merged value, so the evidence is kept.
+    - other text fields: the distinct answers of all sections.
+    """
+    if len(analyses) == 1:
+        return analyses[0]
+    dumps = [analysis.model_dump() for analysis in analyses]
+    merged = {}
+    field_names = list(PolicyAnalysis.model_fields)
+    # The excerpt field names are lower case, the code they belong to not always (Political_salience_...)
+    codes_by_lower = {name.lower(): name for name in field_names if not name.startswith(EXCERPT_PREFIX)}
+
+    titles = Counter(d["title"] for d in dumps if d["title"])
+    merged["title"] = titles.most_common(1)[0][0] if titles else ""
+    performances = {d["implementation_performance"] for d in dumps}
+    merged["implementation_performance"] = performances.pop() if len(performances) == 1 else "Mixed Outcome"
+
+    for name in field_names:
+        if name in merged or name.startswith(EXCERPT_PREFIX):
+            continue
+        values = [d[name] for d in dumps]
+        annotation = PolicyAnalysis.model_fields[name].annotation
+        if annotation == Optional[bool]:
+            if any(v is True for v in values):
+                merged[name] = True
+            elif any(v is False for v in values):
+                merged[name] = False
+            else:
+                merged[name] = None
+        else:
+            merged[name] = _join_distinct(values)
+
+    for name in field_names:
+        if not name.startswith(EXCERPT_PREFIX):
+            continue
+        code = codes_by_lower.get(name[len(EXCERPT_PREFIX):].lower())
+        if code is None or code not in merged or (code == "implementation_performance" and merged[code] == "Mixed Outcome"):
+            supporting = dumps
+        else:
+            supporting = [d for d in dumps if d[code] == merged[code]]
+        merged[name] = _join_distinct([d[name] for d in supporting])
+
+    return PolicyAnalysis(**merged)
+
+
+async def code_text_async(agent, text: str, semaphore: asyncio.Semaphore, max_tokens: Optional[int] = None, overlap: int = 400,
+                          item_id: str = "", metrics: Optional[RunMetrics] = None) -> PolicyAnalysis:
+    """
+    Codes one document. With max_tokens set, long documents are split with chunk_text, the sections are coded
+    in parallel (each call takes a slot of 'semaphore') and the results are merged with merge_analyses.
+    The static instructions stay in the system prompt and the text is the user prompt, so all calls share a cacheable prefix.
+    With 'metrics', the usage of every call is recorded under item_id (plus the section number).
+    """
+    sections = chunk_text(text, max_tokens, overlap) if max_tokens else [text]
+    if len(sections) > 1:
+        sections = [f"Section {i} of {len(sections)} of the document:\n{section}" for i, section in enumerate(sections, 1)]
+
+    async def run(i: int, section: str) -> PolicyAnalysis:
+        async with semaphore:
+            started = time.perf_counter()
+            response = await agent.run(section)
+        if metrics is not None:
+            if isinstance(response, CascadeResult):
+                metrics.record_cascade(f"{item_id}#{i}", response)
+                from_cache = response.from_cache
+            else:
+                from_cache = isinstance(response, CachedResult)
+            metrics.record(f"{item_id}#{i}", agent_model_name(agent), response.usage(), time.perf_counter() - started, from_cache)
+        return response.output
+
+    return merge_analyses(await asyncio.gather(*(run(i, section) for i, section in enumerate(sections, 1))))
@@ -0,0 +1,32 @@
+from typing import Dict
+from pydantic import BaseModel
+from app.coding.chunking import EXCERPT_PREFIX, EXCERPT_SEPARATOR, chunk_text
+from app.coding.policy_models import PolicyAnalysis
+from app.embedding_index import EmbeddingIndex
+
+
+def code_queries(output_type: type[BaseModel] = PolicyAnalysis) -> Dict[str, str]:
+    """The description of every code of the output (excerpt fields left out), used to find the passages about it."""
+    return {
+        name: field.description
+        for name, field in output_type.model_fields.items()
+        if field.description and not name.startswith(EXCERPT_PREFIX)
+    }
+
+
+def index_passages(index: EmbeddingIndex, filename: str, text: str, max_tokens: int = 400, overlap: int = 50) -> int:
+    """Splits the document into passages of 'max_tokens' tokens and embeds those not in the index yet."""
+    passages = chunk_text(text, max_tokens, overlap)
+    return index.add(((f"{filename}#{i:05d}", passage) for i, passage in enumerate(passages)), keep_text=True)
+
+
+def select_passages(index: EmbeddingIndex, filename: str, k: int = 3, output_type: type[BaseModel] = PolicyAnalysis) -> str:
+    """
+    The k passages of the document closest to each code's description, without repeats and in document order.
+    This is what the coder sends instead of the whole text.
+    """
+    selected = set()
+    for query in code_queries(output_type).values():
+        selected.update(item_id for item_id, _ in index.search(query, k, item_prefix=f"{filename}#"))
+    texts = index.texts(sorted(selected))
+    return EXCERPT_SEPARATOR.join(texts[item_id] for item_id in sorted(selected) if texts.get(item_id))
@@ -0,0 +1,133 @@
+import hashlib
+import logging
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+from PyPDF2 import PdfReader
+from app.instrumentation import METRICS
+from app.storage import connect
+
+
+def file_hash(path: Path) -> str:
+    """SHA-256 of the file content, read in 1 MB blocks."""
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _extract_pages(path: str, start: int, stop: int) -> Tuple[List[str], float]:
+    """Text of pages [start, stop) of one PDF, and the seconds it took. Runs in a worker process."""
+    started = time.perf_counter()
+    reader = PdfReader(path)
+    pages = [reader.pages[i].extract_text() or "" for i in range(start, stop)]
+    return pages, time.perf_counter() - started
+
+
+def extract_pdf_text(path: Path) -> str:
+    """Text of the whole PDF, pages joined once at the end rather than concatenated one by one."""
+    reader = PdfReader(path)
+    return "".join(page.extract_text() or "" for page in reader.pages)
+
+
+class PdfTextCache:
+    """
+    Extracted PDF texts stored in SQLite.
+    A file whose path, mtime and size are unchanged is a hit without reading it. Otherwise the content hash is
+    looked up, so a renamed or touched but identical PDF is not parsed again either.
+    """
+
+    def __init__(self, db_path: str):
+        self.conn = connect(db_path)
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS pdf_text (
+                path TEXT PRIMARY KEY,
+                mtime REAL,
+                size INTEGER,
+                file_hash TEXT,
+                text TEXT)
+        ''')
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_pdf_text_hash ON pdf_text (file_hash)")
+        self.conn.commit()
+
+    def get(self, path: Path) -> Optional[str]:
+        stat = path.stat()
+        row = self.conn.execute(
+            "SELECT text FROM pdf_text WHERE path = ? AND mtime = ? AND size = ?", (str(path), stat.st_mtime, stat.st_size)
+        ).fetchone()
+        if row is not None:
+            return row[0]
+        digest = file_hash(path)
+        row = self.conn.execute("SELECT text FROM pdf_text WHERE file_hash = ?", (digest,)).fetchone()
+        if row is None:
+            return None
+        self._save(path, digest, row[0])
+        return row[0]
+
+    def put(self, path: Path, text: str):
+        self._save(path, file_hash(path), text)
+
+    def _save(self, path: Path, digest: str, text: str):
+        stat = path.stat()
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO pdf_text (path, mtime, size, file_hash, text) VALUES (?, ?, ?, ?, ?)",
+                (str(path), stat.st_mtime, stat.st_size, digest, text)
+            )
+
+    def close(self):
+        self.conn.close()
+
+
+def extract_texts(pdf_paths: Iterable[Path], cache_path: str, max_workers: Optional[int] = None, pages_per_task: int = 20) -> Dict[Path, str]:
+    """
+    Returns {path: text} for every PDF that could be read. Cached texts are reused, the others are parsed in a process pool.
+    Each PDF is split into tasks of 'pages_per_task' pages, so a long report is spread over several cores
+    just like many short papers are. Page texts are joined in page order once all tasks of a file are done.
+    Records the parse time (summed over the tasks of a file), the size and the page count of every PDF parsed.
+    """
+    cache = PdfTextCache(cache_path)
+    texts = {}
+    to_parse = []
+    try:
+        for path in map(Path, pdf_paths):
+            text = cache.get(path)
+            if text is None:
+                to_parse.append(path)
+            else:
+                texts[path] = text
+        logging.info(f"{len(texts)} PDF texts from cache, {len(to_parse)} to parse.")
+        if not to_parse:
+            return texts
+
+        with ProcessPoolExecutor(max_workers=max_workers or os.cpu_count()) as pool:
+            futures = {}
+            for path in to_parse:
+                try:
+                    page_count = len(PdfReader(path).pages)
+                except Exception as e:
+                    logging.warning(f"Failed to open {path.name}: {e}")
+                    continue
+                futures[path] = [
+                    pool.submit(_extract_pages, str(path), start, min(start + pages_per_task, page_count))
+                    for start in range(0, page_count, pages_per_task)
+                ]
+            for path, path_futures in futures.items():
+                try:
+                    results = [future.result() for future in path_futures]
+                except Exception as e:
+                    logging.warning(f"Failed to extract text from {path.name}: {e}")
+                    continue
+                text = "".join(page for pages, _ in results for page in pages)
+                METRICS.observe("pdf_parse_seconds", sum(seconds for _, seconds in results))
+                METRICS.observe("pdf_size_bytes", path.stat().st_size)
+                METRICS.observe("pdf_pages", sum(len(pages) for pages, _ in results))
+                cache.put(path, text)
+                texts[path] = text
+                logging.info(f"Extracted text from {path.name}")
+    finally:
+        cache.close()
+    return texts
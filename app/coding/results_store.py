@@ -0,0 +1,162 @@
+import csv
+import json
+import logging
+import time
+import typing
+from pathlib import Path
+from typing import Iterator, List, Optional, Sequence, Tuple
+from pydantic import BaseModel
+from app.coding.policy_models import PolicyAnalysis
+from app.instrumentation import sqlite_write
+from app.storage import add_columns, connect, upsert_rows
+
+TABLE = "policy_analysis"
+# eid: the paper(s) a fetched full text belongs to, ';'-separated (see fulltext.fulltext_eids), NULL for the PDFs placed by hand
+META_COLUMNS = [("filename", "TEXT"), ("model", "TEXT"), ("coded_at", "TEXT"), ("eid", "TEXT")]
+
+
+def sql_type(annotation) -> str:
+    """SQLite type of a pydantic field: BOOLEAN, INTEGER, REAL or TEXT (str, Literal, anything else)."""
+    args = [arg for arg in typing.get_args(annotation) if arg is not type(None)]
+    if typing.get_origin(annotation) is typing.Union and len(args) == 1:
+        annotation = args[0]
+    if annotation is bool:
+        return "BOOLEAN"
+    if annotation is int:
+        return "INTEGER"
+    if annotation is float:
+        return "REAL"
+    return "TEXT"
+
+
+def model_columns(output_type: type[BaseModel] = PolicyAnalysis) -> List[Tuple[str, str]]:
+    """(name, SQLite type) of every field of the coding output, in the order of the model."""
+    return [(name, sql_type(field.annotation)) for name, field in output_type.model_fields.items()]
+
+
+class ResultsStore:
+    """
+    Coding results in a typed table: one row per document, one column per PolicyAnalysis field.
+    The table follows the model: fields added to PolicyAnalysis become new columns the next time the store is opened.
+    Replaces the CSV with the JSON output in one column, which had to be re-read and expanded before any analysis.
+    """
+
+    def __init__(self, db_path: str, output_type: type[BaseModel] = PolicyAnalysis):
+        self.output_type = output_type
+        self.columns = META_COLUMNS + model_columns(output_type)
+        self.conn = connect(db_path)
+        with self.conn:
+            self.conn.execute(f"CREATE TABLE IF NOT EXISTS {TABLE} (filename TEXT PRIMARY KEY)")
+            add_columns(self.conn, TABLE, self.columns)
+
+    def save(self, filename: str, analysis: BaseModel, model: str = "", eid: Optional[str] = None):
+        """Writes (or overwrites) the result of one document in its own transaction."""
+        values = analysis.model_dump()
+        coded_at = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime())
+        row = [filename, model, coded_at, eid] + [values.get(name) for name, _ in self.columns[len(META_COLUMNS):]]
+        with sqlite_write("coding_result", 1), self.conn:
+            upsert_rows(self.conn, TABLE, [name for name, _ in self.columns], [row], key=("filename",))
+
+    def coded_filenames(self) -> set:
+        return {row[0] for row in self.conn.execute(f"SELECT filename FROM {TABLE}")}
+
+    def iter_batches(self, batch_size: int = 1000) -> Iterator[List[dict]]:
+        """The stored results, 'batch_size' rows at a time, with the booleans as True/False/None."""
+        names = [name for name, _ in self.columns]
+        booleans = [i for i, (_, col_type) in enumerate(self.columns) if col_type == "BOOLEAN"]
+        cursor = self.conn.execute(f"SELECT {', '.join(names)} FROM {TABLE} ORDER BY filename")
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                return
+            batch = []
+            for row in rows:
+                row = list(row)
+                for i in booleans:
+                    if row[i] is not None:
+                        row[i] = bool(row[i])
+                batch.append(dict(zip(names, row)))
+            yield batch
+
+    def close(self):
+        self.conn.close()
+
+
+def import_results_csv(csv_path: Path, store: ResultsStore) -> int:
+    """Loads a CSV written by the previous version of the coding script (filename, output as JSON) into the store."""
+    imported = 0
+    with open(csv_path, "r", newline="", encoding="utf-8") as f:
+        for row in csv.DictReader(f):
+            store.save(row["filename"], store.output_type.model_validate(json.loads(row["output"])))
+            imported += 1
+    logging.info(f"Imported {imported} coding results from {csv_path}")
+    return imported
+
+
+def export_csv(store: ResultsStore, out_path: Path, batch_size: int = 1000) -> int:
+    """Writes the results as a flat CSV, one column per field, streaming 'batch_size' rows at a time."""
+    written = 0
+    with open(out_path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.DictWriter(f, fieldnames=[name for name, _ in store.columns])
+        writer.writeheader()
+        for batch in store.iter_batches(batch_size):
+            writer.writerows(batch)
+            written += len(batch)
+    return written
+
+
+def _arrow_schema(columns: Sequence[Tuple[str, str]]):
+    import pyarrow as pa
+    types = {"BOOLEAN": pa.bool_(), "INTEGER": pa.int64(), "REAL": pa.float64(), "TEXT": pa.string()}
+    return pa.schema([(name, types[col_type]) for name, col_type in columns])
+
+
+def export_arrow(store: ResultsStore, out_path: Path, batch_size: int = 10_000) -> int:
+    """
+    Writes the results as Parquet (.parquet) or as an Arrow IPC file (.arrow / .feather), typed from the table,
+    one record batch of 'batch_size' rows at a time. Needs pyarrow (the 'export' extra).
+    """
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError as e:
+        raise ImportError("Parquet/Arrow export needs pyarrow: uv sync --extra export, or export to .csv") from e
+    schema = _arrow_schema(store.columns)
+    if Path(out_path).suffix == ".parquet":
+        writer = pq.ParquetWriter(str(out_path), schema)
+    else:
+        writer = pa.ipc.new_file(str(out_path), schema)
+    written = 0
+    try:
+        for batch in store.iter_batches(batch_size):
+            writer.write_batch(pa.RecordBatch.from_pylist(batch, schema=schema))
+            written += len(batch)
+    finally:
+        writer.close()
+    return written
+
+
+def export_results(db_path: str, out_path: Path, batch_size: int = 10_000) -> int:
+    """Exports the coding results to out_path, as CSV, Parquet or Arrow depending on its extension. Returns the number of rows."""
+    store = ResultsStore(db_path)
+    try:
+        if Path(out_path).suffix in (".parquet", ".arrow", ".feather"):
+            written = export_arrow(store, out_path, batch_size)
+        else:
+            written = export_csv(store, out_path, batch_size)
+    finally:
+        store.close()
+    logging.info(f"Exported {written} coding results to {out_path}")
+    return written
+
+
+if __name__ == "__main__":
+    db_path = Path(__file__).parent.parent / "coding_results.db"
+    legacy_csv = Path(__file__).parent / "policy_analysis_results.csv" # results of the previous version, imported once if present
+    out_path = Path(__file__).parent / "policy_analysis_results_expanded.csv" # or .parquet / .arrow (needs pyarrow)
+
+    store = ResultsStore(db_path)
+    if legacy_csv.exists() and not store.coded_filenames():
+        import_results_csv(legacy_csv, store)
+    store.close()
+    export_results(db_path, out_path)
@@ -0,0 +1,76 @@
+import asyncio
+import logging
+from pathlib import Path
+from typing import Dict, Optional
+from pydantic_ai import Agent
+from app.coding.chunking import code_text_async
+from app.coding.policy_models import PolicyAnalysis
+from app.coding.evidence import index_passages, select_passages
+from app.coding.results_store import ResultsStore
+from app.embedding_index import EmbeddingIndex
+from app.llm_cache import agent_model_name
+from app.run_metrics import RunMetrics
+
+# Fields compared between the small and the large model of a cascade (see app.cascade): the codes, not the free text
+CASCADE_AGREEMENT_FIELDS = ["implementation_performance"] + [
+    name for name, field in PolicyAnalysis.model_fields.items() if field.annotation == Optional[bool]
+]
+CODING_INSTRUCTIONS = (
+    "You are a policy analyst. You are analysing a policy text and will categorise the policies according to the received output_type. Classify the policy text and return the output in the specified format."
+)
+
+
+def build_coding_agent(instructions: str = CODING_INSTRUCTIONS, model: str = "openai:gpt-4.1") -> Agent:
+    """The policy coding agent. Build it once and share it between all documents."""
+    return Agent(
+        model=model,
+        output_type=PolicyAnalysis,
+        instructions=instructions,
+    )
+
+
+async def code_documents_async(agent, texts: Dict[Path, str], store: ResultsStore, concurrency: int = 4, recode_all: bool = False,
+                               max_tokens: Optional[int] = None, overlap: int = 400, metrics: Optional[RunMetrics] = None,
+                               passage_index: Optional[EmbeddingIndex] = None, top_k: int = 3, eids: Optional[Dict[str, str]] = None) -> int:
+    """
+    Codes the documents with up to 'concurrency' agent.run calls in flight.
+    With max_tokens set, long documents are coded section by section and merged, see code_text_async.
+    With a passage_index, each document is embedded passage by passage and only the top_k passages closest to
+    each code are sent to the model instead of the whole text, see evidence.select_passages. The embedding runs in a
+    worker thread, one document at a time, so the event loop (and the other stages of thesis-pipeline) keeps going.
+    Each result is written to the store as soon as it completes, so a failure only loses the documents still in flight.
+    Documents that already have a result in the store are skipped, so a rerun continues where the last one stopped.
+    'eids' maps file names to the EID(s) stored with their result (see fulltext.fulltext_eids).
+    With recode_all=True every document is coded and its previous result overwritten.
+    Returns the number of documents coded.
+    """
+    done = set() if recode_all else store.coded_filenames()
+    pending = {path: text for path, text in texts.items() if path.name not in done}
+    logging.info(f"{len(done)} documents already coded, {len(pending)} to code.")
+    semaphore = asyncio.Semaphore(concurrency)
+    model_name = agent_model_name(agent)
+    index_lock = asyncio.Lock()
+    coded = 0
+
+    def passages(filename: str, text: str) -> str:
+        index_passages(passage_index, filename, text)
+        return select_passages(passage_index, filename, top_k)
+
+    async def code(path: Path, text: str):
+        nonlocal coded
+        logging.info(f"Processing file: {path.name}")
+        try:
+            if passage_index is not None:
+                async with index_lock:
+                    text = await asyncio.to_thread(passages, path.name, text)
+            analysis = await code_text_async(agent, text, semaphore, max_tokens, overlap, path.name, metrics)
+        except Exception as e:
+            logging.warning(f"Coding failed for {path.name}: {e}")
+            return
+        # Written from the event loop thread, one row at a time
+        store.save(path.name, analysis, model_name, (eids or {}).get(path.name))
+        coded += 1
+        logging.info(f"Processed file: {path.name}")
+
+    await asyncio.gather(*(code(path, text) for path, text in pending.items()))
+    return coded
@@ -0,0 +1,239 @@
+import hashlib
+import logging
+import zlib
+from pathlib import Path
+from typing import Iterable, List, Optional, Sequence, Tuple
+import numpy as np
+from app.extract_papers.prescreen import tokenize
+from app.storage import connect
+
+
+class HashingEmbedder:
+    """
+    Embeds texts without any model: the words and bigrams of the text (see prescreen.tokenize) are hashed into 'dim'
+    signed buckets, and the vector is normalised to unit length. Close to TF-IDF cosine similarity, instant and offline.
+    """
+
+    def __init__(self, dim: int = 1024):
+        self.dim = dim
+        self.name = f"hashing-{dim}"
+
+    def embed(self, texts: Sequence[str]) -> np.ndarray:
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for i, text in enumerate(texts):
+            for token in tokenize(text):
+                h = zlib.crc32(token.encode("utf-8"))
+                vectors[i, h % self.dim] += 1.0 if h & 0x80000000 else -1.0
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1
+        return vectors / norms
+
+
+class SentenceTransformerEmbedder:
+    """CPU sentence-embedding model (sentence-transformers, optional). all-MiniLM-L6-v2 gives 384 dimensions."""
+
+    def __init__(self, model_name: str = "all-MiniLM-L6-v2"):
+        from sentence_transformers import SentenceTransformer
+        self.model = SentenceTransformer(model_name, device="cpu")
+        self.dim = self.model.get_sentence_embedding_dimension()
+        self.name = model_name
+
+    def embed(self, texts: Sequence[str]) -> np.ndarray:
+        return self.model.encode(list(texts), batch_size=64, normalize_embeddings=True, convert_to_numpy=True).astype(np.float32)
+
+
+def default_embedder(model_name: Optional[str] = "all-MiniLM-L6-v2"):
+    """The sentence-transformers model if the package is installed, HashingEmbedder otherwise (or with model_name=None)."""
+    if model_name is not None:
+        try:
+            return SentenceTransformerEmbedder(model_name)
+        except ImportError:
+            logging.info("sentence-transformers is not installed, embedding with HashingEmbedder.")
+    return HashingEmbedder()
+
+
+def _text_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()[:16]
+
+
+class EmbeddingIndex:
+    """
+    Unit-length embeddings of items (paper abstracts, passages of full texts...) for cosine top-k search.
+    The vectors are a float32 matrix in a raw file next to the SQLite database (<db>.<name>.f32), read as a numpy memmap,
+    so the index does not have to fit in memory. Which item each row holds is in the embedding_items table of the database.
+    add() is incremental: new items are appended, changed texts are re-embedded in place, the others are skipped.
+    The index can be used from a worker thread (asyncio.to_thread), one thread at a time.
+    """
+
+    def __init__(self, db_path: str, name: str, embedder=None, block: int = 65_536):
+        self.db_path = db_path
+        self.name = name
+        self.embedder = embedder or default_embedder()
+        self.block = block
+        self.matrix_path = Path(f"{Path(db_path).with_suffix('')}.{name}.f32")
+        self.conn = connect(db_path, check_same_thread=False)
+        with self.conn:
+            self.conn.execute('''
+                CREATE TABLE IF NOT EXISTS embedding_indexes (
+                    name TEXT PRIMARY KEY,
+                    embedder TEXT,
+                    dim INTEGER)
+            ''')
+            self.conn.execute('''
+                CREATE TABLE IF NOT EXISTS embedding_items (
+                    index_name TEXT,
+                    item_id TEXT,
+                    row INTEGER,
+                    text_hash TEXT,
+                    text TEXT,
+                    PRIMARY KEY (index_name, item_id))
+            ''')
+            self.conn.execute("CREATE INDEX IF NOT EXISTS idx_embedding_items_row ON embedding_items (index_name, row)")
+            self.conn.execute("INSERT OR IGNORE INTO embedding_indexes (name, embedder, dim) VALUES (?, ?, ?)",
+                              (name, self.embedder.name, self.embedder.dim))
+        embedder_name, dim = self.conn.execute("SELECT embedder, dim FROM embedding_indexes WHERE name = ?", (name,)).fetchone()
+        if embedder_name != self.embedder.name or dim != self.embedder.dim:
+            raise Exception(f"Index {name} was built with {embedder_name} ({dim} dimensions), not {self.embedder.name}. "
+                            f"Delete {self.matrix_path} and its embedding_items rows to rebuild it.")
+        self.dim = dim
+        self._matrix = None
+
+    def __len__(self) -> int:
+        return self.conn.execute("SELECT COUNT(*) FROM embedding_items WHERE index_name = ?", (self.name,)).fetchone()[0]
+
+    def _rows(self) -> int:
+        return self.matrix_path.stat().st_size // (4 * self.dim) if self.matrix_path.exists() else 0
+
+    def matrix(self) -> np.ndarray:
+        rows = self._rows()
+        if self._matrix is None or self._matrix.shape[0] != rows:
+            self._matrix = np.memmap(self.matrix_path, dtype=np.float32, mode="r", shape=(rows, self.dim)) if rows else \
+                np.zeros((0, self.dim), dtype=np.float32)
+        return self._matrix
+
+    def add(self, items: Iterable[Tuple[str, str]], keep_text: bool = False, batch_size: int = 256) -> int:
+        """
+        Embeds the (item_id, text) items that are new or whose text changed. With keep_text, the text is stored too
+        (for passages, which are not kept anywhere else). Returns the number of items embedded.
+        """
+        known = {item_id: (row, text_hash) for item_id, row, text_hash in self.conn.execute(
+            "SELECT item_id, row, text_hash FROM embedding_items WHERE index_name = ?", (self.name,))}
+        todo = [(item_id, text, _text_hash(text)) for item_id, text in items
+                if item_id not in known or known[item_id][1] != _text_hash(text)]
+        added = 0
+        for start in range(0, len(todo), batch_size):
+            batch = todo[start:start + batch_size]
+            vectors = self.embedder.embed([text for _, text, _ in batch]).astype(np.float32)
+            next_row = self._rows()
+            rows = []
+            with open(self.matrix_path, "ab") as f:
+                for (item_id, _, _), vector in zip(batch, vectors):
+                    if item_id in known:
+                        rows.append(known[item_id][0])
+                    else:
+                        f.write(vector.tobytes())
+                        rows.append(next_row)
+                        next_row += 1
+            updated = [(row, vector) for (item_id, _, _), row, vector in zip(batch, rows, vectors) if item_id in known]
+            if updated:
+                matrix = np.memmap(self.matrix_path, dtype=np.float32, mode="r+", shape=(next_row, self.dim))
+                for row, vector in updated:
+                    matrix[row] = vector
+                matrix.flush()
+                del matrix
+            with self.conn:
+                self.conn.executemany(
+                    "INSERT OR REPLACE INTO embedding_items (index_name, item_id, row, text_hash, text) VALUES (?, ?, ?, ?, ?)",
+                    [(self.name, item_id, row, text_hash, text if keep_text else None)
+                     for (item_id, text, text_hash), row in zip(batch, rows)]
+                )
+            added += len(batch)
+        self._matrix = None
+        return added
+
+    def _top_k(self, query: np.ndarray, k: int, rows: Optional[np.ndarray] = None) -> List[Tuple[int, float]]:
+        matrix = self.matrix()
+        if rows is not None:
+            row_ids = np.sort(rows)
+            scores = matrix[row_ids] @ query
+        else:
+            # Block by block, so only 'block' rows of the memmap are in memory at a time
+            scores = np.concatenate([matrix[start:start + self.block] @ query for start in range(0, matrix.shape[0], self.block)]) \
+                if matrix.shape[0] else np.zeros(0, dtype=np.float32)
+            row_ids = np.arange(len(scores))
+        k = min(k, len(scores))
+        if k == 0:
+            return []
+        best = np.argpartition(-scores, k - 1)[:k]
+        best = best[np.argsort(-scores[best])]
+        return [(int(row_ids[i]), float(scores[i])) for i in best]
+
+    def _ids(self, rows: List[int]) -> dict:
+        if not rows:
+            return {}
+        placeholders = ", ".join("?" for _ in rows)
+        return dict(self.conn.execute(
+            f"SELECT row, item_id FROM embedding_items WHERE index_name = ? AND row IN ({placeholders})", [self.name] + rows))
+
+    def search(self, text: str, k: int = 10, item_prefix: Optional[str] = None) -> List[Tuple[str, float]]:
+        """
+        The k items most similar to 'text', as (item_id, cosine similarity), best first.
+        With item_prefix, only items whose id starts with it are searched (e.g. the passages of one document).
+        """
+        rows = None
+        if item_prefix is not None:
+            rows = np.array([row for (row,) in self.conn.execute(
+                "SELECT row FROM embedding_items WHERE index_name = ? AND substr(item_id, 1, ?) = ?",
+                (self.name, len(item_prefix), item_prefix))], dtype=np.int64)
+        best = self._top_k(self.embedder.embed([text])[0], k, rows)
+        ids = self._ids([row for row, _ in best])
+        return [(ids[row], score) for row, score in best if row in ids]
+
+    def similar(self, item_id: str, k: int = 10) -> List[Tuple[str, float]]:
+        """The k items most similar to an item of the index (itself excluded)."""
+        row = self.conn.execute("SELECT row FROM embedding_items WHERE index_name = ? AND item_id = ?", (self.name, item_id)).fetchone()
+        if row is None:
+            raise Exception(f"{item_id} is not in the {self.name} index")
+        best = self._top_k(np.array(self.matrix()[row[0]]), k + 1)
+        ids = self._ids([r for r, _ in best])
+        return [(ids[r], score) for r, score in best if r in ids and ids[r] != item_id][:k]
+
+    def texts(self, item_ids: Sequence[str]) -> dict:
+        if not item_ids:
+            return {}
+        placeholders = ", ".join("?" for _ in item_ids)
+        return dict(self.conn.execute(
+            f"SELECT item_id, text FROM embedding_items WHERE index_name = ? AND item_id IN ({placeholders})",
+            [self.name] + list(item_ids)))
+
+    def close(self):
+        self._matrix = None
+        self.conn.close()
+
+
+def index_abstracts(db_path: str, embedder=None) -> int:
+    """Adds the title + abstract of the papers not indexed yet (or whose abstract changed) to the 'abstracts' index."""
+    index = EmbeddingIndex(db_path, "abstracts", embedder)
+    try:
+        rows = index.conn.execute("SELECT eid, title, abstract FROM papers WHERE abstract IS NOT NULL AND abstract != ''").fetchall()
+        added = index.add((eid, f"{title or ''}\n{abstract}") for eid, title, abstract in rows)
+    finally:
+        index.close()
+    logging.info(f"Embedded {added} abstracts.")
+    return added
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    db_path = Path(__file__).parent / "scopus_results_2.db"
+    query = "barriers to policy implementation at the local level" # free text, or set similar_to to an EID
+    similar_to = None
+    k = 10
+
+    index_abstracts(str(db_path))
+    index = EmbeddingIndex(str(db_path), "abstracts")
+    results = index.similar(similar_to, k) if similar_to else index.search(query, k)
+    for eid, score in results:
+        title = index.conn.execute("SELECT title FROM papers WHERE eid = ?", (eid,)).fetchone()[0]
+        print(f"{score:.3f}  {eid}  {title}")
+    index.close()
@@ -0,0 +1,169 @@
+import logging
+import random
+from typing import List, Optional, Tuple
+import numpy as np
+from scipy import sparse
+from scipy.optimize import minimize
+from app.extract_papers.prescreen import Tfidf
+from app.extract_papers.screening_engine import get_papers_to_screen, screen_papers_async
+from app.llm_cache import agent_model_name
+from app.run_metrics import RunMetrics
+from app.storage import open_db
+
+
+def train_logistic_regression(matrix: sparse.csr_matrix, labels: np.ndarray, weights: np.ndarray, l2: float = 1.0) -> Tuple[np.ndarray, float]:
+    """
+    L2-regularised logistic regression fitted with L-BFGS. 'weights' weigh each paper's loss,
+    so decisions the model was more confident about count more. Returns (coefficients, intercept).
+    The classes are balanced, so the probabilities assume a 50/50 prior: see calibrated_intercept.
+    """
+    n_features = matrix.shape[1]
+    # Positives are rare in screening: balance the two classes so the classifier doesn't just predict "exclude"
+    positive_share = labels.mean() if len(labels) else 0.5
+    class_weights = np.where(labels == 1, 0.5 / max(positive_share, 1e-6), 0.5 / max(1 - positive_share, 1e-6))
+    weights = weights * class_weights
+
+    def loss_and_gradient(params: np.ndarray):
+        coef, intercept = params[:-1], params[-1]
+        z = matrix @ coef + intercept
+        p = 1 / (1 + np.exp(-z))
+        # log(1 + exp(z)) - y*z, written to stay finite for large |z|
+        loss = np.sum(weights * (np.logaddexp(0, z) - labels * z)) + 0.5 * l2 * coef @ coef
+        error = weights * (p - labels)
+        gradient = np.append(matrix.T @ error + l2 * coef, error.sum())
+        return loss, gradient
+
+    result = minimize(loss_and_gradient, np.zeros(n_features + 1), jac=True, method="L-BFGS-B")
+    return result.x[:-1], result.x[-1]
+
+
+def calibrated_intercept(intercept: float, labels: np.ndarray) -> float:
+    """
+    Intercept of the balanced model moved back to the share of included papers in the training labels,
+    so the probabilities estimate how many included papers are left (and not half of the corpus).
+    """
+    positive_share = min(max(labels.mean(), 1e-6), 1 - 1e-6)
+    return intercept + np.log(positive_share / (1 - positive_share))
+
+
+def predict(matrix: sparse.csr_matrix, coef: np.ndarray, intercept: float) -> np.ndarray:
+    return 1 / (1 + np.exp(-(matrix @ coef + intercept)))
+
+
+def _decided(db_path: str, eids: List[str], prompt_hash: Optional[str], model_name: str) -> set:
+    """The EIDs that have a decision for this prompt and model, to tell the screened papers from the failed calls."""
+    if not eids:
+        return set()
+    conn = open_db(db_path)
+    try:
+        return {row[0] for row in conn.execute(
+            f"SELECT eid FROM papers WHERE eid IN ({', '.join('?' for _ in eids)}) AND to_be_reviewed IS NOT NULL "
+            "AND screening_prompt_hash IS ? AND screening_model IS ?", list(eids) + [prompt_hash, model_name])}
+    finally:
+        conn.close()
+
+
+async def active_learning_screen_async(db_path: str, agent, prompt_hash: Optional[str] = None, initial_sample: int = 200,
+                                       batch_size: int = 100, target_recall: float = 0.95, max_rounds: int = 100,
+                                       concurrency: int = 10, metrics: Optional[RunMetrics] = None, seed: int = 0) -> int:
+    """
+    Screens only part of the corpus with the model:
+    1. a random sample of 'initial_sample' papers is screened by the model, then random batches of 'batch_size'
+       until the decisions hold both an included and an excluded paper,
+    2. a logistic regression on TF-IDF (title + abstract) is trained on all the model's decisions so far,
+       weighted by their confidence_level, and ranks the papers not screened yet,
+    3. the next 'batch_size' papers are sent to the model: half the highest ranked, half the most uncertain,
+    4. back to 2 until the estimated recall reaches target_recall.
+    The estimated recall is the number of included papers found, divided by that number plus the sum of the
+    classifier's calibrated probabilities over the papers not screened. Papers whose call failed go back to the
+    papers not screened. Papers never sent to the model keep a NULL decision and get the classifier's calibrated
+    probability in classifier_score. Returns the number of papers screened by the model.
+    """
+    model_name = agent_model_name(agent)
+    rng = random.Random(seed)
+    conn = open_db(db_path)
+    try:
+        rows = conn.execute("SELECT eid, title, abstract FROM papers WHERE abstract IS NOT NULL AND duplicate_of IS NULL").fetchall()
+    finally:
+        conn.close()
+    if not rows:
+        return 0
+    index = {row[0]: i for i, row in enumerate(rows)}
+    matrix = Tfidf().fit_transform([f"{row[1] or ''}\n{row[2] or ''}" for row in rows])
+
+    pending = {paper.eid: paper for paper in get_papers_to_screen(db_path, prompt_hash, model_name)}
+
+    async def screen(eids: List[str]) -> int:
+        batch = [pending.pop(eid) for eid in eids]
+        count = await screen_papers_async(db_path, agent, batch, prompt_hash, concurrency=concurrency, metrics=metrics)
+        decided = _decided(db_path, eids, prompt_hash, model_name)
+        for paper in batch:
+            if paper.eid not in decided:
+                pending[paper.eid] = paper
+        return count
+
+    def labelled() -> Tuple[list, np.ndarray]:
+        conn = open_db(db_path)
+        try:
+            decisions = conn.execute('''
+                SELECT eid, to_be_reviewed, confidence_level FROM papers
+                WHERE to_be_reviewed IS NOT NULL AND abstract IS NOT NULL AND duplicate_of IS NULL
+            ''').fetchall()
+        finally:
+            conn.close()
+        decisions = [d for d in decisions if d[0] in index and d[0] not in pending]
+        return decisions, np.array([int(d[1]) for d in decisions], dtype=np.float64)
+
+    screened = await screen(rng.sample(sorted(pending), min(initial_sample, len(pending))))
+    decisions, labels = labelled()
+    # At low prevalence the sample may hold no included paper: keep screening random batches until there is one to learn from
+    while pending and len(set(labels)) < 2:
+        logging.info(f"No {'excluded' if labels.any() else 'included'} paper to learn from yet, screening {batch_size} more at random.")
+        screened_now = await screen(rng.sample(sorted(pending), min(batch_size, len(pending))))
+        if screened_now == 0:
+            logging.warning("No paper of the random batch could be screened, stopping.")
+            break
+        screened += screened_now
+        decisions, labels = labelled()
+    coef = intercept = intercept_calibrated = None
+
+    for round_number in range(1, max_rounds + 1):
+        if round_number > 1:
+            decisions, labels = labelled()
+        if not pending or len(set(labels)) < 2:
+            logging.info("Nothing left to screen.")
+            break
+
+        weights = np.array([d[2] if d[2] is not None else 1.0 for d in decisions], dtype=np.float64)
+        coef, intercept = train_logistic_regression(matrix[[index[d[0]] for d in decisions]], labels, weights)
+        intercept_calibrated = calibrated_intercept(intercept, labels)
+        pending_eids = list(pending)
+        pending_matrix = matrix[[index[eid] for eid in pending_eids]]
+        probabilities = predict(pending_matrix, coef, intercept)
+
+        found = labels.sum()
+        expected_left = predict(pending_matrix, coef, intercept_calibrated).sum()
+        estimated_recall = found / (found + expected_left) if found else 0.0
+        logging.info(f"Round {round_number}: {int(found)} included papers found, estimated recall {estimated_recall:.3f}, "
+                     f"{len(pending_eids)} papers not screened.")
+        if estimated_recall >= target_recall:
+            break
+
+        by_rank = np.argsort(-probabilities)
+        by_uncertainty = np.argsort(np.abs(probabilities - 0.5))
+        chosen = list(dict.fromkeys(list(by_rank[:batch_size // 2]) + list(by_uncertainty[:batch_size])))[:batch_size]
+        screened += await screen([pending_eids[i] for i in chosen])
+
+    if pending:
+        pending_eids = list(pending)
+        if coef is not None:
+            probabilities = predict(matrix[[index[eid] for eid in pending_eids]], coef, intercept_calibrated)
+            conn = open_db(db_path)
+            try:
+                with conn:
+                    conn.executemany("UPDATE papers SET classifier_score = ? WHERE eid = ?",
+                                     [(float(p), eid) for p, eid in zip(probabilities, pending_eids)])
+            finally:
+                conn.close()
+        logging.info(f"{len(pending)} papers were not sent to the model.")
+    return screened
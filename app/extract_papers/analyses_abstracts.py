@@ -1,12 +1,20 @@
+import asyncio
 import logging
-from typing import Dict, List, Optional
+from typing import Optional
 import nest_asyncio
-from pydantic import BaseModel, Field
-from pydantic_ai import Agent, RunContext
-from pydantic_ai.exceptions import ModelRetry
-import sqlite3
-import time
+from pydantic_ai import Agent
 from pathlib import Path
+from app.extract_papers.screening_models import ResponseModel
+from app.extract_papers.screening_engine import prompt_hash, screen_papers_async
+from app.extract_papers.batch_screening import OpenAIBatchProvider, run_batch_screening
+from app.llm_cache import CachedAgent, ResponseCache
+from app.cascade import CascadeAgent, escalate_when
+from app.instrumentation import save_at_exit
+from app.run_metrics import RunMetrics
+from app.extract_papers.corpus import merge_db, prefill_from_master
+from app.extract_papers.prescreen import prescreen
+from app.extract_papers.active_learning import active_learning_screen_async
+from app.storage import init_db
 
 nest_asyncio.apply()  # for running with interactive python
 # Set up logging
@@ -14,68 +22,45 @@ logging.basicConfig(
     level=logging.INFO)
 
 
-class ResponseModel(BaseModel):
-    """Structured response with metadata."""
-
-    should_be_included: bool = Field(
-        description="Indicates if the paper should be included in the review",
-    )
-    confidence_level: float = Field(
-        description="Confidence level in the decision wether to include the paper in the review", ge=0, le=1
-    )
-    summary: str = Field(
-        description="Brief summary of the analysis decision",
-        max_length=500,
-    )
-
-
-# Define order schema
-class Paper(BaseModel):
-    """Structure for each paper to be screened."""
-
-    eid: str
-    title: str
-    abstract: str
-
-
-# Function to retrieve papers from the SQLite database
 def ensure_columns_exist(db_path: str):
-    conn = sqlite3.connect(db_path)
-    c = conn.cursor()
-    c.execute("PRAGMA table_info(papers)")
-    columns = [col[1] for col in c.fetchall()]
-    if "to_be_reviewed" not in columns:
-        c.execute("ALTER TABLE papers ADD COLUMN to_be_reviewed BOOLEAN")
-    if "confidence_level" not in columns:
-        c.execute("ALTER TABLE papers ADD COLUMN confidence_level REAL")
-    if "analysis_summary" not in columns:
-        c.execute("ALTER TABLE papers ADD COLUMN analysis_summary TEXT")
-    conn.commit()
-    conn.close()
+    """Makes sure the papers table has the screening columns (schema migrations, see app.storage)."""
+    init_db(db_path)
+
+
+def build_agent(instructions_text: str, model: str = "openai:gpt-4.1") -> Agent:
+    """
+    Agent with structured output.
+    Only the static instructions are in the system prompt, the paper is sent in the user prompt
+    (see screening_user_prompt) so that all requests share a prefix the provider can cache.
+    """
+    return Agent(
+        model=model,
+        output_type=ResponseModel,
+        retries=3,
+        instructions=instructions_text,
+    )
 
 
-def process_and_update_papers(db_path: str, agent):
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-    cursor2 = conn.cursor()
-    cursor.execute("SELECT eid, title, abstract FROM papers")
-    total = 0
-    for eid, title, abstract in cursor:
-        paper = Paper(eid=eid, title=title, abstract=abstract)
-        logging.info(f"Processing paper: {title}")
-        response = agent.run_sync(user_prompt="Retrieve the structured output", deps=paper)
-        result = response.output
-        # Store as bool (True/False)
-        cursor2.execute(
-            "UPDATE papers SET to_be_reviewed=?, confidence_level=?, analysis_summary=? WHERE eid=?",
-            (bool(result.should_be_analysed), float(result.confidence_level), result.summary, eid)
-        )
-        conn.commit()
-        total += 1
-        logging.info(f"Processed {total} papers")
-        time.sleep(0.2)
-    conn.close()
-    print(f"Processed and updated {total} papers.")    
+def process_and_update_papers(db_path: str, agent, instructions_text: str, rescreen_all: bool = False, concurrency: int = 10,
+                              requests_per_minute: int = 500, tokens_per_minute: int = 200_000, metrics: Optional[RunMetrics] = None,
+                              min_prescreen_score: Optional[float] = None) -> int:
+    """
+    Screens the papers that have no decision for the current instructions and model yet, and stores the decision in the papers table.
+    Changing screening_promt.txt or the model makes the older decisions outdated, so they are screened again.
+    Set rescreen_all to screen every paper regardless.
+    Runs up to 'concurrency' model calls at the same time, see screen_papers_async.
+    With 'metrics', the usage of each call is recorded and a summary is logged at the end.
+    With min_prescreen_score, papers the local prescreen scored below it are not sent to the model (see prescreen.prescreen).
+    Returns the number of papers updated.
+    """
+    total = asyncio.run(screen_papers_async(db_path, agent, prompt_hash=prompt_hash(instructions_text), rescreen_all=rescreen_all,
+                                            concurrency=concurrency, requests_per_minute=requests_per_minute,
+                                            tokens_per_minute=tokens_per_minute, metrics=metrics,
+                                            min_prescreen_score=min_prescreen_score))
+    print(f"Processed and updated {total} papers.")
+    if metrics is not None:
+        metrics.log_summary()
+    return total
 
 # def get_papers_from_db(db_path: str, limit: int = 5):
 #     conn = sqlite3.connect(db_path)
@@ -92,28 +77,56 @@ if __name__ == "__main__":
 
     # Config:
     instruction_file = Path(__file__).parent.parent.parent / "resources" / "screening_promt.txt"
-    db_dir = str(Path(__file__).parent.parent)
-    db_path = db_dir + "\\scopus_results_2.db"
+    db_path = Path(__file__).parent.parent / "scopus_results_2.db"
+    concurrency = 10 # number of papers screened at the same time
+    rescreen_all = False # True to screen again papers that already have a decision for this prompt and model
+    cache_path = Path(__file__).parent.parent / "llm_cache.db" # responses shared with the policy coding
+    use_batch = False # True to screen through the OpenAI Batch API (cheaper, results within 24h)
+    batch_dir = Path(__file__).parent.parent / "batches" # where the batch request/result files are kept
+    metrics_path = Path(__file__).parent.parent / "run_metrics.db" # tokens, cache hits and latency of every call
+    master_db_path = Path(__file__).parent.parent / "master_corpus.db" # decisions already made for other queries
+    use_prescreen = True # score the papers locally (TF-IDF) and drop near-duplicates before calling the model
+    min_prescreen_score = None # papers scoring below this are not sent to the model. Check the logged percentiles to tune it
+    use_active_learning = False # True to send only the papers a local classifier is unsure about or ranks high to the model
+    target_recall = 0.95 # active learning stops once the estimated share of included papers found reaches this
+    use_cascade = False # True to ask cheap_model first and re-run only the uncertain papers on gpt-4.1
+    cheap_model = "openai:gpt-4.1-nano"
+    escalate_below = 0.8 # answers of cheap_model with a confidence_level below this go to gpt-4.1
+    escalate_values = {"should_be_included": [True]} # answers with these values go to gpt-4.1 too (every inclusion is confirmed)
+    save_at_exit(metrics_path) # timings, sizes, retries, tokens and cost of the run, see app.instrumentation
 
 
     with open(instruction_file, "r", encoding="utf-8") as file:
         instructions_text = file.read()
 
-    # Agent with structured output and dependencies
-    agent = Agent(
-        model="openai:gpt-4.1",
-        output_type=ResponseModel,
-        deps_type=Paper,
-        retries=3,
-        message_history=None,
-        instructions=instructions_text,
-    )
-
-
-    # Add dynamic system prompt based on dependencies
-    @agent.system_prompt
-    async def analyse_paper(ctx: RunContext[Paper]) -> str:
-        return f"Paper: {ctx.deps}"
-
     ensure_columns_exist(db_path)
-    process_and_update_papers(db_path, agent)
\ No newline at end of file
+    # Papers already screened for another query get that decision instead of a new model call
+    prefill_from_master(db_path, master_db_path)
+    if use_prescreen:
+        prescreen(db_path, instructions_text)
+    if use_batch:
+        total = run_batch_screening(db_path, OpenAIBatchProvider(), instructions_text, batch_dir, rescreen_all=rescreen_all,
+                                    min_prescreen_score=min_prescreen_score)
+        print(f"Processed and updated {total} papers.")
+    else:
+        # Identical prompts (e.g. with rescreen_all) are answered from the cache instead of the model
+        cache = ResponseCache(cache_path)
+        agent = CachedAgent(build_agent(instructions_text), cache, instructions_text)
+        if use_cascade:
+            # Both answers are kept in the cascade_decisions table of the metrics DB
+            cheap_agent = CachedAgent(build_agent(instructions_text, cheap_model), cache, instructions_text)
+            agent = CascadeAgent(cheap_agent, agent, escalate_when(escalate_below, escalate_values), ["should_be_included"])
+        metrics = RunMetrics(metrics_path, "screening")
+        if use_active_learning:
+            total = asyncio.run(active_learning_screen_async(db_path, agent, prompt_hash(instructions_text), target_recall=target_recall,
+                                                             concurrency=concurrency, metrics=metrics))
+            print(f"Processed and updated {total} papers.")
+            metrics.log_summary()
+        else:
+            process_and_update_papers(db_path, agent, instructions_text, rescreen_all, concurrency, metrics=metrics,
+                                      min_prescreen_score=min_prescreen_score)
+        logging.info(f"LLM cache: {cache.stats()}")
+        metrics.close()
+        cache.close()
+    # The decisions go to the master corpus, so the papers other queries find again are not screened twice
+    merge_db(master_db_path, db_path)
\ No newline at end of file
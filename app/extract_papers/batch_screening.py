@@ -0,0 +1,244 @@
+import json
+import logging
+import time
+from abc import ABC, abstractmethod
+from pathlib import Path
+from typing import Callable, Iterable, Iterator, Optional, Tuple
+from openai import OpenAI
+from pydantic import ValidationError
+from app.extract_papers.screening_models import Paper, ResponseModel
+from app.extract_papers.screening_engine import UPDATE_SCREENING_SQL, get_papers_to_screen, prompt_hash, screening_user_prompt
+from app.instrumentation import sqlite_write
+from app.storage import connect, open_db
+
+FINISHED_STATUSES = {"completed", "failed", "expired", "cancelled"}
+
+
+class BatchProvider(ABC):
+    """
+    Interface of a batch API: takes a JSONL file of requests, returns a JSONL file of responses.
+    See https://platform.openai.com/docs/guides/batch for the format of both files.
+    """
+
+    @abstractmethod
+    def submit(self, requests_path: Path) -> str:
+        """Uploads the requests and starts the batch. Returns the batch id."""
+
+    @abstractmethod
+    def status(self, batch_id: str) -> str:
+        """One of validating, in_progress, finalizing, completed, failed, expired, cancelled."""
+
+    @abstractmethod
+    def download(self, batch_id: str, results_path: Path):
+        """Writes the responses of a completed batch to results_path."""
+
+
+class OpenAIBatchProvider(BatchProvider):
+    """Runs the batch on the OpenAI Batch API (half the price of synchronous calls, results within 24h)."""
+
+    def __init__(self, client: OpenAI | None = None):
+        self.client = client or OpenAI()
+
+    def submit(self, requests_path: Path) -> str:
+        with open(requests_path, "rb") as f:
+            input_file = self.client.files.create(file=f, purpose="batch")
+        batch = self.client.batches.create(
+            input_file_id=input_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h",
+        )
+        return batch.id
+
+    def status(self, batch_id: str) -> str:
+        return self.client.batches.retrieve(batch_id).status
+
+    def download(self, batch_id: str, results_path: Path):
+        batch = self.client.batches.retrieve(batch_id)
+        if batch.output_file_id is None:
+            raise Exception(f"Batch {batch_id} has no output file (status {batch.status}).")
+        results_path.write_bytes(self.client.files.content(batch.output_file_id).content)
+
+
+class LocalBatchProvider(BatchProvider):
+    """
+    Stand-in provider that answers a batch locally, for running the batch flow without the API.
+    'respond' receives the body of each request and returns the content of the assistant message (a JSON string).
+    """
+
+    def __init__(self, work_dir: Path, respond: Callable[[dict], str]):
+        self.work_dir = Path(work_dir)
+        self.respond = respond
+
+    def submit(self, requests_path: Path) -> str:
+        batch_id = f"local_{requests_path.stem}"
+        with open(requests_path, "r", encoding="utf-8") as infile, \
+                open(self.work_dir / f"{batch_id}_output.jsonl", "w", encoding="utf-8") as outfile:
+            for line in infile:
+                request = json.loads(line)
+                content = self.respond(request["body"])
+                outfile.write(json.dumps({
+                    "custom_id": request["custom_id"],
+                    "response": {"status_code": 200, "body": {"choices": [{"message": {"content": content}}]}},
+                    "error": None,
+                }) + "\n")
+        return batch_id
+
+    def status(self, batch_id: str) -> str:
+        return "completed" if (self.work_dir / f"{batch_id}_output.jsonl").exists() else "failed"
+
+    def download(self, batch_id: str, results_path: Path):
+        results_path.write_bytes((self.work_dir / f"{batch_id}_output.jsonl").read_bytes())
+
+
+def batch_request(paper: Paper, instructions_text: str, model: str) -> dict:
+    """
+    One line of the batch file. The messages mirror what the screening agent sends:
+    the static instructions first, then the user prompt with the paper, with ResponseModel as the output schema.
+    """
+    return {
+        "custom_id": paper.eid,
+        "method": "POST",
+        "url": "/v1/chat/completions",
+        "body": {
+            "model": model,
+            "messages": [
+                {"role": "system", "content": instructions_text},
+                {"role": "user", "content": screening_user_prompt(paper)},
+            ],
+            "response_format": {
+                "type": "json_schema",
+                "json_schema": {"name": "ResponseModel", "schema": ResponseModel.model_json_schema()},
+            },
+        },
+    }
+
+
+def write_batch_requests(papers: Iterable[Paper], instructions_text: str, model: str, requests_path: Path) -> int:
+    """Serializes the papers into a batch requests JSONL file. Returns the number of requests."""
+    count = 0
+    with open(requests_path, "w", encoding="utf-8") as f:
+        for paper in papers:
+            f.write(json.dumps(batch_request(paper, instructions_text, model)) + "\n")
+            count += 1
+    return count
+
+
+def parse_batch_results(results_path: Path) -> Iterator[Tuple[str, ResponseModel]]:
+    """Yields (eid, ResponseModel) for every response of the batch that validates. The others are logged and skipped."""
+    with open(results_path, "r", encoding="utf-8") as f:
+        for line in f:
+            result = json.loads(line)
+            eid = result["custom_id"]
+            response = result.get("response") or {}
+            if result.get("error") or response.get("status_code") != 200:
+                logging.warning(f"Batch request failed for {eid}: {result.get('error') or response.get('status_code')}")
+                continue
+            try:
+                content = response["body"]["choices"][0]["message"]["content"]
+                yield eid, ResponseModel.model_validate_json(content)
+            except (KeyError, IndexError, ValidationError) as e:
+                logging.warning(f"Invalid batch response for {eid}: {e}")
+
+
+def record_batch(db_path: str, batch_id: str, requests_path: Path, prompt_hash: str, model_name: str, count: int):
+    conn = open_db(db_path)
+    try:
+        with conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO screening_batches (batch_id, requests_path, prompt_hash, model, paper_count, status, submitted_at) "
+                "VALUES (?, ?, ?, ?, ?, 'submitted', datetime('now'))",
+                (batch_id, str(requests_path), prompt_hash, model_name, count)
+            )
+    finally:
+        conn.close()
+
+
+def set_batch_status(db_path: str, batch_id: str, status: str):
+    conn = open_db(db_path)
+    try:
+        with conn:
+            conn.execute("UPDATE screening_batches SET status = ?, finished_at = datetime('now') WHERE batch_id = ?", (status, batch_id))
+    finally:
+        conn.close()
+
+
+def get_unfinished_batch(db_path: str, prompt_hash: str, model_name: str) -> Optional[Tuple[str, str, int]]:
+    """(batch_id, requests_path, paper_count) of the last batch submitted for this prompt and model whose results are not saved yet."""
+    conn = open_db(db_path)
+    try:
+        return conn.execute(
+            "SELECT batch_id, requests_path, paper_count FROM screening_batches "
+            "WHERE status = 'submitted' AND prompt_hash = ? AND model = ? ORDER BY submitted_at DESC LIMIT 1",
+            (prompt_hash, model_name)
+        ).fetchone()
+    finally:
+        conn.close()
+
+
+def run_batch_screening(db_path: str, provider: BatchProvider, instructions_text: str, work_dir: Path, model: str = "gpt-4.1",
+                        poll_interval: float = 60, rescreen_all: bool = False, batch_size: int = 500,
+                        min_prescreen_score: Optional[float] = None) -> int:
+    """
+    Screens the pending papers (see get_papers_to_screen) through a batch API instead of one call per paper:
+    writes the requests JSONL, submits it, polls until the batch is finished, then validates the responses
+    against ResponseModel and writes them to papers with executemany, 'batch_size' rows per transaction.
+    The decisions are stored with the same prompt hash and model name as the agent's, so the incremental
+    screening treats both modes alike. Returns the number of papers updated.
+    The batch is recorded in the screening_batches table as soon as it is submitted: a run that is interrupted
+    while polling resumes the same batch for this prompt and model instead of submitting (and paying for) a new one.
+    """
+    work_dir = Path(work_dir)
+    work_dir.mkdir(parents=True, exist_ok=True)
+    model_name = f"openai:{model}"
+    current_hash = prompt_hash(instructions_text)
+
+    batch = get_unfinished_batch(db_path, current_hash, model_name)
+    if batch is not None:
+        batch_id, requests_path, count = batch
+        requests_path = Path(requests_path)
+        logging.info(f"Resuming batch {batch_id} with {count} papers.")
+    else:
+        papers = get_papers_to_screen(db_path, current_hash, model_name, rescreen_all, min_prescreen_score)
+        if not papers:
+            logging.info("No papers to screen.")
+            return 0
+        requests_path = work_dir / f"screening_{time.strftime('%Y%m%d_%H%M%S')}.jsonl"
+        count = write_batch_requests(papers, instructions_text, model, requests_path)
+        batch_id = provider.submit(requests_path)
+        record_batch(db_path, batch_id, requests_path, current_hash, model_name, count)
+        logging.info(f"Submitted batch {batch_id} with {count} papers.")
+
+    status = provider.status(batch_id)
+    while status not in FINISHED_STATUSES:
+        logging.info(f"Batch {batch_id} is {status}, checking again in {poll_interval}s.")
+        time.sleep(poll_interval)
+        status = provider.status(batch_id)
+    if status != "completed":
+        set_batch_status(db_path, batch_id, status)
+        raise Exception(f"Batch {batch_id} finished with status {status}.")
+
+    results_path = requests_path.with_name(f"{requests_path.stem}_results.jsonl")
+    provider.download(batch_id, results_path)
+
+    conn = connect(db_path)
+    written = 0
+    rows = []
+    try:
+        for eid, result in parse_batch_results(results_path):
+            rows.append((bool(result.should_be_included), float(result.confidence_level), result.summary,
+                         current_hash, model_name, eid))
+            if len(rows) >= batch_size:
+                with sqlite_write("batch_screening", len(rows)), conn:
+                    conn.executemany(UPDATE_SCREENING_SQL, rows)
+                written += len(rows)
+                rows = []
+        if rows:
+            with sqlite_write("batch_screening", len(rows)), conn:
+                conn.executemany(UPDATE_SCREENING_SQL, rows)
+            written += len(rows)
+    finally:
+        conn.close()
+    # Only once the decisions are saved: a crash before this point downloads the results again on the next run
+    set_batch_status(db_path, batch_id, "saved")
+    logging.info(f"Saved {written} / {count} screening decisions from batch {batch_id}.")
+    return written
@@ -0,0 +1,177 @@
+import logging
+import re
+import sqlite3
+import unicodedata
+from pathlib import Path
+from typing import List, Optional, Tuple
+from app.storage import open_db, upsert_rows
+
+SCREENING_COLUMNS = ("to_be_reviewed", "confidence_level", "analysis_summary", "screening_prompt_hash", "screening_model", "screened_at")
+# Shorter titles ("Introduction", "Editorial"...) are too generic to identify a paper
+MIN_TITLE_LENGTH = 20
+
+
+def normalize_doi(doi: Optional[str]) -> Optional[str]:
+    """Lower case DOI without the resolver prefix, None if empty."""
+    if not doi:
+        return None
+    doi = doi.strip().lower()
+    doi = re.sub(r"^(https?://)?(dx\.)?doi\.org/|^doi:\s*", "", doi)
+    return doi or None
+
+
+def normalize_title(title: Optional[str]) -> Optional[str]:
+    """Title without accents, punctuation, case and repeated spaces, None if too short to identify a paper."""
+    if not title:
+        return None
+    title = unicodedata.normalize("NFKD", title).encode("ascii", "ignore").decode("ascii").lower()
+    title = " ".join(re.sub(r"[^a-z0-9]+", " ", title).split())
+    return title if len(title) >= MIN_TITLE_LENGTH else None
+
+
+def dedup_keys(eid: str, doi: Optional[str], title: Optional[str], publication_date: Optional[str]) -> List[str]:
+    """
+    Keys under which a paper is indexed: its EID, its DOI and its normalised title + publication year.
+    Two records sharing any key are the same paper (e.g. the same article found by two queries, or a record indexed twice).
+    """
+    keys = [f"eid:{eid}"]
+    doi = normalize_doi(doi)
+    if doi:
+        keys.append(f"doi:{doi}")
+    title = normalize_title(title)
+    if title:
+        keys.append(f"title:{title}|{(publication_date or '')[:4]}")
+    return keys
+
+
+def resolve(conn: sqlite3.Connection, keys: List[str]) -> Optional[str]:
+    """EID of the paper already indexed under one of the keys, None if it is new."""
+    placeholders = ", ".join("?" for _ in keys)
+    row = conn.execute(f"SELECT eid FROM paper_keys WHERE key IN ({placeholders}) LIMIT 1", keys).fetchone()
+    return row[0] if row else None
+
+
+def register(conn: sqlite3.Connection, eid: str, keys: List[str], query: str, source_db: str = ""):
+    """Indexes the paper under its keys and records that 'query' found it."""
+    conn.executemany("INSERT OR IGNORE INTO paper_keys (key, eid) VALUES (?, ?)", [(key, eid) for key in keys])
+    conn.execute(
+        "INSERT OR IGNORE INTO paper_sources (eid, query, source_db, added_at) VALUES (?, ?, ?, datetime('now'))",
+        (eid, query, source_db)
+    )
+
+
+def index_corpus(conn: sqlite3.Connection) -> int:
+    """Indexes the papers that are not in paper_keys yet (e.g. harvested before the index existed). Returns how many."""
+    rows = conn.execute(
+        "SELECT eid, prism_doi, title, publication_date FROM papers WHERE 'eid:' || eid NOT IN (SELECT key FROM paper_keys)"
+    ).fetchall()
+    with conn:
+        for eid, doi, title, publication_date in rows:
+            conn.executemany("INSERT OR IGNORE INTO paper_keys (key, eid) VALUES (?, ?)",
+                             [(key, eid) for key in dedup_keys(eid, doi, title, publication_date)])
+    return len(rows)
+
+
+def dedupe_page(conn: sqlite3.Connection, papers: List[dict], query: str, source_db: str = "") -> List[dict]:
+    """
+    Records the query as a source of every paper of a harvested page, and returns only the papers to write:
+    the new ones and those stored under the same EID. Papers already stored under another EID (same DOI or title)
+    are not written again. Runs in the caller's transaction.
+    """
+    to_write = []
+    for paper in papers:
+        keys = dedup_keys(paper["eid"], paper.get("prism_doi"), paper.get("title"), paper.get("publication_date"))
+        existing = resolve(conn, keys)
+        if existing is not None and existing != paper["eid"]:
+            logging.info(f"{paper['eid']} is a duplicate of {existing}, skipped.")
+        else:
+            to_write.append(paper)
+        register(conn, existing or paper["eid"], keys, query, source_db)
+    return to_write
+
+
+def harvested_query(conn: sqlite3.Connection) -> str:
+    """The query a per-query database was harvested with (harvest_progress), "" if it has none or several."""
+    queries = {row[0] for row in conn.execute("SELECT query FROM harvest_progress")}
+    return queries.pop() if len(queries) == 1 else ""
+
+
+def merge_db(master_path: str, source_path: str, query: Optional[str] = None) -> Tuple[int, int]:
+    """
+    Consolidates the papers of a per-query database into the master corpus.
+    New papers are copied with their abstract and screening decision. For papers the master already has
+    (by EID, DOI or title), only what the master is missing is filled in. Every paper records that 'query' found it,
+    by default the query the database was harvested with.
+    Run it after each stage (harvest, abstracts, screening): merging again adds the abstracts and decisions made since.
+    Returns (new papers, duplicates).
+    """
+    master = open_db(master_path)
+    index_corpus(master)
+    source = open_db(source_path)
+    if query is None:
+        query = harvested_query(source)
+    source.row_factory = sqlite3.Row
+    columns = [col[1] for col in master.execute("PRAGMA table_info(papers)")]
+    new = duplicates = 0
+    try:
+        with master:
+            for row in source.execute("SELECT * FROM papers"):
+                row = dict(row)
+                keys = dedup_keys(row["eid"], row["prism_doi"], row["title"], row["publication_date"])
+                existing = resolve(master, keys)
+                if existing is None:
+                    upsert_rows(master, "papers", columns, [tuple(row.get(col) for col in columns)])
+                    new += 1
+                else:
+                    master.execute("UPDATE papers SET abstract = COALESCE(abstract, ?) WHERE eid = ?", (row["abstract"], existing))
+                    if row["to_be_reviewed"] is not None:
+                        assignments = ", ".join(f"{col} = ?" for col in SCREENING_COLUMNS)
+                        master.execute(f"UPDATE papers SET {assignments} WHERE eid = ? AND to_be_reviewed IS NULL",
+                                       [row[col] for col in SCREENING_COLUMNS] + [existing])
+                    duplicates += 1
+                register(master, existing or row["eid"], keys, query, Path(source_path).name)
+    finally:
+        source.close()
+        master.close()
+    logging.info(f"Merged {source_path} into {master_path}: {new} new papers, {duplicates} already in the corpus.")
+    return new, duplicates
+
+
+def prefill_from_master(db_path: str, master_path: str) -> int:
+    """
+    Copies into db_path the abstracts and screening decisions the master corpus already has for its papers,
+    matched by EID, DOI or title. Run it before retrieves_abstracts / the screening, which then skip those papers
+    instead of paying again for them. Returns the number of papers updated.
+    """
+    if not Path(master_path).exists():
+        return 0
+    conn = open_db(db_path)
+    master = open_db(master_path)
+    index_corpus(master)
+    master.row_factory = sqlite3.Row
+    updated = 0
+    try:
+        pending = conn.execute(
+            "SELECT eid, prism_doi, title, publication_date FROM papers WHERE abstract IS NULL OR to_be_reviewed IS NULL"
+        ).fetchall()
+        with conn:
+            for eid, doi, title, publication_date in pending:
+                existing = resolve(master, dedup_keys(eid, doi, title, publication_date))
+                if existing is None:
+                    continue
+                known = master.execute(
+                    f"SELECT abstract, {', '.join(SCREENING_COLUMNS)} FROM papers WHERE eid = ?", (existing,)
+                ).fetchone()
+                if known is None:
+                    continue
+                conn.execute("UPDATE papers SET abstract = COALESCE(abstract, ?) WHERE eid = ?", (known["abstract"], eid))
+                if known["to_be_reviewed"] is not None:
+                    assignments = ", ".join(f"{col} = ?" for col in SCREENING_COLUMNS)
+                    conn.execute(f"UPDATE papers SET {assignments} WHERE eid = ? AND to_be_reviewed IS NULL",
+                                 [known[col] for col in SCREENING_COLUMNS] + [eid])
+                updated += 1
+    finally:
+        master.close()
+        conn.close()
+    logging.info(f"Prefilled {updated} papers of {db_path} from {master_path}.")
+    return updated
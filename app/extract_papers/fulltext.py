@@ -0,0 +1,220 @@
+import asyncio
+import hashlib
+import logging
+import os
+import sqlite3
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import urlparse
+import httpx
+from dotenv import load_dotenv
+from app.extract_papers.rate_limit import TokenBucket, get_with_retries, run_workers
+from app.instrumentation import save_at_exit, sqlite_write
+from app.storage import connect, init_db
+
+ARTICLE_URL = "https://api.elsevier.com/content/article/pii/{pii}"
+UNPAYWALL_URL = "https://api.unpaywall.org/v2/{doi}"
+# Requests per second per host. Elsevier allows 10/s on the Article Retrieval API, Unpaywall asks for under 10/s
+HOST_RATES = {"api.elsevier.com": 9.0, "api.unpaywall.org": 8.0}
+DEFAULT_HOST_RATE = 2.0
+# Statuses that are not retried: the paper has no open-access PDF we can get.
+# 'failed' and 'unauthorized' (Elsevier refused the API key or its entitlements) are tried again on the next run
+FINAL_STATUSES = ("fetched", "not_found", "not_pdf")
+
+
+class HostLimiters:
+    """One TokenBucket per host, so a slow or throttling publisher doesn't hold back the requests to the others."""
+
+    def __init__(self, rates: Optional[Dict[str, float]] = None, default_rate: float = DEFAULT_HOST_RATE):
+        self.rates = HOST_RATES if rates is None else rates
+        self.default_rate = default_rate
+        self.limiters: Dict[str, TokenBucket] = {}
+
+    def get(self, url: str) -> TokenBucket:
+        host = urlparse(url).netloc
+        if host not in self.limiters:
+            self.limiters[host] = TokenBucket(self.rates.get(host, self.default_rate))
+        return self.limiters[host]
+
+
+def store_path(store_dir: Path, digest: str) -> Path:
+    """Content-addressed location of a PDF: <store>/<first 2 hex>/<sha256>.pdf"""
+    return Path(store_dir) / digest[:2] / f"{digest}.pdf"
+
+
+def save_pdf(store_dir: Path, content: bytes) -> Path:
+    """Stores the PDF under its hash, once: the same file found for two papers (or twice) is kept a single time."""
+    path = store_path(store_dir, hashlib.sha256(content).hexdigest())
+    if not path.exists():
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_suffix(".part")
+        tmp.write_bytes(content)
+        os.replace(tmp, path)
+    return path
+
+
+def get_pending_fulltexts(db_path: str, only_included: bool = True) -> List[Tuple[str, Optional[str], Optional[str]]]:
+    """
+    (eid, pii, doi) of the open-access papers without a full text yet (never tried, or failed or unauthorized last time).
+    With only_included, only the papers the screening kept.
+    """
+    sql = f'''
+        SELECT eid, pii, prism_doi FROM papers
+        WHERE (openaccessFlag = 1 OR openaccessFlag = 'true')
+        AND (fulltext_status IS NULL OR fulltext_status NOT IN ({", ".join("?" for _ in FINAL_STATUSES)}))
+    '''
+    if only_included:
+        sql += " AND to_be_reviewed = 1"
+    conn = connect(db_path)
+    try:
+        return conn.execute(sql, FINAL_STATUSES).fetchall()
+    finally:
+        conn.close()
+
+
+def fetched_paths(db_path: str) -> List[Path]:
+    """The full texts already in the store, ready for extract_texts."""
+    conn = connect(db_path)
+    try:
+        return [Path(row[0]) for row in conn.execute("SELECT DISTINCT fulltext_path FROM papers WHERE fulltext_status = 'fetched'")]
+    finally:
+        conn.close()
+
+
+def fulltext_eids(db_path: str) -> Dict[str, str]:
+    """
+    {file name in the store: EID(s) of the paper} for the fetched full texts, so the coding results of a
+    content-addressed <sha256>.pdf can be traced back to the paper. A PDF shared by several EIDs gets them ';'-separated.
+    """
+    conn = connect(db_path)
+    try:
+        rows = conn.execute(
+            "SELECT fulltext_path, group_concat(eid, ';') FROM papers WHERE fulltext_status = 'fetched' GROUP BY fulltext_path"
+        ).fetchall()
+    finally:
+        conn.close()
+    return {Path(path).name: eids for path, eids in rows}
+
+
+def flush_statuses(conn: sqlite3.Connection, rows: list):
+    """Writes a batch of (status, path, eid) rows in one transaction."""
+    with sqlite_write("fulltext_status", len(rows)), conn:
+        conn.executemany(
+            "UPDATE papers SET fulltext_status = ?, fulltext_path = ?, fulltext_fetched_at = datetime('now') WHERE eid = ?", rows
+        )
+
+
+def _is_pdf(response: httpx.Response) -> bool:
+    return "pdf" in response.headers.get("Content-Type", "") or response.content[:5] == b"%PDF-"
+
+
+async def _pdf_url(client: httpx.AsyncClient, limiters: HostLimiters, doi: str, email: str) -> Optional[str]:
+    """Best open-access PDF location of the DOI according to Unpaywall, None if it knows of none."""
+    url = UNPAYWALL_URL.format(doi=doi)
+    response = await get_with_retries(client, limiters.get(url), url, {"email": email})
+    if response.status_code != 200:
+        return None
+    location = response.json().get("best_oa_location") or {}
+    return location.get("url_for_pdf")
+
+
+async def fetch_fulltext(client: httpx.AsyncClient, limiters: HostLimiters, store_dir: Path, pii: Optional[str], doi: Optional[str],
+                         elsevier_headers: dict, unpaywall_email: Optional[str] = None,
+                         article_url: str = ARTICLE_URL) -> Tuple[str, Optional[Path]]:
+    """
+    Downloads the PDF of one paper: from the Elsevier Article Retrieval API when it has a PII (ScienceDirect),
+    otherwise from the open-access location Unpaywall gives for its DOI. Returns (status, stored path).
+    A 401/403 from Elsevier is about the API key, not the paper: it is 'unauthorized', which is retried.
+    """
+    if pii:
+        url = article_url.format(pii=pii)
+        response = await get_with_retries(client, limiters.get(url), url, {"httpAccept": "application/pdf"}, headers=elsevier_headers)
+        if response.status_code in (401, 403):
+            return "unauthorized", None
+    elif doi and unpaywall_email:
+        url = await _pdf_url(client, limiters, doi, unpaywall_email)
+        if url is None:
+            return "not_found", None
+        response = await get_with_retries(client, limiters.get(url), url)
+    else:
+        return "not_found", None
+    if response.status_code in (401, 403, 404, 410):
+        return "not_found", None
+    if response.status_code != 200:
+        return "failed", None
+    if not _is_pdf(response):
+        return "not_pdf", None
+    return "fetched", save_pdf(store_dir, response.content)
+
+
+async def fetch_fulltexts_async(db_path: str, store_dir: Path, elsevier_headers: dict, unpaywall_email: Optional[str] = None,
+                                concurrency: int = 8, only_included: bool = True, flush_every: int = 20,
+                                host_rates: Optional[Dict[str, float]] = None, article_url: str = ARTICLE_URL,
+                                max_unauthorized: int = 20) -> List[Path]:
+    """
+    Fetches the full text of every pending open-access paper (see get_pending_fulltexts) with 'concurrency' workers
+    sharing one client. Requests are paced per host (HostLimiters), and 429/5xx are retried (see get_with_retries).
+    The status of each EID (fetched, not_found, not_pdf, failed, unauthorized) is written every 'flush_every' papers
+    (see run_workers), so an interrupted run only retries what was in flight; failed and unauthorized papers are
+    tried again on the next run. The run stops after 'max_unauthorized' 401/403 in a row from Elsevier: the key is wrong.
+    Returns the paths of the PDFs fetched, to pass to extract_texts.
+    """
+    pending = get_pending_fulltexts(db_path, only_included)
+    logging.info(f"{len(pending)} open-access papers without full text.")
+    if not pending:
+        return []
+    limiters = HostLimiters(host_rates)
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    conn = connect(db_path)
+    fetched = []
+    unauthorized = 0
+
+    async def fetch(client: httpx.AsyncClient, paper: Tuple[str, Optional[str], Optional[str]]):
+        nonlocal unauthorized
+        eid, pii, doi = paper
+        if unauthorized >= max_unauthorized:
+            return None
+        try:
+            status, path = await fetch_fulltext(client, limiters, store_dir, pii, doi, elsevier_headers, unpaywall_email, article_url)
+        except Exception as e:
+            logging.warning(f"Failed to fetch the full text of {eid}: {e}")
+            status, path = "failed", None
+        unauthorized = unauthorized + 1 if status == "unauthorized" else 0
+        if unauthorized == max_unauthorized:
+            logging.error(f"Elsevier refused the last {max_unauthorized} requests (401/403), check SCOPUS_API_KEY. Stopping.")
+        if path is not None:
+            fetched.append(path)
+        return status, str(path) if path else None, eid
+
+    def flush(rows: list):
+        flush_statuses(conn, rows)
+        logging.info(f"{len(fetched)} full texts fetched")
+
+    try:
+        async with httpx.AsyncClient(limits=limits, timeout=120, follow_redirects=True) as client:
+            await run_workers(pending, lambda paper: fetch(client, paper), flush, concurrency, flush_every)
+    finally:
+        conn.close()
+    logging.info(f"Fetched {len(fetched)} full texts of {len(pending)} open-access papers.")
+    return fetched
+
+
+if __name__ == "__main__":
+    from app.coding.pdf_text import extract_texts
+
+    logging.basicConfig(level=logging.INFO)
+    load_dotenv()
+
+    # Config
+    db_path = Path(__file__).parent.parent / "scopus_results_2.db"
+    store_dir = Path(__file__).parent.parent / "fulltexts" # content-addressed PDF store
+    concurrency = 8 # downloads in flight
+    only_included = True # only the papers the screening kept
+    unpaywall_email = os.getenv("UNPAYWALL_EMAIL") # Unpaywall needs a contact email, papers without PII are skipped without it
+    elsevier_headers = {"X-ELS-APIKey": os.getenv("SCOPUS_API_KEY")}
+    save_at_exit(Path(__file__).parent.parent / "run_metrics.db") # timings, sizes, retries, tokens and cost of the run, see app.instrumentation
+
+    init_db(str(db_path))
+    fetched = asyncio.run(fetch_fulltexts_async(str(db_path), store_dir, elsevier_headers, unpaywall_email, concurrency, only_included))
+    # Straight to text extraction, so the coding stage finds the texts in the cache
+    extract_texts(fetched_paths(str(db_path)), Path(__file__).parent.parent / "pdf_text_cache.db")
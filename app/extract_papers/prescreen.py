@@ -0,0 +1,199 @@
+import logging
+import math
+import re
+import time
+from collections import Counter
+from typing import Dict, Iterable, List, Optional
+import numpy as np
+from scipy import sparse
+from scipy.sparse.csgraph import connected_components
+from app.storage import open_db
+
+TOKEN_RE = re.compile(r"[a-z][a-z0-9\-]+")
+STOPWORDS = frozenset("""
+a about above after again against all also am an and any are as at be because been before being below between both but by
+can could did do does doing down during each few for from further had has have having he her here hers him his how i if in
+into is it its itself just more most my no nor not of off on once only or other our ours out over own same she should so
+some such than that the their theirs them then there these they this those through to too under until up very was we were
+what when where which while who whom why will with would you your paper study article results research based using used
+""".split())
+
+
+def tokenize(text: str) -> List[str]:
+    """Lower case words without stopwords, plus the bigrams of consecutive words."""
+    words = [word for word in TOKEN_RE.findall(text.lower()) if word not in STOPWORDS]
+    return words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+
+
+class Tfidf:
+    """
+    Sparse TF-IDF vectors (sublinear tf, smoothed idf, rows normalised to unit length) so that
+    the dot product of two rows is their cosine similarity.
+    """
+
+    def __init__(self, min_df: int = 2, max_df: float = 0.5):
+        self.min_df = min_df
+        self.max_df = max_df
+        self.vocabulary: Dict[str, int] = {}
+        self.idf: Optional[np.ndarray] = None
+
+    def fit_transform(self, texts: List[str]) -> sparse.csr_matrix:
+        counts = [Counter(tokenize(text)) for text in texts]
+        df = Counter()
+        for doc in counts:
+            df.update(doc.keys())
+        n = len(texts)
+        terms = sorted(term for term, count in df.items() if count >= self.min_df and count <= self.max_df * n)
+        self.vocabulary = {term: i for i, term in enumerate(terms)}
+        self.idf = np.array([math.log((1 + n) / (1 + df[term])) + 1 for term in terms], dtype=np.float32)
+        return self._vectors(counts)
+
+    def transform(self, texts: Iterable[str]) -> sparse.csr_matrix:
+        return self._vectors([Counter(tokenize(text)) for text in texts])
+
+    def _vectors(self, counts: List[Counter]) -> sparse.csr_matrix:
+        indptr = [0]
+        indices = []
+        data = []
+        for doc in counts:
+            for term, count in doc.items():
+                i = self.vocabulary.get(term)
+                if i is not None:
+                    indices.append(i)
+                    data.append(1 + math.log(count))
+            indptr.append(len(indices))
+        matrix = sparse.csr_matrix(
+            (np.array(data, dtype=np.float32), np.array(indices, dtype=np.int32), np.array(indptr, dtype=np.int64)),
+            shape=(len(counts), len(self.vocabulary)),
+        )
+        matrix = matrix @ sparse.diags(self.idf)
+        norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+        norms[norms == 0] = 1
+        return sparse.diags(1 / norms) @ matrix
+
+
+MERSENNE_PRIME = (1 << 31) - 1
+
+
+def minhash_candidates(matrix: sparse.csr_matrix, bands: int = 20, rows_per_band: int = 5, block: int = 1000,
+                       seed: int = 0) -> np.ndarray:
+    """
+    Candidate near-duplicate pairs (i < j, one per row of the returned array) by MinHash / LSH banding over
+    the set of terms of every row: two rows share a band, and become candidates, with probability
+    1 - (1 - J^rows_per_band)^bands for a Jaccard similarity J of their terms. With the defaults that is
+    more than 97% from J = 0.7 and about one in a million pairs at J = 0.05. Rows without any term are left out.
+    """
+    n_hashes = bands * rows_per_band
+    rng = np.random.default_rng(seed)
+    a = rng.integers(1, MERSENNE_PRIME, n_hashes, dtype=np.int64)
+    b = rng.integers(0, MERSENNE_PRIME, n_hashes, dtype=np.int64)
+    present = np.flatnonzero(np.diff(matrix.indptr))
+    # Hashes of 'block' rows at a time: one value per term and hash function of the block
+    signatures = np.empty((len(present), n_hashes), dtype=np.int64)
+    for start in range(0, len(present), block):
+        rows = present[start:start + block]
+        chunk = matrix[rows]
+        terms = chunk.indices.astype(np.int64)
+        hashes = (terms[:, None] * a + b) % MERSENNE_PRIME
+        signatures[start:start + len(rows)] = np.minimum.reduceat(hashes, chunk.indptr[:-1], axis=0)
+
+    pairs = []
+    for band in range(bands):
+        _, bucket = np.unique(signatures[:, band * rows_per_band:(band + 1) * rows_per_band], axis=0, return_inverse=True)
+        bucket = bucket.ravel()
+        shared = np.flatnonzero(np.bincount(bucket)[bucket] > 1)
+        if not len(shared):
+            continue
+        shared = shared[np.argsort(bucket[shared], kind="stable")]
+        for members in np.split(shared, np.flatnonzero(np.diff(bucket[shared])) + 1):
+            first, second = np.triu_indices(len(members), 1)
+            pairs.append(np.stack([present[members[first]], present[members[second]]], axis=1))
+    if not pairs:
+        return np.empty((0, 2), dtype=np.int64)
+    pairs = np.concatenate(pairs)
+    return np.unique(pairs, axis=0)
+
+
+def near_duplicate_clusters(matrix: sparse.csr_matrix, threshold: float = 0.9, block: int = 1000,
+                            bands: int = 20, rows_per_band: int = 5) -> np.ndarray:
+    """
+    Cluster label of every row: rows whose cosine similarity is at least 'threshold' (directly or through
+    other rows, e.g. preprint / journal version / conference version) share a label.
+    Only the candidate pairs of minhash_candidates are compared, so neither the n x n similarities nor
+    a block of them against every row are computed: near duplicates share most of their terms.
+    """
+    n = matrix.shape[0]
+    candidates = minhash_candidates(matrix, bands, rows_per_band, block)
+    keep = []
+    for start in range(0, len(candidates), 100_000):
+        pairs = candidates[start:start + 100_000]
+        similarities = np.asarray(matrix[pairs[:, 0]].multiply(matrix[pairs[:, 1]]).sum(axis=1)).ravel()
+        keep.append(pairs[similarities >= threshold])
+    keep = np.concatenate(keep) if keep else np.empty((0, 2), dtype=np.int64)
+    logging.info(f"{len(candidates)} candidate pairs of near duplicates, {len(keep)} above the threshold.")
+    graph = sparse.coo_matrix((np.ones(len(keep), dtype=np.int8), (keep[:, 0], keep[:, 1])), shape=(n, n))
+    _, labels = connected_components(graph, directed=False)
+    return labels
+
+
+def relevance_scores(model: Tfidf, matrix: sparse.csr_matrix, criteria_text: str, positives: np.ndarray, negatives: np.ndarray) -> np.ndarray:
+    """
+    Cosine similarity of every row to a query vector: the inclusion criteria, moved towards the labelled
+    positive papers and away from the negative ones (Rocchio feedback) when a seed set is available.
+    """
+    query = np.asarray(model.transform([criteria_text]).todense()).ravel()
+    if len(positives):
+        query = query + np.asarray(matrix[positives].mean(axis=0)).ravel()
+    if len(negatives):
+        query = query - 0.5 * np.asarray(matrix[negatives].mean(axis=0)).ravel()
+    query = np.clip(query, 0, None)
+    norm = np.linalg.norm(query)
+    if norm == 0:
+        return np.zeros(matrix.shape[0], dtype=np.float32)
+    return matrix @ (query / norm)
+
+
+def prescreen(db_path: str, criteria_text: str, duplicate_threshold: float = 0.9) -> int:
+    """
+    Local pre-screening before the LLM. Over title + abstract of every paper with an abstract:
+    - near-duplicates of another paper get its EID in duplicate_of (the one with the longest abstract is kept),
+    - the papers still to screen get a relevance score in prescreen_score (see relevance_scores), using the
+      papers that already have a decision as seed set.
+    The screening then skips duplicates and the papers scoring below min_prescreen_score (see get_papers_to_screen).
+    Returns the number of papers scored.
+    """
+    started = time.perf_counter()
+    conn = open_db(db_path)
+    try:
+        rows = conn.execute("SELECT eid, title, abstract, to_be_reviewed FROM papers WHERE abstract IS NOT NULL").fetchall()
+        if not rows:
+            return 0
+        eids = [row[0] for row in rows]
+        abstracts = [row[2] or "" for row in rows]
+        labels = np.array([-1 if row[3] is None else int(row[3]) for row in rows])
+
+        model = Tfidf()
+        matrix = model.fit_transform([f"{row[1] or ''}\n{row[2] or ''}" for row in rows])
+        clusters = near_duplicate_clusters(matrix, duplicate_threshold)
+        keep = {}
+        for i, cluster in enumerate(clusters):
+            if cluster not in keep or len(abstracts[i]) > len(abstracts[keep[cluster]]):
+                keep[cluster] = i
+        duplicate_of = [None if keep[cluster] == i else eids[keep[cluster]] for i, cluster in enumerate(clusters)]
+
+        scores = relevance_scores(model, matrix, criteria_text, np.flatnonzero(labels == 1), np.flatnonzero(labels == 0))
+        pending = np.flatnonzero(labels == -1)
+        with conn:
+            conn.executemany(
+                "UPDATE papers SET prescreen_score = ?, duplicate_of = ? WHERE eid = ?",
+                [(float(scores[i]), duplicate_of[i], eids[i]) for i in pending]
+            )
+    finally:
+        conn.close()
+
+    duplicates = sum(1 for i in pending if duplicate_of[i] is not None)
+    if len(pending):
+        percentiles = np.percentile(scores[pending], [10, 25, 50, 75, 90]).round(3).tolist()
+        logging.info(f"Prescreen scores of the {len(pending)} papers to screen (p10, p25, p50, p75, p90): {percentiles}")
+    logging.info(f"Prescreened {len(rows)} papers in {time.perf_counter() - started:.1f}s, {duplicates} near-duplicates.")
+    return len(pending)
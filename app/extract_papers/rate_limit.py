@@ -0,0 +1,159 @@
+import asyncio
+import logging
+import time
+from typing import Any, Awaitable, Callable, Iterable, Optional
+from urllib.parse import urlparse
+import httpx
+from app.instrumentation import METRICS
+
+
+class TokenBucket:
+    """
+    Async token bucket used to pace requests to the Elsevier APIs.
+    Tokens refill continuously at 'rate' per second up to 'capacity'.
+    The bucket also follows the quota headers Elsevier sends back (X-RateLimit-Remaining / X-RateLimit-Reset)
+    and can be paused explicitly, e.g. after a 429 with a Retry-After header.
+    See https://dev.elsevier.com/api_key_settings.html for the per-API throttling limits
+    """
+
+    def __init__(self, rate: float, capacity: float | None = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self._tokens = self.capacity
+        self._last_refill = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._last_refill) * self.rate)
+        self._last_refill = now
+
+    async def acquire(self):
+        """Waits until a token is available (and any pause is over) and consumes it."""
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._refill()
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def pause(self, seconds: float):
+        """Blocks every caller of acquire() for at least 'seconds'."""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        # Drop the burst allowance so we restart gently once the pause is over
+        self._tokens = 0.0
+        self._last_refill = self._paused_until
+
+    def update_from_headers(self, headers):
+        """
+        Reads the Elsevier quota headers of a response.
+        When the quota is exhausted the bucket is paused until X-RateLimit-Reset (epoch seconds).
+        """
+        remaining = headers.get("X-RateLimit-Remaining")
+        reset = headers.get("X-RateLimit-Reset")
+        if remaining is None or reset is None:
+            return
+        try:
+            remaining = int(remaining)
+            reset = float(reset)
+        except ValueError:
+            return
+        if remaining <= 0:
+            wait = max(0.0, reset - time.time())
+            logging.warning(f"Scopus quota exhausted, pausing requests for {wait:.0f}s.")
+            self.pause(wait)
+
+
+def retry_delay(headers, attempt: int, base: float = 1.0, max_delay: float = 60.0) -> float:
+    """
+    Seconds to wait before retrying a throttled (429) or failed (5xx) request.
+    Uses the Retry-After header if the server sent one, otherwise exponential backoff.
+    """
+    retry_after = headers.get("Retry-After")
+    if retry_after is not None:
+        try:
+            return min(max_delay, float(retry_after))
+        except ValueError:
+            pass
+    return min(max_delay, base * 2 ** attempt)
+
+
+async def get_with_retries(client, limiter: TokenBucket, url: str, params: dict | None = None, max_retries: int = 5,
+                           headers: dict | None = None):
+    """
+    GET through a shared httpx.AsyncClient, paced by 'limiter'. 'headers' are added to the client's for this request only.
+    429 and 5xx responses pause the whole limiter (so every worker backs off, not just this one) and are retried,
+    and so are timeouts and transport errors (connection resets, read timeouts...), with the same backoff.
+    Returns the first response that is neither, raises once 'max_retries' is exhausted.
+    Records the time spent waiting for the limiter, the request time and response size per host, and the retries.
+    """
+    host = urlparse(url).netloc
+    for attempt in range(max_retries + 1):
+        with METRICS.timer("http_wait_seconds", host=host):
+            await limiter.acquire()
+        try:
+            with METRICS.timer("http_request_seconds", host=host):
+                response = await client.get(url, params=params, headers=headers)
+        except (httpx.TimeoutException, httpx.TransportError) as e:
+            delay = retry_delay({}, attempt)
+            METRICS.inc("http_retries_total", host=host, status=type(e).__name__)
+            logging.warning(f"{url} failed ({type(e).__name__}: {e}), retrying in {delay:.1f}s.")
+            limiter.pause(delay)
+            continue
+        METRICS.observe("http_response_bytes", len(response.content), host=host)
+        limiter.update_from_headers(response.headers)
+        if response.status_code == 429 or response.status_code >= 500:
+            delay = retry_delay(response.headers, attempt)
+            METRICS.inc("http_retries_total", host=host, status=response.status_code)
+            logging.warning(f"{url} returned {response.status_code}, retrying in {delay:.1f}s.")
+            limiter.pause(delay)
+            continue
+        return response
+    raise Exception(f"Request to {url} still failing after {max_retries} retries.")
+
+
+async def run_workers(items: Iterable, handle: Callable[[Any], Awaitable[Optional[tuple]]], flush: Callable[[list], None],
+                      concurrency: int, flush_every: int) -> int:
+    """
+    Runs handle(item) for every item with 'concurrency' workers, e.g. requests sharing one client and limiter.
+    The rows they return (None for no row) are buffered and written with flush(rows) every 'flush_every' rows,
+    and once more at the end, also when a worker raises: an interruption loses at most one buffer.
+    Returns the number of rows flushed.
+    """
+    queue = asyncio.Queue()
+    for item in items:
+        queue.put_nowait(item)
+    buffer = []
+    flushed = 0
+
+    async def worker():
+        nonlocal flushed
+        while True:
+            try:
+                item = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            row = await handle(item)
+            if row is None:
+                continue
+            buffer.append(row)
+            # Workers share one event loop, so the buffer can be swapped without a lock
+            if len(buffer) >= flush_every:
+                rows = buffer[:]
+                buffer.clear()
+                flush(rows)
+                flushed += len(rows)
+
+    try:
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+    finally:
+        if buffer:
+            flush(buffer[:])
+            flushed += len(buffer)
+    return flushed
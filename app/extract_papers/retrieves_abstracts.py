@@ -1,58 +1,124 @@
+import asyncio
 import sqlite3
-import requests
+import httpx
 import os
 from dotenv import load_dotenv
-import time
 import logging
+from pathlib import Path
+from app.extract_papers.rate_limit import TokenBucket, get_with_retries, run_workers
+from app.extract_papers.corpus import merge_db, prefill_from_master
+from app.instrumentation import save_at_exit, sqlite_write
+from app.storage import connect, init_db
 # Set up logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
+ABSTRACT_URL = "https://api.elsevier.com/content/abstract/eid/{eid}"
+# 4xx answers that can change on a later run: a bad or expired key, a timeout, throttling
+RETRYABLE_4XX = {401, 403, 408, 429}
 
-# Load API key
-load_dotenv()
-api_key = os.getenv("SCOPUS_API_KEY")
-
-headers = {
-    "X-ELS-APIKey": api_key,
-    "Accept": "application/json"
-}
-
-# Connect to the database
-db_file_name = "scopus_results.db"
-conn = sqlite3.connect(db_file_name)
-c = conn.cursor()
-
-# Add an 'abstract' column if it doesn't exist
-c.execute("PRAGMA table_info(papers)")
-columns = [col[1] for col in c.fetchall()]
-if "abstract" not in columns:
-    c.execute("ALTER TABLE papers ADD COLUMN abstract TEXT")
-
-# Get all EIDs
-c.execute("SELECT eid FROM papers")
-eids = [row[0] for row in c.fetchall()]
-
-counter = 0
-for eid in eids:
-    url = f"https://api.elsevier.com/content/abstract/eid/{eid}"
-    response = requests.get(url, headers=headers)
-    counter += 1
-    logging.info(f"Processing {counter}/{len(eids)}: {eid}")
-    if response.status_code == 200:
-        data = response.json()
-        # Try to extract the abstract
-        abstract = ""
+
+def ensure_abstract_column(db_path: str):
+    """Makes sure the papers table has its 'abstract' column (schema migrations, see app.storage)."""
+    init_db(db_path)
+
+def get_pending_eids(db_path: str) -> list:
+    """
+    Returns the EIDs whose abstract has not been retrieved yet.
+    Papers without an abstract in Scopus, or that the API definitively refused (404, 400...), are stored with an empty string,
+    so reruns only pick up what is still missing or failed for a transient reason.
+    """
+    conn = connect(db_path)
+    try:
+        return [row[0] for row in conn.execute("SELECT eid FROM papers WHERE abstract IS NULL")]
+    finally:
+        conn.close()
+
+def parse_abstract(data: dict) -> str:
+    """Extracts the abstract from an Abstract Retrieval API response, empty string if there is none."""
+    try:
+        return data["abstracts-retrieval-response"]["coredata"].get("dc:description", "") or ""
+    except Exception:
+        return ""
+
+def flush_abstracts(conn: sqlite3.Connection, rows: list):
+    """Writes a batch of (abstract, eid) rows in one transaction."""
+    with sqlite_write("abstracts", len(rows)), conn:
+        conn.executemany("UPDATE papers SET abstract = ? WHERE eid = ?", rows)
+
+async def retrieve_abstracts_async(db_path: str, headers: dict, concurrency: int = 8, requests_per_second: float = 9.0,
+                                   flush_every: int = 100, url: str = ABSTRACT_URL) -> int:
+    """
+    Retrieves the abstract of every paper that doesn't have one yet.
+    'concurrency' workers share one keep-alive client and one token bucket. A 429 or 5xx pauses all of them
+    with exponential backoff (or the server's Retry-After), see get_with_retries.
+    Abstracts are buffered and written every 'flush_every' rows, see run_workers.
+    A definitive 4xx (e.g. 404 for an EID Scopus doesn't know) is stored as an empty abstract; other failures leave it NULL.
+    Returns the number of abstracts written.
+    """
+    eids = get_pending_eids(db_path)
+    logging.info(f"{len(eids)} papers without abstract.")
+    if not eids:
+        return 0
+
+    limiter = TokenBucket(requests_per_second)
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    conn = connect(db_path)
+    done = 0
+    written = 0
+
+    async def retrieve(client: httpx.AsyncClient, eid: str):
+        nonlocal done
+        done += 1
+        logging.info(f"Processing {done}/{len(eids)}: {eid}")
         try:
-            abstract = data["abstracts-retrieval-response"]["coredata"].get("dc:description", "")
-        except Exception:
-            pass
-        # Update the database
-        c.execute("UPDATE papers SET abstract = ? WHERE eid = ?", (abstract, eid))
-        logging.info(f"Updated abstract for {eid}")
-    else:
-        print(f"Failed to retrieve abstract for {eid}: {response.status_code}")
-    time.sleep(0.2)  # Be polite to the API
-
-conn.commit()
-conn.close()
-print("All abstracts updated.")
\ No newline at end of file
+            response = await get_with_retries(client, limiter, url.format(eid=eid))
+            if response.status_code != 200:
+                logging.warning(f"Failed to retrieve abstract for {eid}: {response.status_code}")
+                if not 400 <= response.status_code < 500 or response.status_code in RETRYABLE_4XX:
+                    return None
+                # The API will give the same answer next time: stored as without abstract, not asked again
+                return "", eid
+            # A truncated or non-JSON body fails this paper only
+            return parse_abstract(response.json()), eid
+        except Exception as e:
+            # The abstract stays NULL, so the next run tries again
+            logging.warning(f"Failed to retrieve abstract for {eid}: {e}")
+            return None
+
+    def flush(rows: list):
+        nonlocal written
+        flush_abstracts(conn, rows)
+        written += len(rows)
+        logging.info(f"Saved {written} abstracts")
+
+    try:
+        async with httpx.AsyncClient(headers=headers, limits=limits, timeout=60) as client:
+            return await run_workers(eids, lambda eid: retrieve(client, eid), flush, concurrency, flush_every)
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    # Load API key
+    load_dotenv()
+    api_key = os.getenv("SCOPUS_API_KEY")
+
+    headers = {
+        "X-ELS-APIKey": api_key,
+        "Accept": "application/json"
+    }
+
+    # Config
+    db_file_name = "scopus_results.db"
+    db_path = Path(__file__).parent.parent / db_file_name
+    master_db_path = Path(__file__).parent.parent / "master_corpus.db" # abstracts already retrieved for other queries
+    concurrency = 8 # number of abstracts requested at the same time
+    flush_every = 100 # number of abstracts buffered before writing to the database
+    save_at_exit(Path(__file__).parent.parent / "run_metrics.db") # timings, sizes, retries, tokens and cost of the run, see app.instrumentation
+
+    ensure_abstract_column(db_path)
+    prefill_from_master(db_path, master_db_path)
+    written = asyncio.run(retrieve_abstracts_async(db_path, headers, concurrency, flush_every=flush_every))
+    print(f"All abstracts updated ({written} written).")
+    # The new abstracts go to the master corpus, for the next queries that find the same papers
+    merge_db(master_db_path, db_path)
@@ -0,0 +1,198 @@
+import asyncio
+import hashlib
+import logging
+import time
+from collections import deque
+from typing import Iterable, List, Optional, Tuple
+from pydantic_ai import Agent
+from app.extract_papers.screening_models import Paper
+from app.cascade import CascadeResult
+from app.instrumentation import sqlite_write
+from app.llm_cache import CachedResult, agent_model_name
+from app.run_metrics import RunMetrics
+from app.storage import connect
+
+SCREENING_PROMPT = "Retrieve the structured output"
+UPDATE_SCREENING_SQL = '''
+    UPDATE papers SET to_be_reviewed=?, confidence_level=?, analysis_summary=?,
+    screening_prompt_hash=?, screening_model=?, screened_at=datetime('now')
+    WHERE eid=?
+'''
+
+
+class RateBudget:
+    """
+    Sliding one-minute window of requests and tokens shared by all screening workers.
+    A request is only sent when both the requests-per-minute and the tokens-per-minute limits of the
+    OpenAI account leave room for it, see https://platform.openai.com/docs/guides/rate-limits
+    """
+
+    def __init__(self, requests_per_minute: int, tokens_per_minute: int):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self._window = deque()  # [timestamp, tokens] of the requests sent in the last minute
+        self._lock = asyncio.Lock()
+
+    async def acquire(self, estimated_tokens: int) -> list:
+        """Waits until a request of 'estimated_tokens' fits in the budget. Returns its entry for settle()."""
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                while self._window and now - self._window[0][0] >= 60:
+                    self._window.popleft()
+                used = sum(tokens for _, tokens in self._window)
+                fits_tokens = used + estimated_tokens <= self.tokens_per_minute or not self._window
+                if len(self._window) < self.requests_per_minute and fits_tokens:
+                    entry = [now, estimated_tokens]
+                    self._window.append(entry)
+                    return entry
+                await asyncio.sleep(max(0.05, 60 - (now - self._window[0][0])))
+
+    def settle(self, entry: list, actual_tokens: Optional[int]):
+        """Replaces the estimate of a finished request with the tokens it actually used."""
+        if actual_tokens is not None:
+            entry[1] = actual_tokens
+
+
+def screening_user_prompt(paper: Paper) -> str:
+    """
+    The paper comes last, in the user prompt, after the static instructions.
+    Every request then starts with the same prefix, which the provider can cache,
+    see https://platform.openai.com/docs/guides/prompt-caching
+    """
+    return f"{SCREENING_PROMPT}\n\nPaper: {paper}"
+
+
+def estimate_tokens(paper: Paper) -> int:
+    """Rough prompt size (about 4 characters per token) used before the real usage is known."""
+    return (len(paper.title) + len(paper.abstract)) // 4 + 1000
+
+
+def prompt_hash(instructions_text: str) -> str:
+    """Identifies the version of the screening prompt a decision was made with."""
+    return hashlib.sha256(f"{instructions_text}\n{SCREENING_PROMPT}".encode("utf-8")).hexdigest()[:16]
+
+
+def _to_screen_filter(prompt_hash: Optional[str], model_name: Optional[str], rescreen_all: bool,
+                      min_prescreen_score: Optional[float]) -> Tuple[str, tuple]:
+    """WHERE clause and parameters selecting the papers to screen, see get_papers_to_screen."""
+    sql = "abstract IS NOT NULL AND duplicate_of IS NULL"
+    params = ()
+    if not rescreen_all:
+        sql += " AND (to_be_reviewed IS NULL OR screening_prompt_hash IS NOT ? OR screening_model IS NOT ?)"
+        params = (prompt_hash, model_name)
+    if min_prescreen_score is not None:
+        sql += " AND (prescreen_score IS NULL OR prescreen_score >= ?)"
+        params += (min_prescreen_score,)
+    return sql, params
+
+
+def get_papers_to_screen(db_path: str, prompt_hash: Optional[str] = None, model_name: Optional[str] = None, rescreen_all: bool = False,
+                         min_prescreen_score: Optional[float] = None) -> List[Paper]:
+    """
+    Reads the papers that have an abstract but no decision for the current prompt and model.
+    That is, papers never screened, or screened with another prompt_hash or model_name.
+    Decisions are saved as they are made, so a run that was killed picks up where it stopped.
+    With rescreen_all=True every paper with an abstract is returned.
+    Near-duplicates found by the prescreen are left out, and with min_prescreen_score so are the papers
+    the prescreen scored below it (papers without a score are kept).
+    """
+    where, params = _to_screen_filter(prompt_hash, model_name, rescreen_all, min_prescreen_score)
+    conn = connect(db_path)
+    try:
+        rows = conn.execute(f"SELECT eid, title, abstract FROM papers WHERE {where}", params).fetchall()
+    finally:
+        conn.close()
+    return [Paper(eid=eid, title=title or "", abstract=abstract) for eid, title, abstract in rows]
+
+
+def count_papers_to_screen(db_path: str, prompt_hash: Optional[str] = None, model_name: Optional[str] = None,
+                           min_prescreen_score: Optional[float] = None) -> int:
+    """Number of papers get_papers_to_screen would return, without reading the abstracts."""
+    where, params = _to_screen_filter(prompt_hash, model_name, False, min_prescreen_score)
+    conn = connect(db_path)
+    try:
+        return conn.execute(f"SELECT COUNT(*) FROM papers WHERE {where}", params).fetchone()[0]
+    finally:
+        conn.close()
+
+
+async def _writer(db_path: str, results: asyncio.Queue, batch_size: int, prompt_hash: Optional[str], model_name: str) -> int:
+    """
+    Single task owning the database connection. Flushes the screening decisions in batches of 'batch_size'.
+    Each flush is a checkpoint: the decisions are stored with the prompt hash and model they were made with.
+    """
+    conn = connect(db_path)
+    batch = []
+    written = 0
+    try:
+        while True:
+            item = await results.get()
+            if item is not None:
+                eid, result = item
+                batch.append((bool(result.should_be_included), float(result.confidence_level), result.summary,
+                              prompt_hash, model_name, eid))
+            if batch and (item is None or len(batch) >= batch_size):
+                with sqlite_write("screening", len(batch)), conn:
+                    conn.executemany(UPDATE_SCREENING_SQL, batch)
+                written += len(batch)
+                logging.info(f"Saved {written} screening decisions")
+                batch = []
+            if item is None:
+                return written
+    finally:
+        conn.close()
+
+
+async def screen_papers_async(db_path: str, agent: Agent, papers: Optional[Iterable[Paper]] = None, prompt_hash: Optional[str] = None,
+                              rescreen_all: bool = False, concurrency: int = 10, requests_per_minute: int = 500,
+                              tokens_per_minute: int = 200_000, batch_size: int = 50, metrics: Optional[RunMetrics] = None,
+                              min_prescreen_score: Optional[float] = None) -> int:
+    """
+    Screens the papers with up to 'concurrency' agent.run calls in flight, within the per-minute request and token budget.
+    Screening is dominated by model latency, so N calls in flight give close to N times the throughput of run_sync.
+    Decisions go through one writer task that batches the UPDATEs, see _writer.
+    'papers' defaults to the papers without a decision for this prompt_hash and model (see get_papers_to_screen). The agent can be overridden with pydantic-ai's
+    TestModel/FunctionModel (agent.override(model=...)) to run the engine offline.
+    With 'metrics', the tokens (input, cached, output) and latency of every call are recorded.
+    Returns the number of papers updated.
+    """
+    model_name = agent_model_name(agent)
+    if papers is None:
+        papers = get_papers_to_screen(db_path, prompt_hash, model_name, rescreen_all, min_prescreen_score)
+        logging.info(f"{len(papers)} papers to screen with {model_name} (prompt {prompt_hash}).")
+    pending = iter(papers)
+    budget = RateBudget(requests_per_minute, tokens_per_minute)
+    results = asyncio.Queue()
+    processed = 0
+
+    async def worker():
+        nonlocal processed
+        for paper in pending:
+            entry = await budget.acquire(estimate_tokens(paper))
+            started = time.perf_counter()
+            try:
+                response = await agent.run(user_prompt=screening_user_prompt(paper))
+            except Exception as e:
+                # The paper keeps its previous decision (if any)
+                logging.warning(f"Screening failed for {paper.eid}: {e}")
+                continue
+            budget.settle(entry, response.usage().total_tokens)
+            if metrics is not None:
+                if isinstance(response, CascadeResult):
+                    metrics.record_cascade(paper.eid, response)
+                    from_cache = response.from_cache
+                else:
+                    from_cache = isinstance(response, CachedResult)
+                metrics.record(paper.eid, model_name, response.usage(), time.perf_counter() - started, from_cache)
+            await results.put((paper.eid, response.output))
+            processed += 1
+            logging.info(f"Processed {processed} papers")
+
+    writer = asyncio.create_task(_writer(db_path, results, batch_size, prompt_hash, model_name))
+    try:
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+    finally:
+        await results.put(None)
+        written = await writer
+    return written
@@ -0,0 +1,25 @@
+from pydantic import BaseModel, Field
+
+
+class ResponseModel(BaseModel):
+    """Structured response with metadata."""
+
+    should_be_included: bool = Field(
+        description="Indicates if the paper should be included in the review",
+    )
+    confidence_level: float = Field(
+        description="Confidence level in the decision wether to include the paper in the review", ge=0, le=1
+    )
+    summary: str = Field(
+        description="Brief summary of the analysis decision",
+        max_length=500,
+    )
+
+
+# Define order schema
+class Paper(BaseModel):
+    """Structure for each paper to be screened."""
+
+    eid: str
+    title: str
+    abstract: str
@@ -1,3 +1,7 @@
+import asyncio
+from collections import deque
+from itertools import islice
+import httpx
 import requests
 from dotenv import load_dotenv
 import os
@@ -5,6 +9,11 @@ import csv
 import logging
 import sqlite3
 from pathlib import Path
+from urllib.parse import urlparse
+from app.extract_papers.rate_limit import TokenBucket, get_with_retries
+from app.extract_papers.corpus import dedupe_page, index_corpus, merge_db
+from app.instrumentation import METRICS, save_at_exit, sqlite_write
+from app.storage import connect, init_db, open_db, upsert_rows
 # Set up logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
@@ -25,20 +34,43 @@ def get_research_length(headers: dict, url: str, query: str, subject: str, scopu
         "httpAccept": "application/json"
     }
 
-    response = requests.get(url, headers=headers, params=params)
+    with METRICS.timer("http_request_seconds", host=urlparse(url).netloc):
+        response = requests.get(url, headers=headers, params=params)
     research_length = int(response.json().get("search-results").get("opensearch:totalResults"))
     return research_length
 
-def get_papers(headers: dict, url: str, query: str, subject: str, scopus_api: str, research_length: int, chunk: int) -> list:
+def entry_to_paper(entry: dict) -> dict:
+    """Extracts the relevant information from one entry of a Scopus search results page."""
+    return {
+        "eid": entry.get("eid"),
+        "scopus_id": entry.get("dc:identifier"),
+        "first_author": entry.get("dc:creator"),
+        "content_retrieval_uri": entry.get("prism:url"),
+        "prism_doi": entry.get("prism:doi", ""),
+        "link_self": entry.get("link")[0].get("@href"),
+        "link_author_affiliation": entry.get("link")[1].get("@href"),
+        "link_scopus": entry.get("link")[2].get("@href"),
+        "open_access": entry.get("openaccess", ""),
+        "openaccessFlag": entry.get("openaccessFlag", ""),
+        "suptype": entry.get("subtypeDescription"),
+        "suptype_code": entry.get("subtype"),
+        "citedby-count": entry.get("citedby-count"),
+        "source_title": entry.get("prism:publicationName"),
+        "prism_issn": entry.get("prism:issn"),
+        "prism_isbn": entry.get("prism:isbn"),
+        "publication_date": entry.get("prism:coverDate"),
+        "pii": entry.get("pii"),
+        "pubmed-id": entry.get("pubmed-id"),
+        "orcid": entry.get("orcid"),
+        "title": entry.get("dc:title")
+    }
+
+def iter_pages(headers: dict, url: str, query: str, subject: str, scopus_api: str, research_length: int, chunk: int, first_start: int = 0):
     """
-    Retrieves papers from the Scopus API based on the provided query and subject.
-    Loops through the results in chunks of 'chunk' until it reaches the total number of results.
-    Extracts relevant information from each entry in the chunk and appends it to a list.    
+    Generator yielding (start, papers) for each page of results, from 'first_start' until the total number of results.
+    Only one page is held in memory at a time.
     """
-    papers = []
-    retrieved = 0
-    # Loop through the results in chunks of 'chunk' until we reach the total number of results
-    for start in range(0, research_length, chunk):
+    for start in range(first_start, research_length, chunk):
         params = {
         "query": query,
         "subj" : subject,
@@ -48,38 +80,92 @@ def get_papers(headers: dict, url: str, query: str, subject: str, scopus_api: st
         "httpAccept": "application/json"
         }
 
-        response = requests.get(url, headers=headers, params=params)
+        with METRICS.timer("http_request_seconds", host=urlparse(url).netloc):
+            response = requests.get(url, headers=headers, params=params)
+        METRICS.observe("http_response_bytes", len(response.content), host=urlparse(url).netloc)
         if response.status_code != 200:
             raise Exception(f"Scopus API request failed with status code {response.status_code}: {response.text}")
         data = response.json()
-        retrieved += len(data.get("search-results", {}).get("entry", []))
-        logging.info(f"Retrieved {retrieved} / {research_length} from Scopus API.")
 
         # Extract relevant information from each entry in the chunk
-        for entry in data.get("search-results", {}).get("entry", []):
-            papers.append({
-                "eid": entry.get("eid"),
-                "scopus_id": entry.get("dc:identifier"),
-                "first_author": entry.get("dc:creator"),
-                "content_retrieval_uri": entry.get("prism:url"),
-                "prism_doi": entry.get("prism:doi", ""),
-                "link_self": entry.get("link")[0].get("@href"),
-                "link_author_affiliation": entry.get("link")[1].get("@href"),
-                "link_scopus": entry.get("link")[2].get("@href"),
-                "open_access": entry.get("openaccess", ""),
-                "openaccessFlag": entry.get("openaccessFlag", ""),
-                "suptype": entry.get("subtypeDescription"),
-                "suptype_code": entry.get("subtype"),
-                "citedby-count": entry.get("citedby-count"),
-                "source_title": entry.get("prism:publicationName"),
-                "prism_issn": entry.get("prism:issn"),
-                "prism_isbn": entry.get("prism:isbn"),
-                "publication_date": entry.get("prism:coverDate"),
-                "pii": entry.get("pii"),
-                "pubmed-id": entry.get("pubmed-id"),
-                "orcid": entry.get("orcid"),
-                "title": entry.get("dc:title")
-            })
+        entries = data.get("search-results", {}).get("entry", [])
+        yield start, [entry_to_paper(entry) for entry in entries]
+
+def get_papers(headers: dict, url: str, query: str, subject: str, scopus_api: str, research_length: int, chunk: int) -> list:
+    """
+    Retrieves papers from the Scopus API based on the provided query and subject.
+    Loops through the results in chunks of 'chunk' until it reaches the total number of results.
+    Extracts relevant information from each entry in the chunk and appends it to a list.
+    Use harvest_to_db to write the pages to the database as they arrive instead.
+    """
+    papers = []
+    for start, page in iter_pages(headers, url, query, subject, scopus_api, research_length, chunk):
+        papers.extend(page)
+        logging.info(f"Retrieved {len(papers)} / {research_length} from Scopus API.")
+    return papers
+
+async def fetch_page_async(client: httpx.AsyncClient, limiter: TokenBucket, url: str, params: dict, max_retries: int = 5) -> dict:
+    """
+    Fetches one page of Scopus search results through the shared client.
+    Every attempt waits for a token from 'limiter'. 429 and 5xx responses are retried with backoff.
+    """
+    response = await get_with_retries(client, limiter, url, params, max_retries)
+    if response.status_code != 200:
+        raise Exception(f"Scopus API request failed with status code {response.status_code}: {response.text}")
+    return response.json()
+
+async def iter_pages_async(headers: dict, url: str, query: str, subject: str, scopus_api: str, research_length: int, chunk: int,
+                           first_start: int = 0, concurrency: int = 5, requests_per_second: float = 9.0):
+    """
+    Async generator yielding (start, papers) for every page of the query, in offset order.
+    Since research_length is known in advance, all page offsets are known too: up to 'concurrency' pages
+    are requested at the same time over one pooled client, paced by a token bucket that follows the Scopus quota headers.
+    Only 'concurrency' pages are held at any time, so memory does not grow with the size of the result.
+    The Scopus search API allows 9 requests per second by default, see https://dev.elsevier.com/api_key_settings.html
+    """
+    limiter = TokenBucket(requests_per_second)
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    starts = iter(range(first_start, research_length, chunk))
+    pending = deque()
+
+    async with httpx.AsyncClient(headers=headers, limits=limits, timeout=60) as client:
+        def schedule(start: int):
+            params = {
+                "query": query,
+                "subj": subject,
+                "count": chunk,
+                "start": start,
+                "apiKey": scopus_api,
+                "httpAccept": "application/json"
+            }
+            pending.append((start, asyncio.create_task(fetch_page_async(client, limiter, url, params))))
+
+        for start in islice(starts, concurrency):
+            schedule(start)
+        try:
+            while pending:
+                start, task = pending.popleft()
+                data = await task
+                next_start = next(starts, None)
+                if next_start is not None:
+                    schedule(next_start)
+                entries = data.get("search-results", {}).get("entry", [])
+                yield start, [entry_to_paper(entry) for entry in entries]
+        finally:
+            for _, task in pending:
+                task.cancel()
+
+async def get_papers_async(headers: dict, url: str, query: str, subject: str, scopus_api: str, research_length: int, chunk: int,
+                           concurrency: int = 5, requests_per_second: float = 9.0) -> list:
+    """
+    Async version of get_papers. Pages are fetched concurrently (see iter_pages_async)
+    but the returned list is in the same order as with get_papers.
+    """
+    papers = []
+    async for start, page in iter_pages_async(headers, url, query, subject, scopus_api, research_length, chunk,
+                                              concurrency=concurrency, requests_per_second=requests_per_second):
+        papers.extend(page)
+        logging.info(f"Retrieved {len(papers)} / {research_length} from Scopus API.")
     return papers
 
 def save_papers_to_csv(papers: list, csv_file_name: str):
@@ -96,93 +182,140 @@ def save_papers_to_csv(papers: list, csv_file_name: str):
 
 
 def create_db(db_file_name:str):
-    """Create a SQLite database and a table for storing paper information."""
-    conn = sqlite3.connect(db_file_name)
-    c = conn.cursor()
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS papers (
-            eid TEXT PRIMARY KEY,
-            scopus_id TEXT,
-            first_author TEXT,
-            content_retrieval_uri TEXT,
-            prism_doi TEXT,
-            link_self TEXT,
-            link_author_affiliation TEXT,
-            link_scopus TEXT,
-            open_access TEXT,
-            openaccessFlag BOOLEAN,
-            suptype TEXT,
-            suptype_code TEXT,
-            citedby_count INTEGER,
-            source_title TEXT,
-            prism_issn TEXT,
-            prism_isbn TEXT,
-            publication_date DATE,
-            pii TEXT,
-            pubmed_id TEXT,
-            orcid TEXT,
-            title TEXT)
-    ''')
-    conn.commit()
-    conn.close()
+    """Create the SQLite database (papers and harvest progress tables) or bring its schema up to date, see app.storage."""
+    init_db(db_file_name)
+
+PAPER_COLUMNS = (
+    "eid",
+    "scopus_id",
+    "first_author",
+    "content_retrieval_uri",
+    "prism_doi",
+    "link_self",
+    "link_author_affiliation",
+    "link_scopus",
+    "open_access",
+    "openaccessFlag",
+    "suptype",
+    "suptype_code",
+    "citedby_count",
+    "source_title",
+    "prism_issn",
+    "prism_isbn",
+    "publication_date",
+    "pii",
+    "pubmed_id",
+    "orcid",
+    "title",
+)
+
+def paper_to_row(paper: dict) -> tuple:
+    """Orders the values of a paper dict as PAPER_COLUMNS."""
+    return (
+        paper["eid"],
+        paper["scopus_id"],
+        paper["first_author"],
+        paper["content_retrieval_uri"],
+        paper["prism_doi"],
+        paper["link_self"],
+        paper["link_author_affiliation"],
+        paper["link_scopus"],
+        paper["open_access"],
+        paper["openaccessFlag"],
+        paper["suptype"],
+        paper["suptype_code"],
+        paper["citedby-count"],
+        paper["source_title"],
+        paper["prism_issn"],
+        paper["prism_isbn"],
+        paper["publication_date"],
+        paper["pii"],
+        paper["pubmed-id"],
+        paper["orcid"],
+        paper["title"]
+    )
 
 def insert_papers_to_db(db_file_name:str, papers:list):
-    """Insert a list of papers into the SQLite database."""
-    conn = sqlite3.connect(db_file_name)
-    c = conn.cursor()
+    """
+    Insert a list of papers into the SQLite database.
+    Papers already in the database are updated, keeping their abstract and screening decision.
+    """
+    conn = connect(db_file_name)
     try:
-        for paper in papers:
-            c.execute('''
-                INSERT OR REPLACE INTO papers (eid,
-                scopus_id,
-                first_author,
-                content_retrieval_uri,
-                prism_doi,
-                link_self,
-                link_author_affiliation,
-                link_scopus,
-                open_access,
-                openaccessFlag,
-                suptype,
-                suptype_code,
-                citedby_count,
-                source_title,
-                prism_issn,
-                publication_date,
-                pii,
-                pubmed_id,
-                orcid,
-                title
-                )
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (
-                paper["eid"],
-                paper["scopus_id"],
-                paper["first_author"],
-                paper["content_retrieval_uri"],
-                paper["prism_doi"],
-                paper["link_self"],
-                paper["link_author_affiliation"],
-                paper["link_scopus"],
-                paper["open_access"],
-                paper["openaccessFlag"],
-                paper["suptype"],
-                paper["suptype_code"],
-                paper["citedby-count"],
-                paper["source_title"],
-                paper["prism_issn"],
-                paper["publication_date"],
-                paper["pii"],
-                paper["pubmed-id"],
-                paper["orcid"],
-                paper["title"]
-            )
-            )
-        conn.commit()
+        with conn:
+            upsert_rows(conn, "papers", PAPER_COLUMNS, map(paper_to_row, papers))
         logging.info(f"Saved {len(papers)} papers to {db_file_name}")
     finally:
         conn.close()
-    
+
+def get_next_start(conn: sqlite3.Connection, query: str, subject: str) -> int:
+    """Returns the offset where the harvest of (query, subject) should continue, 0 if it never ran."""
+    row = conn.execute(
+        "SELECT next_start FROM harvest_progress WHERE query = ? AND subject = ?", (query, subject)
+    ).fetchone()
+    return row[0] if row else 0
+
+def save_page(conn: sqlite3.Connection, query: str, subject: str, start: int, chunk: int, research_length: int, papers: list):
+    """
+    Writes one page of papers and moves the progress cursor past it, in a single transaction.
+    Either both land or neither does, so a crash never leaves the cursor ahead of the data.
+    Papers already stored under another EID (same DOI or title, see corpus.dedupe_page) are not written twice.
+    """
+    with sqlite_write("harvest_page", len(papers)), conn:
+        upsert_rows(conn, "papers", PAPER_COLUMNS, map(paper_to_row, dedupe_page(conn, papers, query)))
+        conn.execute('''
+            INSERT INTO harvest_progress (query, subject, next_start, research_length, updated_at)
+            VALUES (?, ?, ?, ?, datetime('now'))
+            ON CONFLICT(query, subject) DO UPDATE SET
+                next_start = excluded.next_start,
+                research_length = excluded.research_length,
+                updated_at = excluded.updated_at
+        ''', (query, subject, start + chunk, research_length))
+
+def _resume_offset(conn: sqlite3.Connection, query: str, subject: str, research_length: int) -> int:
+    index_corpus(conn)
+    first_start = get_next_start(conn, query, subject)
+    if first_start >= research_length:
+        logging.info(f"Harvest already complete ({research_length} results), nothing to fetch.")
+    elif first_start > 0:
+        logging.info(f"Resuming harvest at start={first_start} / {research_length}.")
+    return first_start
+
+def harvest_to_db(db_file_name: str, headers: dict, url: str, query: str, subject: str, scopus_api: str, research_length: int, chunk: int):
+    """
+    Streams the query results page by page into the database instead of building the full list in memory.
+    Each page is bulk inserted in its own transaction and the progress cursor (harvest_progress) records
+    the next offset to fetch, so an interrupted harvest resumes where it stopped instead of starting over.
+    Pages are fetched one at a time; see harvest_to_db_async for the concurrent version.
+    """
+    conn = open_db(db_file_name)
+    try:
+        first_start = _resume_offset(conn, query, subject, research_length)
+        retrieved = first_start
+        for start, papers in iter_pages(headers, url, query, subject, scopus_api, research_length, chunk, first_start):
+            save_page(conn, query, subject, start, chunk, research_length, papers)
+            retrieved += len(papers)
+            logging.info(f"Saved {retrieved} / {research_length} papers to {db_file_name}")
+    finally:
+        conn.close()
+
+async def harvest_to_db_async(db_file_name: str, headers: dict, url: str, query: str, subject: str, scopus_api: str, research_length: int, chunk: int,
+                              concurrency: int = 5, requests_per_second: float = 9.0):
+    """
+    Same as harvest_to_db, but pages are fetched concurrently with iter_pages_async.
+    Pages still arrive in offset order, so the cursor only ever moves past pages that are already stored.
+    """
+    conn = open_db(db_file_name)
+    try:
+        first_start = _resume_offset(conn, query, subject, research_length)
+        retrieved = first_start
+        async for start, papers in iter_pages_async(headers, url, query, subject, scopus_api, research_length, chunk,
+                                                    first_start, concurrency, requests_per_second):
+            save_page(conn, query, subject, start, chunk, research_length, papers)
+            retrieved += len(papers)
+            logging.info(f"Saved {retrieved} / {research_length} papers to {db_file_name}")
+    finally:
+        conn.close()
 
 
 if __name__ == "__main__":
@@ -200,9 +333,14 @@ if __name__ == "__main__":
     subject = "SOCI"  # Sociology subject area
     csv_file_name = "scopus_results.csv" # Use if you want to save the results to a CSV file
     db_file_name = "scopus_results_2.db"
+    master_db_file_name = "master_corpus.db" # every query is merged into this one, see corpus.merge_db
+    use_async = True # fetch pages concurrently (see iter_pages_async)
+    concurrency = 5 # max number of pages in flight when use_async is True
+    save_at_exit(Path(__file__).parent.parent / "run_metrics.db") # timings, sizes, retries, tokens and cost of the run, see app.instrumentation
 
     # Some more static config    
     db_path = Path(__file__).parent.parent / db_file_name
+    master_db_path = Path(__file__).parent.parent / master_db_file_name
     headers = {
         "X-ELS-APIKey": scopus_api,
         "Accept": "application/json"
@@ -210,11 +348,18 @@ if __name__ == "__main__":
 
     #run the functions
     research_lenght = get_research_length(headers, url, query, subject, scopus_api)
-    papers = get_papers(headers, url, query, subject, scopus_api, research_lenght, chunk)
     # if you want to save the results to a CSV file
+    #papers = get_papers(headers, url, query, subject, scopus_api, research_lenght, chunk)
     #save_papers_to_csv(papers, csv_file_name)
 
     # If you want to save the results to a SQLite database
     # Create a SQLite database and a table for storing paper information
     create_db(db_path)
-    insert_papers_to_db(db_path, papers)
\ No newline at end of file
+    # Stream the pages into the database. Rerunning after an interruption resumes from the last saved page
+    if use_async:
+        asyncio.run(harvest_to_db_async(db_path, headers, url, query, subject, scopus_api, research_lenght, chunk, concurrency))
+    else:
+        harvest_to_db(db_path, headers, url, query, subject, scopus_api, research_lenght, chunk)
+
+    # Consolidate this query's papers into the master corpus, which records which queries found each paper
+    merge_db(master_db_path, db_path, query)
@@ -0,0 +1,240 @@
+import atexit
+import bisect
+import cProfile
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+# Bucket upper bounds by unit, picked from the metric name's suffix (Prometheus naming)
+BUCKETS = {
+    "_seconds": (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120),
+    "_bytes": tuple(1024 * 4 ** i for i in range(10)),
+    "_tokens": (100, 250, 500, 1000, 2000, 4000, 8000, 16000, 32000, 64000, 128000),
+    "_usd": (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1),
+    "_rows": (1, 10, 50, 100, 500, 1000, 5000, 10000),
+    "_pages": (1, 5, 10, 20, 50, 100, 200, 500),
+}
+# USD per million tokens: (input, cached input, output), see https://openai.com/api/pricing
+MODEL_PRICES = {
+    "gpt-4.1": (2.00, 0.50, 8.00),
+    "gpt-4.1-mini": (0.40, 0.10, 1.60),
+    "gpt-4.1-nano": (0.10, 0.025, 0.40),
+    "gpt-4o": (2.50, 1.25, 10.00),
+    "gpt-4o-mini": (0.15, 0.075, 0.60),
+}
+
+
+def estimate_cost(model: str, input_tokens: int, cached_tokens: int, output_tokens: int) -> Optional[float]:
+    """
+    Estimated USD cost of a call, None for a model without a known price. Cached input tokens are billed at the cached rate.
+    Cascade calls mix two prices, their cost is recorded per model by RunMetrics.record_cascade.
+    """
+    if model.startswith("cascade:"):
+        return None
+    name = model.split(":")[-1]
+    prices = MODEL_PRICES.get(name) or next((p for m, p in MODEL_PRICES.items() if name.startswith(f"{m}-20")), None)
+    if prices is None:
+        return None
+    input_price, cached_price, output_price = prices
+    return ((input_tokens - cached_tokens) * input_price + cached_tokens * cached_price + output_tokens * output_price) / 1e6
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Histogram:
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+
+class Metrics:
+    """
+    Process-wide histograms and counters, keyed by name and labels. The stages record into the METRICS instance:
+    HTTP requests (app.extract_papers.rate_limit), SQLite writes (app.storage and the writers), PDF parsing
+    (app.coding.pdf_text) and model calls (app.run_metrics). Export with write_prometheus or write_table.
+    """
+
+    def __init__(self):
+        self.histograms: Dict[Tuple[str, tuple], Histogram] = {}
+        self.counters: Dict[Tuple[str, tuple], float] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(name: str, labels: dict) -> Tuple[str, tuple]:
+        return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+    def observe(self, name: str, value: float, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            if key not in self.histograms:
+                buckets = next((b for suffix, b in BUCKETS.items() if name.endswith(suffix)), BUCKETS["_seconds"])
+                self.histograms[key] = Histogram(buckets)
+            self.histograms[key].observe(value)
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    @contextmanager
+    def timer(self, name: str, **labels):
+        """Observes the seconds the block took, also when it raises."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def reset(self):
+        with self._lock:
+            self.histograms.clear()
+            self.counters.clear()
+
+    def prometheus_text(self) -> str:
+        """The metrics in the Prometheus text exposition format."""
+        def fmt(labels: tuple, extra: tuple = ()) -> str:
+            items = labels + extra
+            if not items:
+                return ""
+            return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in items) + "}"
+
+        lines = []
+        with self._lock:
+            typed = set()
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                if name not in typed:
+                    lines.append(f"# TYPE {name} histogram")
+                    typed.add(name)
+                cumulative = 0
+                for bound, count in zip(list(histogram.buckets) + ["+Inf"], histogram.counts):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{fmt(labels, (('le', bound),))} {cumulative}")
+                lines.append(f"{name}_sum{fmt(labels)} {histogram.sum}")
+                lines.append(f"{name}_count{fmt(labels)} {histogram.count}")
+            for (name, labels), value in sorted(self.counters.items()):
+                if name not in typed:
+                    lines.append(f"# TYPE {name} counter")
+                    typed.add(name)
+                lines.append(f"{name}{fmt(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path: Path):
+        """Writes the text file atomically, for node_exporter's textfile collector or a manual look."""
+        path = Path(path)
+        tmp = path.with_suffix(path.suffix + ".tmp")
+        tmp.write_text(self.prometheus_text(), encoding="utf-8")
+        os.replace(tmp, path)
+
+    def write_table(self, db_path: str, run_id: Optional[str] = None) -> str:
+        """Appends a snapshot of every histogram and counter to the instrumentation table of db_path. Returns the run_id."""
+        from app.storage import connect
+        run_id = run_id or uuid.uuid4().hex[:12]
+        now = time.time()
+        with self._lock:
+            rows = [(run_id, name, json.dumps(dict(labels)), "histogram", h.count, h.sum,
+                     json.dumps(dict(zip([str(b) for b in h.buckets] + ["+Inf"], h.counts))), now)
+                    for (name, labels), h in self.histograms.items()]
+            rows += [(run_id, name, json.dumps(dict(labels)), "counter", None, value, None, now)
+                     for (name, labels), value in self.counters.items()]
+        conn = connect(db_path)
+        try:
+            with conn:
+                conn.execute('''
+                    CREATE TABLE IF NOT EXISTS instrumentation (
+                        run_id TEXT,
+                        name TEXT,
+                        labels TEXT,
+                        kind TEXT,
+                        count INTEGER,
+                        sum REAL,
+                        buckets TEXT,
+                        created_at REAL)
+                ''')
+                conn.executemany("INSERT INTO instrumentation VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+        finally:
+            conn.close()
+        return run_id
+
+    def log_summary(self):
+        """Count, total and mean of every histogram, and the counters."""
+        with self._lock:
+            for (name, labels), h in sorted(self.histograms.items()):
+                logging.info(f"{name} {dict(labels)}: count={h.count} sum={h.sum:.3f} mean={h.sum / h.count if h.count else 0:.4f}")
+            for (name, labels), value in sorted(self.counters.items()):
+                logging.info(f"{name} {dict(labels)}: {value}")
+
+
+METRICS = Metrics()
+
+
+def save_instrumentation(db_path: str, prometheus_path: Optional[Path] = None) -> Optional[str]:
+    """Logs METRICS and appends them to the instrumentation table of db_path (and the Prometheus file). Returns the run_id."""
+    if not METRICS.histograms and not METRICS.counters:
+        return None
+    METRICS.log_summary()
+    run_id = METRICS.write_table(str(db_path))
+    if prometheus_path is not None:
+        METRICS.write_prometheus(prometheus_path)
+    logging.info(f"Instrumentation of run {run_id} saved to the instrumentation table of {db_path}")
+    return run_id
+
+
+def save_at_exit(db_path: str, prometheus_path: Optional[Path] = None):
+    """For the scripts run on their own: saves METRICS (see save_instrumentation) when the script ends, also after an error."""
+    atexit.register(save_instrumentation, db_path, prometheus_path)
+
+
+@contextmanager
+def sqlite_write(op: str, rows: int):
+    """Times one write transaction: sqlite_write_seconds and sqlite_write_rows, labelled with what is written."""
+    with METRICS.timer("sqlite_write_seconds", op=op):
+        yield
+    METRICS.observe("sqlite_write_rows", rows, op=op)
+
+
+@contextmanager
+def profile_stage(name: str, out_dir: Optional[Path] = None, profiler: str = "cprofile"):
+    """
+    Profiles the block when out_dir is set: with cProfile into <out_dir>/<name>.prof (open with snakeviz or pstats),
+    or with pyinstrument (if installed) into <out_dir>/<name>.html. Does nothing otherwise.
+    In a process running several stages at once the profile also shows what the others did meanwhile,
+    so profile a stage on its own for a clean picture.
+    """
+    if out_dir is None:
+        yield
+        return
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    if profiler == "pyinstrument":
+        from pyinstrument import Profiler
+        pyinstrument_profiler = Profiler(async_mode="enabled")
+        pyinstrument_profiler.start()
+        try:
+            yield
+        finally:
+            pyinstrument_profiler.stop()
+            (out_dir / f"{name}.html").write_text(pyinstrument_profiler.output_html(), encoding="utf-8")
+        return
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        yield
+    finally:
+        profile.disable()
+        profile.dump_stats(str(out_dir / f"{name}.prof"))
+        logging.info(f"Profile of {name} written to {out_dir / f'{name}.prof'}")
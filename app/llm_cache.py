@@ -0,0 +1,189 @@
+import functools
+import hashlib
+import json
+import logging
+import time
+from contextvars import ContextVar
+from typing import Any, Optional
+from pydantic import BaseModel
+from pydantic_ai import Agent
+from pydantic_ai.usage import Usage
+from app.storage import connect
+
+
+def _sha256(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+@functools.lru_cache(maxsize=None)
+def _schema_hash(output_type: type[BaseModel]) -> str:
+    return _sha256(json.dumps(output_type.model_json_schema(), sort_keys=True))
+
+
+def _override_model(agent):
+    """
+    The model set with agent.override(model=...) in the current context, None if there is none.
+    pydantic-ai keeps Some(model), in a plain attribute up to 0.2 and in a ContextVar after;
+    a CachedAgent is overridden through the Agent it wraps.
+    """
+    if isinstance(agent, CachedAgent):
+        return _override_model(agent.agent)
+    override = getattr(agent, "_override_model", None)
+    if isinstance(override, ContextVar):
+        override = override.get()
+    return getattr(override, "value", None)
+
+
+def agent_model_name(agent) -> str:
+    """
+    Name of the model an Agent (or CachedAgent) runs with, e.g. 'openai:gpt-4.1'.
+    Under agent.override(model=TestModel()) it is the test model's, so offline runs are neither recorded
+    nor cached under the production model.
+    """
+    model = _override_model(agent) or agent.model
+    if model is None or isinstance(model, str):
+        return str(model)
+    return f"{model.system}:{model.model_name}"
+
+
+class ResponseCache:
+    """
+    Persistent, content-addressed cache of validated agent outputs, stored in SQLite.
+    Entries are keyed on (model, instructions hash, output schema hash, input text hash), so changing any of them
+    is a miss. Old or excess entries are removed with evict(), least recently used first.
+    """
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self.hits = 0
+        self.misses = 0
+        self.conn = connect(db_path)
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS llm_cache (
+                key TEXT PRIMARY KEY,
+                model TEXT,
+                output_json TEXT,
+                size INTEGER,
+                created_at REAL,
+                last_used_at REAL)
+        ''')
+        self.conn.commit()
+
+    @staticmethod
+    def make_key(model: str, instructions: str, output_type: type[BaseModel], input_text: str) -> str:
+        return _sha256("\n".join([model, _sha256(instructions), _schema_hash(output_type), _sha256(input_text)]))
+
+    def get(self, key: str, output_type: type[BaseModel]) -> Optional[BaseModel]:
+        """Returns the cached output validated as output_type, None (and a miss) if there is none."""
+        row = self.conn.execute("SELECT output_json FROM llm_cache WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.conn.execute("UPDATE llm_cache SET last_used_at = ? WHERE key = ?", (time.time(), key))
+        self.conn.commit()
+        return output_type.model_validate_json(row[0])
+
+    def put(self, key: str, model: str, output: BaseModel):
+        output_json = output.model_dump_json()
+        now = time.time()
+        self.conn.execute(
+            "INSERT OR REPLACE INTO llm_cache (key, model, output_json, size, created_at, last_used_at) VALUES (?, ?, ?, ?, ?, ?)",
+            (key, model, output_json, len(output_json), now, now)
+        )
+        self.conn.commit()
+
+    def evict(self, max_age_days: Optional[float] = None, max_entries: Optional[int] = None, max_bytes: Optional[int] = None) -> int:
+        """
+        Deletes entries older than max_age_days, then the least recently used entries
+        until there are at most max_entries and their outputs take at most max_bytes. Returns the number deleted.
+        """
+        deleted = 0
+        with self.conn:
+            if max_age_days is not None:
+                cutoff = time.time() - max_age_days * 86400
+                deleted += self.conn.execute("DELETE FROM llm_cache WHERE created_at < ?", (cutoff,)).rowcount
+            if max_entries is not None:
+                deleted += self.conn.execute('''
+                    DELETE FROM llm_cache WHERE key IN (
+                        SELECT key FROM llm_cache ORDER BY last_used_at DESC LIMIT -1 OFFSET ?)
+                ''', (max_entries,)).rowcount
+            if max_bytes is not None:
+                deleted += self.conn.execute('''
+                    DELETE FROM llm_cache WHERE key IN (
+                        SELECT key FROM (
+                            SELECT key, SUM(size) OVER (ORDER BY last_used_at DESC) AS running_size FROM llm_cache)
+                        WHERE running_size > ?)
+                ''', (max_bytes,)).rowcount
+        if deleted:
+            logging.info(f"Evicted {deleted} entries from the LLM cache.")
+        return deleted
+
+    def stats(self) -> dict:
+        entries, size = self.conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM llm_cache").fetchone()
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "entries": entries,
+            "bytes": size,
+        }
+
+    def close(self):
+        self.conn.close()
+
+
+class CachedResult:
+    """Stands in for an AgentRunResult when the output comes from the cache: no request was made, so usage is zero."""
+
+    def __init__(self, output: BaseModel):
+        self.output = output
+
+    def usage(self) -> Usage:
+        return Usage()
+
+
+class CachedAgent:
+    """
+    Puts a ResponseCache in front of a pydantic-ai Agent. run/run_sync have the same signature as the Agent's,
+    and on a hit return the validated output without any network round trip.
+    'instructions' must be the text the agent was built with, since it is part of the key.
+    The input text of the key is the user prompt plus the deps, so dynamic system prompts built from deps are covered.
+    """
+
+    def __init__(self, agent: Agent, cache: ResponseCache, instructions: str, output_type: Optional[type[BaseModel]] = None):
+        self.agent = agent
+        self.cache = cache
+        self.instructions = instructions
+        self.output_type = output_type or agent.output_type
+
+    @property
+    def model(self):
+        return self.agent.model
+
+    def _key(self, user_prompt: str, deps: Any) -> tuple[str, str]:
+        if isinstance(deps, BaseModel):
+            deps_text = deps.model_dump_json()
+        else:
+            deps_text = "" if deps is None else repr(deps)
+        model = agent_model_name(self.agent)
+        return self.cache.make_key(model, self.instructions, self.output_type, f"{user_prompt}\n{deps_text}"), model
+
+    async def run(self, user_prompt: str, deps: Any = None, **kwargs):
+        key, model = self._key(user_prompt, deps)
+        output = self.cache.get(key, self.output_type)
+        if output is not None:
+            return CachedResult(output)
+        result = await self.agent.run(user_prompt, deps=deps, **kwargs)
+        self.cache.put(key, model, result.output)
+        return result
+
+    def run_sync(self, user_prompt: str, deps: Any = None, **kwargs):
+        key, model = self._key(user_prompt, deps)
+        output = self.cache.get(key, self.output_type)
+        if output is not None:
+            return CachedResult(output)
+        result = self.agent.run_sync(user_prompt, deps=deps, **kwargs)
+        self.cache.put(key, model, result.output)
+        return result
@@ -0,0 +1,288 @@
+import argparse
+import asyncio
+import logging
+import os
+from pathlib import Path
+from typing import Dict, List, Optional
+from dotenv import load_dotenv
+from app.coding.pdf_text import PdfTextCache, extract_texts
+from app.coding.results_store import ResultsStore, export_results, import_results_csv
+from app.coding.runner import CODING_INSTRUCTIONS, build_coding_agent, code_documents_async
+from app.embedding_index import EmbeddingIndex, default_embedder
+from app.extract_papers.analyses_abstracts import build_agent
+from app.extract_papers.corpus import merge_db, prefill_from_master
+from app.extract_papers.fulltext import FINAL_STATUSES, fetch_fulltexts_async, fetched_paths, fulltext_eids, get_pending_fulltexts
+from app.extract_papers.prescreen import prescreen
+from app.extract_papers.retrieves_abstracts import retrieve_abstracts_async
+from app.extract_papers.screening_engine import count_papers_to_screen, prompt_hash, screen_papers_async
+from app.extract_papers.search_basic_info import get_next_start, get_research_length, harvest_to_db_async
+from app.instrumentation import save_instrumentation
+from app.llm_cache import CachedAgent, ResponseCache, agent_model_name
+from app.pipeline import Stage, run_pipeline
+from app.run_metrics import RunMetrics
+from app.storage import connect, init_db
+
+APP_DIR = Path(__file__).parent
+SEARCH_URL = "https://api.elsevier.com/content/search/scopus"
+STAGES = ["harvest", "abstracts", "screen", "fetch", "extract", "code", "export"]
+DEFAULT_WORKERS = {"harvest": 5, "abstracts": 8, "screen": 10, "fetch": 8, "extract": os.cpu_count() or 1, "code": 4, "export": 1}
+
+
+def _count(db_path: str, sql: str, params: tuple = ()) -> int:
+    conn = connect(db_path)
+    try:
+        return conn.execute(sql, params).fetchone()[0]
+    finally:
+        conn.close()
+
+
+def _extracted_paths(pdf_cache_path: str) -> set:
+    conn = connect(pdf_cache_path)
+    try:
+        return {row[0] for row in conn.execute("SELECT path FROM pdf_text")}
+    finally:
+        conn.close()
+
+
+def build_stages(args: argparse.Namespace, workers: Dict[str, int], headers: dict, cache: ResponseCache,
+                 metrics: Dict[str, RunMetrics]) -> List[Stage]:
+    """The stages of the pipeline, each one reading its input from the rows the previous one wrote."""
+    db_path = str(args.db)
+    stages = []
+
+    research_length: Optional[int] = None
+
+    async def harvest() -> int:
+        nonlocal research_length
+        if research_length is None:
+            research_length = await asyncio.to_thread(get_research_length, headers, SEARCH_URL, args.query, args.subject, headers["X-ELS-APIKey"])
+        before = _count(db_path, "SELECT COUNT(*) FROM papers")
+        await harvest_to_db_async(db_path, headers, SEARCH_URL, args.query, args.subject, headers["X-ELS-APIKey"], research_length,
+                                  args.chunk, workers["harvest"])
+        return _count(db_path, "SELECT COUNT(*) FROM papers") - before
+
+    def harvest_pending() -> int:
+        if research_length is None:
+            return 0
+        conn = connect(db_path)
+        try:
+            return max(0, research_length - get_next_start(conn, args.query, args.subject))
+        finally:
+            conn.close()
+
+    stages.append(Stage("harvest", harvest, harvest_pending, lambda: _count(db_path, "SELECT COUNT(*) FROM papers"),
+                        workers=workers["harvest"]))
+
+    async def abstracts() -> int:
+        # Abstracts the master corpus already has for other queries are copied instead of fetched
+        await asyncio.to_thread(prefill_from_master, db_path, args.master_db)
+        return await retrieve_abstracts_async(db_path, headers, workers["abstracts"])
+
+    stages.append(Stage("abstracts", abstracts,
+                        lambda: _count(db_path, "SELECT COUNT(*) FROM papers WHERE abstract IS NULL"),
+                        lambda: _count(db_path, "SELECT COUNT(*) FROM papers WHERE abstract IS NOT NULL"),
+                        ["harvest"], workers["abstracts"]))
+
+    # The agents are only built for the stages that run: building one needs the provider's API key
+    if "screen" in args.stages:
+        instructions_text = Path(args.instructions).read_text(encoding="utf-8")
+        screening_agent = CachedAgent(build_agent(instructions_text, args.screening_model), cache, instructions_text)
+        screening_hash = prompt_hash(instructions_text)
+        screening_model = agent_model_name(screening_agent)
+
+        prescreened = False
+
+        async def screen() -> int:
+            nonlocal prescreened
+            # Over the whole corpus, so only once: with --prescreen the stage starts after the abstracts are all in
+            if args.prescreen and not prescreened:
+                await asyncio.to_thread(prescreen, db_path, instructions_text)
+                prescreened = True
+            return await screen_papers_async(db_path, screening_agent, prompt_hash=screening_hash, concurrency=workers["screen"],
+                                             metrics=metrics["screen"])
+
+        stages.append(Stage("screen", screen,
+                            lambda: count_papers_to_screen(db_path, screening_hash, screening_model),
+                            lambda: _count(db_path, "SELECT COUNT(*) FROM papers WHERE screening_prompt_hash = ? AND screening_model = ?",
+                                           (screening_hash, screening_model)),
+                            ["abstracts"], workers["screen"], after_upstream=args.prescreen))
+
+    async def fetch() -> int:
+        fetched = await fetch_fulltexts_async(db_path, args.fulltext_dir, {"X-ELS-APIKey": headers["X-ELS-APIKey"]},
+                                              args.unpaywall_email, workers["fetch"], not args.fetch_all)
+        return len(fetched)
+
+    stages.append(Stage("fetch", fetch, lambda: len(get_pending_fulltexts(db_path, not args.fetch_all)),
+                        lambda: _count(db_path, f"SELECT COUNT(*) FROM papers WHERE fulltext_status IN ({', '.join('?' for _ in FINAL_STATUSES)})",
+                                       FINAL_STATUSES),
+                        ["screen"], workers["fetch"]))
+
+    pdf_cache_path = str(args.pdf_cache)
+    PdfTextCache(pdf_cache_path).close()
+
+    def pdfs() -> List[Path]:
+        # The PDFs placed by hand and the open-access full texts fetched so far
+        return sorted(Path(args.files_dir).glob("*.pdf")) + fetched_paths(db_path)
+
+    def to_extract() -> List[Path]:
+        extracted = _extracted_paths(pdf_cache_path)
+        return [path for path in pdfs() if str(path) not in extracted]
+
+    async def extract() -> int:
+        pending = to_extract()
+        if not pending:
+            return 0
+        return len(await asyncio.to_thread(extract_texts, pending, pdf_cache_path, workers["extract"]))
+
+    stages.append(Stage("extract", extract, lambda: len(to_extract()), lambda: len(pdfs()) - len(to_extract()),
+                        ["fetch"], workers["extract"]))
+
+    def coded() -> set:
+        store = ResultsStore(str(args.results_db))
+        try:
+            return store.coded_filenames()
+        finally:
+            store.close()
+
+    def to_code() -> List[Path]:
+        extracted = _extracted_paths(pdf_cache_path)
+        done = coded()
+        return [path for path in pdfs() if str(path) in extracted and path.name not in done]
+
+    if "code" in args.stages:
+        coding_agent = CachedAgent(build_coding_agent(model=args.coding_model), cache, CODING_INSTRUCTIONS)
+        # Loaded once, not on every round of the stage
+        passage_embedder = default_embedder() if args.top_k_passages else None
+
+        async def code() -> int:
+            text_cache = PdfTextCache(pdf_cache_path)
+            try:
+                texts = {path: text_cache.get(path) for path in to_code()}
+            finally:
+                text_cache.close()
+            texts = {path: text for path, text in texts.items() if text is not None}
+            if not texts:
+                return 0
+            store = ResultsStore(str(args.results_db))
+            passage_index = EmbeddingIndex(str(args.results_db), "passages", passage_embedder) if args.top_k_passages else None
+            try:
+                return await code_documents_async(coding_agent, texts, store, workers["code"], max_tokens=args.max_tokens,
+                                                  metrics=metrics["code"], passage_index=passage_index,
+                                                  top_k=args.top_k_passages or 3, eids=fulltext_eids(db_path))
+            finally:
+                if passage_index is not None:
+                    passage_index.close()
+                store.close()
+
+        stages.append(Stage("code", code, lambda: len(to_code()), lambda: len(coded()), ["extract"], workers["code"]))
+
+    async def export() -> int:
+        await asyncio.to_thread(export_results, str(args.results_db), args.export)
+        return 0
+
+    stages.append(Stage("export", export, lambda: 0, lambda: 0, ["code"], after_upstream=True))
+    return [stage for stage in stages if stage.name in args.stages]
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Runs the review pipeline (harvest -> abstracts -> screen -> fetch -> extract -> code -> export) over one database. "
+                    "The stages run at the same time, each one picking up the rows the previous one writes."
+    )
+    parser.add_argument("--db", type=Path, default=APP_DIR / "scopus_results_2.db", help="database of the query")
+    parser.add_argument("--stages", default=",".join(STAGES), help=f"comma separated stages to run, among {','.join(STAGES)}")
+    parser.add_argument("--workers", action="append", default=[], metavar="STAGE=N",
+                        help=f"requests / calls in flight for a stage, can be repeated. Defaults: {DEFAULT_WORKERS}")
+    parser.add_argument("--query", help="Scopus query to harvest (see search_basic_info)")
+    parser.add_argument("--subject", default="SOCI", help="Scopus subject area")
+    parser.add_argument("--chunk", type=int, default=25, help="results per search page, 200 on the institutional network")
+    parser.add_argument("--master-db", type=Path, default=APP_DIR / "master_corpus.db", help="corpus merged across queries")
+    parser.add_argument("--instructions", type=Path, default=APP_DIR.parent / "resources" / "screening_promt.txt")
+    parser.add_argument("--screening-model", default="openai:gpt-4.1")
+    parser.add_argument("--prescreen", action="store_true", help="score papers locally and drop near-duplicates before screening (the screening then waits for the abstracts stage)")
+    parser.add_argument("--fulltext-dir", type=Path, default=APP_DIR / "fulltexts", help="content-addressed store of the fetched PDFs")
+    parser.add_argument("--unpaywall-email", default=os.getenv("UNPAYWALL_EMAIL"),
+                        help="contact email for Unpaywall, needed to fetch the papers without a ScienceDirect PII")
+    parser.add_argument("--fetch-all", action="store_true", help="fetch every open-access paper, not only the included ones")
+    parser.add_argument("--files-dir", type=Path, default=APP_DIR / "files", help="PDFs to code, besides the fetched ones")
+    parser.add_argument("--coding-model", default="openai:gpt-4.1")
+    parser.add_argument("--max-tokens", type=int, default=8000, help="longer documents are coded in sections")
+    parser.add_argument("--top-k-passages", type=int, default=None,
+                        help="send only the K passages closest to each code instead of the whole document")
+    parser.add_argument("--results-db", type=Path, default=APP_DIR / "coding_results.db", help="coding results, one typed row per document")
+    parser.add_argument("--legacy-csv", type=Path, default=APP_DIR / "coding" / "policy_analysis_results.csv",
+                        help="results of the previous CSV version, imported once into an empty --results-db")
+    parser.add_argument("--export", type=Path, default=APP_DIR / "coding" / "policy_analysis_results_expanded.csv",
+                        help="export of the coding results: .csv, or .parquet / .arrow with pyarrow installed")
+    parser.add_argument("--cache", type=Path, default=APP_DIR / "llm_cache.db")
+    parser.add_argument("--pdf-cache", type=Path, default=APP_DIR / "pdf_text_cache.db")
+    parser.add_argument("--metrics", type=Path, default=APP_DIR / "run_metrics.db")
+    parser.add_argument("--prometheus-file", type=Path, default=None,
+                        help="also write the timing, size, retry, token and cost histograms in the Prometheus text format")
+    parser.add_argument("--profile", choices=STAGES, default=None,
+                        help="profile this stage (other stages running meanwhile show up too, run it alone for a clean profile)")
+    parser.add_argument("--profile-dir", type=Path, default=APP_DIR / "profiles")
+    parser.add_argument("--profiler", choices=["cprofile", "pyinstrument"], default="cprofile",
+                        help="pyinstrument needs the package installed")
+    parser.add_argument("--poll-interval", type=float, default=10.0, help="seconds a stage waits when it has nothing to do")
+    parser.add_argument("--report-interval", type=float, default=30.0, help="seconds between progress reports")
+    args = parser.parse_args(argv)
+
+    args.stages = [name.strip() for name in args.stages.split(",") if name.strip()]
+    unknown = set(args.stages) - set(STAGES)
+    if unknown:
+        parser.error(f"unknown stages: {', '.join(sorted(unknown))}")
+    if "harvest" in args.stages and not args.query:
+        parser.error("--query is required to run the harvest stage")
+    args.workers_by_stage = dict(DEFAULT_WORKERS)
+    for item in args.workers:
+        name, _, value = item.partition("=")
+        if name not in DEFAULT_WORKERS or not value.isdigit() or int(value) < 1:
+            parser.error(f"invalid --workers {item}, expected STAGE=N")
+        args.workers_by_stage[name] = int(value)
+    return args
+
+
+def main(argv: Optional[List[str]] = None):
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    # Before parsing, so the defaults read from the environment see the .env file
+    load_dotenv()
+    args = parse_args(argv)
+    headers = {
+        "X-ELS-APIKey": os.getenv("SCOPUS_API_KEY"),
+        "Accept": "application/json"
+    }
+
+    init_db(str(args.db))
+    store = ResultsStore(str(args.results_db))
+    try:
+        # Documents coded by the CSV version are not coded (and paid for) again
+        if args.legacy_csv.exists() and not store.coded_filenames():
+            import_results_csv(args.legacy_csv, store)
+    finally:
+        store.close()
+    cache = ResponseCache(args.cache)
+    metrics = {"screen": RunMetrics(args.metrics, "screening"), "code": RunMetrics(args.metrics, "coding")}
+    try:
+        stages = build_stages(args, args.workers_by_stage, headers, cache, metrics)
+        for stage in stages:
+            if stage.name == args.profile:
+                stage.profile_dir = args.profile_dir
+                stage.profiler = args.profiler
+        statuses = asyncio.run(run_pipeline(stages, args.poll_interval, args.report_interval))
+        # Consolidate this query's papers, abstracts and decisions into the master corpus
+        merge_db(args.master_db, args.db, args.query)
+        for stage_metrics in metrics.values():
+            stage_metrics.log_summary()
+        logging.info(f"LLM cache: {cache.stats()}")
+    finally:
+        save_instrumentation(str(args.metrics), args.prometheus_file)
+        for stage_metrics in metrics.values():
+            stage_metrics.close()
+        cache.close()
+    if "failed" in statuses.values():
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+import asyncio
+import logging
+import time
+from contextlib import nullcontext
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Awaitable, Callable, Dict, List, Optional
+from app.instrumentation import METRICS, profile_stage
+
+
+@dataclass
+class Stage:
+    """
+    One step of the pipeline. The stages share the database, which is also their queue:
+    - run() processes what is pending right now (with 'workers' requests / calls in flight) and returns how many items it did,
+    - pending() is the number of items waiting for it (its queue depth),
+    - completed() is the number of items it has done so far, for the throughput and ETA.
+    A stage keeps running rounds while its upstream stages are producing rows, and finishes once they are all finished
+    and a round leaves nothing it can process. With after_upstream, it only runs once its upstream stages have finished
+    (e.g. an export). With profile_dir, the stage runs under a profiler (see instrumentation.profile_stage).
+    """
+    name: str
+    run: Callable[[], Awaitable[int]]
+    pending: Callable[[], int]
+    completed: Callable[[], int]
+    upstream: List[str] = field(default_factory=list)
+    workers: int = 1
+    after_upstream: bool = False
+    profile_dir: Optional[Path] = None
+    profiler: str = "cprofile"
+
+
+class StageState:
+    def __init__(self, stage: Stage):
+        self.stage = stage
+        self.status = "waiting"
+        self.started_at: Optional[float] = None
+        self.completed_at_start = 0
+        self.finished = asyncio.Event()
+
+    def report(self) -> str:
+        depth = self.stage.pending()
+        if self.started_at is None:
+            return f"{self.stage.name}: {self.status}, {depth} queued"
+        done = self.stage.completed() - self.completed_at_start
+        elapsed = time.monotonic() - self.started_at
+        rate = done / elapsed if elapsed else 0.0
+        eta = f"{depth / rate:.0f}s" if rate and depth else "-"
+        return f"{self.stage.name}: {self.status}, {done} done, {rate:.2f}/s, {depth} queued, ETA {eta}"
+
+
+async def _run_stage(state: StageState, states: Dict[str, StageState], poll_interval: float):
+    stage = state.stage
+    upstream = [states[name] for name in stage.upstream if name in states]
+    try:
+        if stage.after_upstream:
+            for other in upstream:
+                await other.finished.wait()
+        state.status = "running"
+        state.started_at = time.monotonic()
+        state.completed_at_start = stage.completed()
+        with profile_stage(stage.name, stage.profile_dir, stage.profiler) if stage.profile_dir else nullcontext():
+            while True:
+                # Read before the round, so rows produced while it runs are picked up by the next one
+                upstream_finished = all(other.finished.is_set() for other in upstream)
+                with METRICS.timer("stage_round_seconds", stage=stage.name):
+                    processed = await stage.run()
+                METRICS.inc("stage_items_total", processed, stage=stage.name)
+                if upstream_finished and (processed == 0 or stage.pending() == 0):
+                    state.status = "finished"
+                    return
+                if processed == 0:
+                    await asyncio.sleep(poll_interval)
+    except Exception as e:
+        # Downstream stages still drain what was produced
+        logging.exception(f"Stage {stage.name} failed: {e}")
+        state.status = "failed"
+    finally:
+        state.finished.set()
+
+
+async def _report(states: Dict[str, StageState], interval: float):
+    while True:
+        await asyncio.sleep(interval)
+        logging.info("Pipeline progress:\n  " + "\n  ".join(state.report() for state in states.values()))
+
+
+async def run_pipeline(stages: List[Stage], poll_interval: float = 10.0, report_interval: float = 30.0) -> Dict[str, str]:
+    """
+    Runs the stages at the same time: each one starts consuming rows as soon as its upstream stages write them,
+    instead of waiting for them to finish. Progress (throughput, queue depth, ETA) is logged every report_interval seconds.
+    Upstream stages that are not in 'stages' count as finished. Returns the final status of every stage.
+    """
+    states = {stage.name: StageState(stage) for stage in stages}
+    reporter = asyncio.create_task(_report(states, report_interval))
+    try:
+        await asyncio.gather(*(_run_stage(state, states, poll_interval) for state in states.values()))
+    finally:
+        reporter.cancel()
+    logging.info("Pipeline finished:\n  " + "\n  ".join(state.report() for state in states.values()))
+    return {name: state.status for name, state in states.items()}
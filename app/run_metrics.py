@@ -0,0 +1,167 @@
+import logging
+import statistics
+import time
+import uuid
+from typing import Tuple
+from app.instrumentation import METRICS, estimate_cost
+from app.storage import add_columns, connect
+
+
+def usage_tokens(usage) -> Tuple[int, int, int]:
+    """
+    (input, cached input, output) tokens of a pydantic-ai Usage.
+    OpenAI reports the cached part of the prompt in details["cached_tokens"], see https://platform.openai.com/docs/guides/prompt-caching
+    """
+    input_tokens = getattr(usage, "input_tokens", None) or getattr(usage, "request_tokens", None) or 0
+    output_tokens = getattr(usage, "output_tokens", None) or getattr(usage, "response_tokens", None) or 0
+    cached_tokens = getattr(usage, "cache_read_tokens", None) or (getattr(usage, "details", None) or {}).get("cached_tokens", 0)
+    return input_tokens, cached_tokens, output_tokens
+
+
+class RunMetrics:
+    """
+    Per-call usage of one run of a stage (screening, coding...), stored in the run_metrics table.
+    record() is called after every model call, summary() gives the cache hit rate, tokens and latency of the run.
+    """
+
+    def __init__(self, db_path: str, stage: str, flush_every: int = 50):
+        self.stage = stage
+        self.run_id = uuid.uuid4().hex[:12]
+        self.flush_every = flush_every
+        self.rows = []
+        self.conn = connect(db_path)
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS run_metrics (
+                run_id TEXT,
+                stage TEXT,
+                item_id TEXT,
+                model TEXT,
+                input_tokens INTEGER,
+                cached_tokens INTEGER,
+                output_tokens INTEGER,
+                latency REAL,
+                response_cache_hit BOOLEAN,
+                created_at REAL)
+        ''')
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_run_metrics_run ON run_metrics (run_id)")
+        # Both answers of every cascade call (see app.cascade), to audit how often the small model agrees with the large one
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS cascade_decisions (
+                run_id TEXT,
+                stage TEXT,
+                item_id TEXT,
+                cheap_model TEXT,
+                cheap_output TEXT,
+                cheap_latency REAL,
+                strong_model TEXT,
+                strong_output TEXT,
+                strong_latency REAL,
+                escalated BOOLEAN,
+                agreed BOOLEAN,
+                created_at REAL)
+        ''')
+        # Cost of the one or two calls of each cascade decision, at the price of each model
+        add_columns(self.conn, "cascade_decisions", [("cost_usd", "REAL")])
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_cascade_decisions_run ON cascade_decisions (run_id)")
+        self.conn.commit()
+        self.cascade_rows = []
+
+    def record(self, item_id: str, model: str, usage, latency: float, response_cache_hit: bool = False):
+        input_tokens, cached_tokens, output_tokens = usage_tokens(usage)
+        if not response_cache_hit:
+            labels = {"stage": self.stage, "model": model}
+            METRICS.observe("llm_call_seconds", latency, **labels)
+            METRICS.observe("llm_input_tokens", input_tokens, **labels)
+            METRICS.observe("llm_cached_tokens", cached_tokens, **labels)
+            METRICS.observe("llm_output_tokens", output_tokens, **labels)
+            cost = estimate_cost(model, input_tokens, cached_tokens, output_tokens)
+            if cost is not None:
+                METRICS.observe("llm_cost_usd", cost, **labels)
+        else:
+            METRICS.inc("llm_response_cache_hits_total", stage=self.stage)
+        self.rows.append((self.run_id, self.stage, item_id, model, input_tokens, cached_tokens, output_tokens,
+                          latency, response_cache_hit, time.time()))
+        if len(self.rows) >= self.flush_every:
+            self.flush()
+
+    def record_cascade(self, item_id: str, result):
+        """Stores both answers of a CascadeResult. Call it next to record() for the calls made through a CascadeAgent."""
+        strong_output = result.strong_result.output.model_dump_json() if result.escalated else None
+        calls = [(result.cheap_model, result.cheap_result)] + ([(result.strong_model, result.strong_result)] if result.escalated else [])
+        total_cost = 0.0
+        for model, model_result in calls if not result.from_cache else []:
+            cost = estimate_cost(model, *usage_tokens(model_result.usage()))
+            if cost is not None:
+                METRICS.observe("llm_cost_usd", cost, stage=self.stage, model=model)
+                total_cost += cost
+        self.cascade_rows.append((self.run_id, self.stage, item_id, result.cheap_model, result.cheap_result.output.model_dump_json(),
+                                  result.cheap_latency, result.strong_model, strong_output, result.strong_latency,
+                                  result.escalated, result.agreed, time.time(), total_cost))
+        if len(self.cascade_rows) >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        if not self.rows and not self.cascade_rows:
+            return
+        with self.conn:
+            self.conn.executemany("INSERT INTO run_metrics VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", self.rows)
+            self.conn.executemany('''
+                INSERT INTO cascade_decisions (run_id, stage, item_id, cheap_model, cheap_output, cheap_latency, strong_model,
+                                               strong_output, strong_latency, escalated, agreed, created_at, cost_usd)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', self.cascade_rows)
+        self.rows = []
+        self.cascade_rows = []
+
+    def cascade_summary(self) -> dict:
+        """Share of cascade calls escalated to the larger model, and how often both models agreed on those."""
+        self.flush()
+        calls, escalated, agreed = self.conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(escalated), 0), COALESCE(SUM(agreed), 0) FROM cascade_decisions WHERE run_id = ?",
+            (self.run_id,)
+        ).fetchone()
+        return {
+            "cascade_calls": calls,
+            "escalation_rate": escalated / calls if calls else 0.0,
+            "agreement_rate": agreed / escalated if escalated else None,
+        }
+
+    def summary(self) -> dict:
+        self.flush()
+        rows = self.conn.execute(
+            "SELECT input_tokens, cached_tokens, output_tokens, latency, response_cache_hit, model FROM run_metrics WHERE run_id = ?",
+            (self.run_id,)
+        ).fetchall()
+        calls = [row for row in rows if not row[4]]
+        latencies = sorted(row[3] for row in calls)
+        input_tokens = sum(row[0] for row in calls)
+        cached_tokens = sum(row[1] for row in calls)
+        costs = [estimate_cost(row[5], row[0], row[1], row[2]) for row in calls]
+        # Cascade calls are priced per model when recorded, see record_cascade
+        cascade_cost = self.conn.execute("SELECT COALESCE(SUM(cost_usd), 0) FROM cascade_decisions WHERE run_id = ?",
+                                         (self.run_id,)).fetchone()[0]
+        return {
+            "stage": self.stage,
+            "run_id": self.run_id,
+            "items": len(rows),
+            "response_cache_hits": len(rows) - len(calls),
+            "model_calls": len(calls),
+            "input_tokens": input_tokens,
+            "cached_tokens": cached_tokens,
+            "prompt_cache_hit_rate": cached_tokens / input_tokens if input_tokens else 0.0,
+            "output_tokens": sum(row[2] for row in calls),
+            "latency_p50": statistics.median(latencies) if latencies else None,
+            "latency_p95": latencies[int(0.95 * (len(latencies) - 1))] if latencies else None,
+            # Calls to models without a price in instrumentation.MODEL_PRICES are left out
+            "estimated_cost_usd": sum(cost for cost in costs if cost is not None) + cascade_cost,
+        }
+
+    def log_summary(self):
+        logging.info(f"Run metrics: {self.summary()}")
+        cascade = self.cascade_summary()
+        if cascade["cascade_calls"]:
+            logging.info(f"Cascade: {cascade}")
+
+    def close(self):
+        self.flush()
+        self.conn.close()
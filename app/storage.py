@@ -0,0 +1,211 @@
+import logging
+import sqlite3
+from typing import Callable, Iterable, List, Sequence, Tuple
+
+# Pragmas set on every connection. WAL lets the harvest, the abstract retrieval and the screening read and write
+# the same database at the same time; busy_timeout makes a writer wait for the lock instead of failing with
+# "database is locked". See https://www.sqlite.org/wal.html and https://www.sqlite.org/pragma.html
+PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA busy_timeout=30000",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-65536",
+    "PRAGMA mmap_size=268435456",
+)
+
+
+def connect(db_path: str, check_same_thread: bool = True) -> sqlite3.Connection:
+    """
+    Opens a connection with the shared pragmas. Use it instead of sqlite3.connect for every database of the project.
+    check_same_thread=False lets a connection be used from worker threads, when the caller makes sure only one uses it at a time.
+    """
+    conn = sqlite3.connect(db_path, timeout=30, check_same_thread=check_same_thread)
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+
+def _columns(conn: sqlite3.Connection, table: str) -> List[str]:
+    return [col[1] for col in conn.execute(f"PRAGMA table_info({table})")]
+
+
+def add_columns(conn: sqlite3.Connection, table: str, columns: Sequence[Tuple[str, str]]):
+    """Adds the (name, type) columns the table doesn't have yet. Databases created before the migrations may have some."""
+    existing = _columns(conn, table)
+    for name, col_type in columns:
+        if name not in existing:
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN {name} {col_type}")
+
+
+def _create_papers(conn: sqlite3.Connection):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS papers (
+            eid TEXT PRIMARY KEY,
+            scopus_id TEXT,
+            first_author TEXT,
+            content_retrieval_uri TEXT,
+            prism_doi TEXT,
+            link_self TEXT,
+            link_author_affiliation TEXT,
+            link_scopus TEXT,
+            open_access TEXT,
+            openaccessFlag BOOLEAN,
+            suptype TEXT,
+            suptype_code TEXT,
+            citedby_count INTEGER,
+            source_title TEXT,
+            prism_issn TEXT,
+            prism_isbn TEXT,
+            publication_date DATE,
+            pii TEXT,
+            pubmed_id TEXT,
+            orcid TEXT,
+            title TEXT)
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS harvest_progress (
+            query TEXT,
+            subject TEXT,
+            next_start INTEGER,
+            research_length INTEGER,
+            updated_at TEXT,
+            PRIMARY KEY (query, subject))
+    ''')
+
+
+def _add_abstract(conn: sqlite3.Connection):
+    add_columns(conn, "papers", [("abstract", "TEXT")])
+
+
+def _add_screening(conn: sqlite3.Connection):
+    add_columns(conn, "papers", [
+        ("to_be_reviewed", "BOOLEAN"),
+        ("confidence_level", "REAL"),
+        ("analysis_summary", "TEXT"),
+        # Which prompt and model each decision was made with, so only outdated decisions are screened again
+        ("screening_prompt_hash", "TEXT"),
+        ("screening_model", "TEXT"),
+        ("screened_at", "TEXT"),
+    ])
+
+
+def _add_indexes(conn: sqlite3.Connection):
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_papers_to_be_reviewed ON papers (to_be_reviewed)")
+    # Partial index: only the papers still waiting for their abstract, which is what retrieves_abstracts asks for
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_papers_abstract_missing ON papers (eid) WHERE abstract IS NULL")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_papers_publication_date ON papers (publication_date)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_papers_prism_doi ON papers (prism_doi)")
+
+
+def _add_dedup_index(conn: sqlite3.Connection):
+    # Every key (EID, DOI, normalised title) a paper is known under, see app.extract_papers.corpus
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS paper_keys (
+            key TEXT PRIMARY KEY,
+            eid TEXT)
+    ''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_paper_keys_eid ON paper_keys (eid)")
+    # Which queries found each paper
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS paper_sources (
+            eid TEXT,
+            query TEXT,
+            source_db TEXT,
+            added_at TEXT,
+            PRIMARY KEY (eid, query))
+    ''')
+
+
+def _add_prescreen(conn: sqlite3.Connection):
+    # Local pre-screening before the LLM, see app.extract_papers.prescreen
+    add_columns(conn, "papers", [("prescreen_score", "REAL"), ("duplicate_of", "TEXT")])
+
+
+def _add_classifier_score(conn: sqlite3.Connection):
+    # Probability of inclusion of the papers the active learning loop didn't send to the LLM, see app.extract_papers.active_learning
+    add_columns(conn, "papers", [("classifier_score", "REAL")])
+
+
+def _add_fulltext(conn: sqlite3.Connection):
+    # Open-access full texts, see app.extract_papers.fulltext
+    add_columns(conn, "papers", [
+        ("fulltext_status", "TEXT"),
+        ("fulltext_path", "TEXT"),
+        ("fulltext_fetched_at", "TEXT"),
+    ])
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_papers_fulltext_status ON papers (fulltext_status)")
+
+
+def _create_screening_batches(conn: sqlite3.Connection):
+    # Batches submitted to the Batch API, so an interrupted run resumes polling instead of paying for a new one,
+    # see app.extract_papers.batch_screening
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS screening_batches (
+            batch_id TEXT PRIMARY KEY,
+            requests_path TEXT,
+            prompt_hash TEXT,
+            model TEXT,
+            paper_count INTEGER,
+            status TEXT,
+            submitted_at TEXT,
+            finished_at TEXT)
+    ''')
+
+
+# Schema versions, applied in order. The version of a database is kept in PRAGMA user_version.
+# Add new migrations at the end, never change one that has been released.
+MIGRATIONS: List[Tuple[int, Callable[[sqlite3.Connection], None]]] = [
+    (1, _create_papers),
+    (2, _add_abstract),
+    (3, _add_screening),
+    (4, _add_indexes),
+    (5, _add_dedup_index),
+    (6, _add_prescreen),
+    (7, _add_classifier_score),
+    (8, _add_fulltext),
+    (9, _create_screening_batches),
+]
+
+
+def migrate(conn: sqlite3.Connection) -> int:
+    """Applies the migrations the database doesn't have yet, each in its own transaction. Returns the schema version."""
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    for target, migration in MIGRATIONS:
+        if target <= version:
+            continue
+        with conn:
+            migration(conn)
+            conn.execute(f"PRAGMA user_version = {target}")
+        logging.info(f"Migrated database to schema version {target} ({migration.__name__}).")
+        version = target
+    return version
+
+
+def open_db(db_path: str) -> sqlite3.Connection:
+    """Connects with the shared pragmas and brings the schema up to date."""
+    conn = connect(db_path)
+    migrate(conn)
+    return conn
+
+
+def init_db(db_path: str):
+    """Creates the database or brings its schema up to date."""
+    open_db(db_path).close()
+
+
+def upsert_sql(table: str, columns: Sequence[str], key: Sequence[str]) -> str:
+    """
+    INSERT ... ON CONFLICT DO UPDATE statement for the given columns.
+    Unlike INSERT OR REPLACE, columns that are not listed (abstract, screening decision...) keep their value.
+    """
+    placeholders = ", ".join("?" for _ in columns)
+    updates = ", ".join(f"{col} = excluded.{col}" for col in columns if col not in key)
+    return (f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({placeholders}) "
+            f"ON CONFLICT({', '.join(key)}) DO UPDATE SET {updates}")
+
+
+def upsert_rows(conn: sqlite3.Connection, table: str, columns: Sequence[str], rows: Iterable[Sequence], key: Sequence[str] = ("eid",)) -> int:
+    """Bulk upsert with executemany. Runs in the caller's transaction. Returns the number of rows written."""
+    cursor = conn.executemany(upsert_sql(table, columns, key), rows)
+    return cursor.rowcount
@@ -0,0 +1,81 @@
+import json
+from pathlib import Path
+from app.extract_papers.batch_screening import LocalBatchProvider, get_unfinished_batch, record_batch, run_batch_screening, \
+    write_batch_requests
+from app.extract_papers.screening_engine import get_papers_to_screen, prompt_hash
+from app.storage import connect, init_db
+
+INSTRUCTIONS = "Include the papers about the implementation of public policies."
+MODEL_NAME = "openai:gpt-4.1"
+
+
+class CountingProvider(LocalBatchProvider):
+    def __init__(self, work_dir: Path):
+        super().__init__(work_dir, self.answer)
+        self.submitted = 0
+
+    @staticmethod
+    def answer(body: dict) -> str:
+        included = "eid='2-s2.0-1'" in body["messages"][1]["content"]
+        return json.dumps({"should_be_included": included, "confidence_level": 0.8, "summary": "Local decision."})
+
+    def submit(self, requests_path: Path) -> str:
+        self.submitted += 1
+        return super().submit(requests_path)
+
+
+def make_db(tmp_path, papers: int) -> str:
+    db_path = str(tmp_path / "papers.db")
+    init_db(db_path)
+    conn = connect(db_path)
+    with conn:
+        conn.executemany("INSERT INTO papers (eid, title, abstract) VALUES (?, ?, ?)",
+                         [(f"2-s2.0-{i}", f"Paper {i}", f"Abstract of paper {i}.") for i in range(papers)])
+    conn.close()
+    return db_path
+
+
+def decisions(db_path: str) -> dict:
+    conn = connect(db_path)
+    try:
+        return {eid: (included, model) for eid, included, model in
+                conn.execute("SELECT eid, to_be_reviewed, screening_model FROM papers WHERE to_be_reviewed IS NOT NULL")}
+    finally:
+        conn.close()
+
+
+def test_full_batch_run(tmp_path):
+    db_path = make_db(tmp_path, 12)
+    provider = CountingProvider(tmp_path)
+
+    written = run_batch_screening(db_path, provider, INSTRUCTIONS, tmp_path / "batches", poll_interval=0, batch_size=5)
+
+    assert written == 12
+    assert provider.submitted == 1
+    saved = decisions(db_path)
+    assert len(saved) == 12 and {model for _, model in saved.values()} == {MODEL_NAME}
+    assert [eid for eid, (included, _) in saved.items() if included] == ["2-s2.0-1"]
+    assert get_unfinished_batch(db_path, prompt_hash(INSTRUCTIONS), MODEL_NAME) is None
+    # Nothing left for this prompt and model
+    assert run_batch_screening(db_path, provider, INSTRUCTIONS, tmp_path / "batches", poll_interval=0) == 0
+    assert provider.submitted == 1
+
+
+def test_submitted_batch_is_resumed(tmp_path):
+    db_path = make_db(tmp_path, 4)
+    provider = CountingProvider(tmp_path)
+    current = prompt_hash(INSTRUCTIONS)
+    # A run that submitted its batch and was interrupted while polling
+    requests_path = tmp_path / "screening_interrupted.jsonl"
+    count = write_batch_requests(get_papers_to_screen(db_path, current, MODEL_NAME), INSTRUCTIONS, "gpt-4.1", requests_path)
+    batch_id = LocalBatchProvider(tmp_path, provider.answer).submit(requests_path)
+    record_batch(db_path, batch_id, requests_path, current, MODEL_NAME, count)
+
+    written = run_batch_screening(db_path, provider, INSTRUCTIONS, tmp_path, poll_interval=0)
+
+    assert written == 4
+    assert provider.submitted == 0
+    assert len(decisions(db_path)) == 4
+    conn = connect(db_path)
+    assert conn.execute("SELECT status FROM screening_batches WHERE batch_id = ?", (batch_id,)).fetchone() == ("saved",)
+    conn.close()
@@ -0,0 +1,43 @@
+import asyncio
+from app.benchmarks.mock_scopus import MockScopus, synthetic_entry
+from app.extract_papers.fulltext import fetch_fulltexts_async, get_pending_fulltexts
+from app.extract_papers.search_basic_info import entry_to_paper, insert_papers_to_db
+from app.storage import connect, init_db
+
+
+def make_db(tmp_path, papers: int) -> str:
+    db_path = str(tmp_path / "papers.db")
+    init_db(db_path)
+    insert_papers_to_db(db_path, [entry_to_paper(synthetic_entry(i)) for i in range(papers)])
+    return db_path
+
+
+def statuses(db_path: str) -> set:
+    conn = connect(db_path)
+    try:
+        return {row[0] for row in conn.execute("SELECT fulltext_status FROM papers WHERE openaccessFlag = 1")}
+    finally:
+        conn.close()
+
+
+def fetch(db_path: str, tmp_path, scopus: MockScopus, key: str, max_unauthorized: int = 20) -> list:
+    host = scopus.base_url.split("//", 1)[1]
+    return asyncio.run(fetch_fulltexts_async(db_path, tmp_path / "store", {"X-ELS-APIKey": key}, None, 2, only_included=False,
+                                             flush_every=4, host_rates={host: 1000.0}, article_url=scopus.article_url,
+                                             max_unauthorized=max_unauthorized))
+
+
+def test_unauthorized_is_retried_on_the_next_run(tmp_path):
+    # Every third synthetic paper is open access: 10 to fetch
+    db_path = make_db(tmp_path, 30)
+    with MockScopus(30, latency=0, api_key="good") as scopus:
+        assert fetch(db_path, tmp_path, scopus, "bad", max_unauthorized=3) == []
+        # The run stops once the key is clearly wrong, instead of trying every paper
+        assert scopus.requests < 10
+        assert statuses(db_path) <= {"unauthorized", None}
+        assert len(get_pending_fulltexts(db_path, only_included=False)) == 10
+
+        fetched = fetch(db_path, tmp_path, scopus, "good")
+    assert len(fetched) == 10 and all(path.read_bytes().startswith(b"%PDF-") for path in fetched)
+    assert statuses(db_path) == {"fetched"}
+    assert get_pending_fulltexts(db_path, only_included=False) == []
@@ -0,0 +1,12 @@
+import asyncio
+from app.benchmarks.mock_scopus import MockScopus, synthetic_eid
+from app.extract_papers.search_basic_info import get_papers_async
+
+
+def test_get_papers_async_keeps_offset_order_through_429s():
+    papers = 503
+    with MockScopus(papers, latency=0, throttle_rate=0.2, retry_after=0.01) as scopus:
+        harvested = asyncio.run(get_papers_async({}, scopus.search_url, "test", "", "", papers, 10, concurrency=8,
+                                                 requests_per_second=1000.0))
+        assert scopus.throttled > 0
+    assert [paper["eid"] for paper in harvested] == [synthetic_eid(i) for i in range(papers)]
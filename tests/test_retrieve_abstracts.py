@@ -0,0 +1,41 @@
+import asyncio
+from app.benchmarks.mock_scopus import MockScopus, synthetic_eid
+from app.extract_papers.retrieves_abstracts import get_pending_eids, retrieve_abstracts_async
+from app.storage import connect, init_db
+
+
+def make_db(tmp_path, papers: int) -> str:
+    db_path = str(tmp_path / "papers.db")
+    init_db(db_path)
+    conn = connect(db_path)
+    with conn:
+        conn.executemany("INSERT INTO papers (eid, title) VALUES (?, ?)", [(synthetic_eid(i), f"Paper {i}") for i in range(papers)])
+    conn.close()
+    return db_path
+
+
+def abstracts(db_path: str) -> list:
+    conn = connect(db_path)
+    try:
+        return [row[0] for row in conn.execute("SELECT abstract FROM papers ORDER BY eid")]
+    finally:
+        conn.close()
+
+
+def test_abstracts_are_retrieved_through_429s(tmp_path):
+    db_path = make_db(tmp_path, 30)
+    with MockScopus(30, latency=0, throttle_rate=0.2, retry_after=0.01) as scopus:
+        written = asyncio.run(retrieve_abstracts_async(db_path, {}, 4, 1000.0, flush_every=7, url=scopus.abstract_url))
+    assert written == 30
+    assert all(abstracts(db_path))
+    assert get_pending_eids(db_path) == []
+
+
+def test_not_found_is_not_requested_again(tmp_path):
+    db_path = make_db(tmp_path, 5)
+    with MockScopus(5, latency=0) as scopus:
+        written = asyncio.run(retrieve_abstracts_async(db_path, {}, 4, 1000.0, url=scopus.base_url + "/missing/{eid}"))
+        assert scopus.requests == 5
+    assert written == 5
+    assert abstracts(db_path) == [""] * 5
+    assert get_pending_eids(db_path) == []
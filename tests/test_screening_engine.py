@@ -0,0 +1,57 @@
+import asyncio
+from pydantic_ai.models.test import TestModel
+from app.benchmarks.fake_models import screening_output, simulated_model
+from app.extract_papers.analyses_abstracts import build_agent
+from app.extract_papers.screening_engine import prompt_hash, screen_papers_async
+from app.instrumentation import METRICS
+from app.storage import connect, init_db
+
+INSTRUCTIONS = "Include the papers about the implementation of public policies."
+
+
+def make_db(tmp_path, papers: int) -> str:
+    db_path = str(tmp_path / "papers.db")
+    init_db(db_path)
+    conn = connect(db_path)
+    with conn:
+        conn.executemany("INSERT INTO papers (eid, title, abstract) VALUES (?, ?, ?)",
+                         [(f"2-s2.0-{i}", f"Paper {i}", f"Abstract of paper {i}.") for i in range(papers)])
+    conn.close()
+    return db_path
+
+
+def decisions(db_path: str) -> list:
+    conn = connect(db_path)
+    try:
+        return conn.execute("SELECT eid, to_be_reviewed, screening_prompt_hash, screening_model FROM papers ORDER BY eid").fetchall()
+    finally:
+        conn.close()
+
+
+def test_writer_commits_in_batches(tmp_path):
+    db_path = make_db(tmp_path, 7)
+    agent = build_agent(INSTRUCTIONS, model=simulated_model(screening_output, latency=0))
+    METRICS.reset()
+
+    written = asyncio.run(screen_papers_async(db_path, agent, prompt_hash=prompt_hash(INSTRUCTIONS), concurrency=4, batch_size=3))
+
+    assert written == 7
+    assert all(row[1] is not None and row[2] == prompt_hash(INSTRUCTIONS) for row in decisions(db_path))
+    rows = METRICS.histograms[METRICS._key("sqlite_write_rows", {"op": "screening"})]
+    # Two full batches of 3 and the last paper on its own
+    assert rows.count == 3
+    assert rows.sum == 7
+
+
+def test_screened_papers_are_skipped_for_the_same_prompt_and_model(tmp_path):
+    db_path = make_db(tmp_path, 5)
+    agent = build_agent(INSTRUCTIONS, model=simulated_model(screening_output, latency=0))
+    current = prompt_hash(INSTRUCTIONS)
+
+    assert asyncio.run(screen_papers_async(db_path, agent, prompt_hash=current)) == 5
+    assert asyncio.run(screen_papers_async(db_path, agent, prompt_hash=current)) == 0
+    # New instructions or another model: every paper is screened again
+    assert asyncio.run(screen_papers_async(db_path, agent, prompt_hash=prompt_hash(INSTRUCTIONS + " Exclude reviews."))) == 5
+    with agent.override(model=TestModel()):
+        assert asyncio.run(screen_papers_async(db_path, agent, prompt_hash=current)) == 5
+    assert {row[3] for row in decisions(db_path)} == {"test:test"}